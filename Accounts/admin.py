@@ -2,7 +2,7 @@ from django.contrib import admin
 from django.contrib.admin import HORIZONTAL
 from django.db import models
 
-from .models import Transaction, Account, Categories, FinancialYear, UploadError, UploadHistory
+from .models import Transaction, Account, Categories, FinancialYear, UploadError, UploadHistory, ImportJob, CategoryRule
 
 
 # Register your models here.
@@ -16,6 +16,11 @@ class UploadErrorAdmin(admin.ModelAdmin):
     list_display = ['upload_history', 'transaction', 'error_message']
     date_hierarchy = 'upload_history__uploaded_at'
 
+@admin.register(ImportJob)
+class ImportJobAdmin(admin.ModelAdmin):
+    list_display = ['file_name', 'account', 'uploaded_by', 'status', 'rows_processed', 'error_count', 'created_at']
+    list_filter = ['status']
+
 @admin.register(Transaction)
 class TransactionAdmin(admin.ModelAdmin):
     list_display = ['transaction_date',  'description','credit', 'debit']
@@ -45,6 +50,19 @@ class CategoriesAdmin(admin.ModelAdmin):
         """Now maybe you want to only show the "root" categories, the ones that have no parent, then you can override the `queryset` attribute or the `get_queryset` method"""
         return super().get_queryset(request).filter(parent__isnull=True)
 
+@admin.register(CategoryRule)
+class CategoryRuleAdmin(admin.ModelAdmin):
+    list_display = ['order', 'field', 'pattern', 'amount_sign', 'category', 'active', 'source', 'support']
+    list_display_links = ['pattern']
+    list_editable = ['order', 'active']
+    list_filter = ['active', 'source', 'category']
+    radio_fields = {'field': HORIZONTAL, 'amount_sign': HORIZONTAL}
+    actions = ['activate']
+
+    @admin.action(description='Activate the selected rules')
+    def activate(self, request, queryset):
+        queryset.update(active=True)
+
 @admin.register(FinancialYear)
 class FinancialYearAdmin(admin.ModelAdmin):
     pass
\ No newline at end of file
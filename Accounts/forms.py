@@ -32,6 +32,7 @@ class Upload(forms.Form):
     account = forms.ModelChoiceField(queryset=Account.objects.all())
     file = forms.FileField(
         label='Select a file',
+        help_text='A CSV, OFX, QIF or camt.053 statement',
     )
 
 class SummaryForm(forms.Form):
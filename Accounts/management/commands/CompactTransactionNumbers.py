@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+
+import logging
+
+from Accounts.models import Account
+from Accounts.services.numbering import compact_numbers
+
+logger = logging.getLogger('Accounts.management.CompactTransactionNumbers')
+
+
+class Command( BaseCommand ):
+    help = 'Re-space the transaction numbers of each account - so out of order uploads can be numbered into the gaps'
+
+    def add_arguments(self, parser):
+        parser.add_argument("--account", type=int, action="append", dest="accounts",
+                            help="The id of an account to compact (may be repeated) - defaults to all accounts")
+
+    def handle(self, *args, **options):
+        verbose = options.get('verbosity', 0)
+
+        accounts = Account.objects.all()
+        if options['accounts']:
+            accounts = accounts.filter(id__in=options['accounts'])
+            if len(accounts) != len(set(options['accounts'])):
+                raise CommandError(f'Unknown account in {options["accounts"]}')
+
+        for account in accounts:
+            renumbered = compact_numbers(account)
+            if verbose:
+                self.stdout.write(f'{account} : {renumbered} transaction(s) renumbered')
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+
+import logging
+
+from Accounts.services.categorisation import learn_rules
+
+logger = logging.getLogger('Accounts.management.LearnCategoryRules')
+
+
+class Command( BaseCommand ):
+    help = ('Propose category rules from how past transactions with the same name were categorised - '
+            'the rules are inactive until activated in the admin')
+
+    def add_arguments(self, parser):
+        parser.add_argument("--min-count", type=int, default=3, dest="min_count",
+                            help="The least number of past transactions a rule is based on (default 3)")
+        parser.add_argument("--min-share", type=float, default=0.9, dest="min_share",
+                            help="The least share of the transactions with a name which have the category (default 0.9)")
+        parser.add_argument("--activate", action="store_true",
+                            help="Make the proposed rules active straight away")
+
+    def handle(self, *args, **options):
+        verbose = options.get('verbosity', 0)
+        if not 0 < options['min_share'] <= 1:
+            raise CommandError(f'--min-share must be between 0 and 1 - not {options["min_share"]}')
+
+        proposed = learn_rules(min_count=options['min_count'], min_share=options['min_share'], activate=options['activate'])
+        if verbose:
+            for rule in proposed:
+                self.stdout.write(f'{rule} - from {rule.support} transaction(s)')
+            self.stdout.write(f'{len(proposed)} rule(s) proposed')
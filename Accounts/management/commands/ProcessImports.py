@@ -0,0 +1,37 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+import logging
+
+from Accounts.models import ImportJob
+from Accounts.services.import_jobs import run_job
+
+logger = logging.getLogger('Accounts.management.ProcessImports')
+
+
+class Command( BaseCommand ):
+    help = 'Process queued bank statement uploads'
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true",
+                            help="Process the jobs that are currently queued and then exit")
+        parser.add_argument("--sleep", type=float, default=5.0,
+                            help="Seconds to wait between polls of an empty queue")
+
+    def handle(self, *args, **options):
+        verbose = options.get('verbosity', 0)
+
+        while True:
+            job = ImportJob.objects.claim_next()
+            if job is None:
+                if options['once']:
+                    return
+                time.sleep(options['sleep'])
+                continue
+
+            if verbose:
+                self.stdout.write(f'Processing {job}')
+            job = run_job(job)
+            if verbose:
+                self.stdout.write(f'{job} : {job.rows_processed} rows, {job.error_count} error(s) {job.message}')
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+
+import logging
+
+from Accounts.models import Account, Transaction
+
+logger = logging.getLogger('Accounts.management.RebuildSplitTotals')
+
+
+class Command( BaseCommand ):
+    help = 'Recalculate the split totals held on each transaction from the splits themselves'
+
+    def add_arguments(self, parser):
+        parser.add_argument("--account", type=int, action="append", dest="accounts",
+                            help="The id of an account to rebuild (may be repeated) - defaults to all accounts")
+
+    def handle(self, *args, **options):
+        verbose = options.get('verbosity', 0)
+
+        accounts = Account.objects.all()
+        if options['accounts']:
+            accounts = accounts.filter(id__in=options['accounts'])
+            if len(accounts) != len(set(options['accounts'])):
+                raise CommandError(f'Unknown account in {options["accounts"]}')
+
+        for account in accounts:
+            updated = Transaction.objects.refresh_split_totals(Transaction.objects.filter(account=account, parent__isnull=True))
+            if verbose:
+                self.stdout.write(f'{account} : split totals rebuilt for {updated} transaction(s)')
@@ -0,0 +1,49 @@
+# Generated by Django 5.0 on 2026-10-18 06:23
+
+import hashlib
+from collections import Counter
+from decimal import Decimal
+
+from django.db import migrations, models
+
+def set_fingerprint(apps, schema_editor):
+    """Fingerprint the existing statement rows - as Transaction.make_fingerprint
+
+       Existing rows can be identical (the unique_together didn't apply to rows with a NULL debit or credit, and
+       the fingerprint ignores spaces around the description) - so, as TransactionImporter.fingerprint, the nth
+       identical row (in ledger order, counting from 0) has n in its fingerprint too, and every fingerprint is unique.
+    """
+    Transaction = apps.get_model('Accounts', 'Transaction')
+
+    transactions = list(Transaction.objects.filter(parent__isnull=True).order_by('account', 'transaction_date', 'tx_number', 'id'))
+    occurrences = Counter()
+    for transaction in transactions:
+        amount = (transaction.credit or Decimal('0')) - (transaction.debit or Decimal('0'))
+        balance = f'{transaction.balance:.2f}' if transaction.balance is not None else ''
+        key = (f'{transaction.account_id}|{transaction.transaction_date.isoformat()}|'
+               f'{transaction.description.strip()}|{amount:.2f}|{balance}')
+        occurrence = occurrences[key]
+        occurrences[key] += 1
+        if occurrence:
+            key += f'|{occurrence}'
+        transaction.fingerprint = hashlib.sha256(key.encode('utf-8')).hexdigest()
+    Transaction.objects.bulk_update(transactions, ['fingerprint'], batch_size=500)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Accounts', '0025_importjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='fingerprint',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['account', 'fingerprint'], name='TransactionByFingerprint'),
+        ),
+        migrations.RunPython(set_fingerprint, reverse_code=migrations.RunPython.noop),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 5.0 on 2026-10-18 06:28
+
+import django.db.models.deletion
+from decimal import Decimal
+from django.db import migrations, models
+
+from django.db.models import Count, F, Sum, Value
+from django.db.models.functions import Coalesce, TruncMonth
+
+def build_totals(apps, schema_editor):
+    Transaction = apps.get_model('Accounts', 'Transaction')
+    CategoryMonthlyTotal = apps.get_model('Accounts', 'CategoryMonthlyTotal')
+
+    totals = (Transaction.objects.order_by().
+                values('account_id', 'category', month=TruncMonth('transaction_date'),
+                       parent_category=Coalesce(F('parent__category'), Value(''))).
+                annotate(credit_sum=Sum('credit', default=Decimal('0.00')),
+                         debit_sum=Sum('debit', default=Decimal('0.00')),
+                         tx_count=Count('id')))
+    CategoryMonthlyTotal.objects.bulk_create([CategoryMonthlyTotal(account_id=row['account_id'], month=row['month'],
+                                                                   category=row['category'], parent_category=row['parent_category'],
+                                                                   credit=row['credit_sum'], debit=row['debit_sum'], count=row['tx_count'])
+                                              for row in totals], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Accounts', '0026_transaction_fingerprint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CategoryMonthlyTotal',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField()),
+                ('category', models.CharField(max_length=100)),
+                ('parent_category', models.CharField(blank=True, default='', max_length=100)),
+                ('credit', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=12)),
+                ('debit', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=12)),
+                ('count', models.IntegerField(default=0)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='Accounts.account')),
+            ],
+            options={
+                'unique_together': {('account', 'month', 'category', 'parent_category')},
+            },
+        ),
+        migrations.RunPython(build_totals, reverse_code=migrations.RunPython.noop),
+    ]
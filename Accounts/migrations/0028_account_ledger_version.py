@@ -0,0 +1,18 @@
+# Generated by Django 5.0 on 2026-10-18 06:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Accounts', '0027_categorymonthlytotal'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='account',
+            name='ledger_version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.0 on 2026-10-18 06:35
+
+from decimal import Decimal
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+def set_split_totals(apps, schema_editor):
+    """Total the existing splits onto their parents - as TransactionManager.refresh_split_totals"""
+    Transaction = apps.get_model('Accounts', 'Transaction')
+
+    splits = Transaction.objects.filter(parent=OuterRef('id')).order_by().values('parent')
+    Transaction.objects.filter(parent__isnull=True, id__in=Transaction.objects.filter(parent__isnull=False).values('parent')).update(
+        split_credit_total=Coalesce(Subquery(splits.annotate(total=Sum('credit')).values('total')), Value(Decimal('0.00'))),
+        split_debit_total=Coalesce(Subquery(splits.annotate(total=Sum('debit')).values('total')), Value(Decimal('0.00'))))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Accounts', '0028_account_ledger_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='split_credit_total',
+            field=models.DecimalField(decimal_places=2, default=Decimal('0.00'), editable=False, max_digits=10),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='split_debit_total',
+            field=models.DecimalField(decimal_places=2, default=Decimal('0.00'), editable=False, max_digits=10),
+        ),
+        migrations.RunPython(set_split_totals, reverse_code=migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.0 on 2026-10-18 06:46
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Accounts', '0029_transaction_split_totals'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CategoryRule',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('order', models.PositiveIntegerField(default=0, help_text='Rules are tried lowest first')),
+                ('field', models.CharField(choices=[('name', 'Name'), ('description', 'Description')], default='description', max_length=11)),
+                ('pattern', models.CharField(help_text='A regular expression - found anywhere in the field, ignoring case', max_length=200)),
+                ('amount_sign', models.CharField(choices=[('any', 'Credit or Debit'), ('credit', 'Credit'), ('debit', 'Debit')], default='any', max_length=6)),
+                ('active', models.BooleanField(default=True)),
+                ('source', models.CharField(choices=[('manual', 'Manual'), ('learned', 'Learned from history')], default='manual', editable=False, max_length=7)),
+                ('support', models.PositiveIntegerField(default=0, editable=False, help_text='The past transactions a learned rule is based on')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rules', to='Accounts.categories', to_field='category_name')),
+            ],
+            options={
+                'ordering': ['order', 'id'],
+            },
+        ),
+    ]
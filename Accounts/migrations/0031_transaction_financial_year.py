@@ -0,0 +1,28 @@
+# Generated by Django 5.0 on 2026-10-18 06:51
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def set_financial_years(apps, schema_editor):
+    """Point the existing transactions at the financial year they are dated in - as TransactionManager.assign_financial_year"""
+    FinancialYear = apps.get_model('Accounts', 'FinancialYear')
+    Transaction = apps.get_model('Accounts', 'Transaction')
+
+    for financial_year in FinancialYear.objects.all():
+        Transaction.objects.filter(transaction_date__range=(financial_year.year_start, financial_year.year_end)).update(financial_year=financial_year)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Accounts', '0030_categoryrule'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='financial_year',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='transactions', to='Accounts.financialyear'),
+        ),
+        migrations.RunPython(set_financial_years, reverse_code=migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.0 on 2026-10-18 07:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Accounts', '0032_importjob_heartbeat_at'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='transaction',
+            name='TransactionByFingerprint',
+        ),
+        migrations.AlterUniqueTogether(
+            name='transaction',
+            unique_together=set(),
+        ),
+        migrations.AddConstraint(
+            model_name='transaction',
+            constraint=models.UniqueConstraint(fields=('account', 'fingerprint'), name='UniqueTransactionFingerprint'),
+        ),
+    ]
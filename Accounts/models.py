@@ -1,15 +1,24 @@
 import datetime
+import hashlib
+import uuid
 from decimal import Decimal
+from itertools import chain
 
 from gdstorage.storage import GoogleDriveStorage
 
 from django.apps import apps
 from django.conf import settings
-from django.db import models
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, models, transaction as db_transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.urls import reverse
+from django.utils import timezone
 import re
 import string
 
-from django.db.models import Lookup, OuterRef, Subquery, F, Sum, Case, When, Value, Q, Exists, Count
+from django.db.models import Lookup, OuterRef, Subquery, F, Sum, Case, When, Value, Q, Exists, Count, Window, RowRange
+from django.db.models.functions import Coalesce, Lag, TruncMonth
 from django.db.models.sql import Query
 from django.template.defaultfilters import default
 from django.utils.translation.reloader import translation_file_changed
@@ -39,6 +48,16 @@ class AccountManager(models.Manager):
     def get_by_natural_key(self, bank_name, sort_code, account_number):
         return self.get(bank_name=bank_name, sort_code=sort_code, account_number=account_number)
 
+    def ledger_changed(self, account, start:datetime.date, end:datetime.date):
+        """Record a change to the transactions of an account between start and end - the monthly totals
+           are rebuilt, and the ledger version is bumped so that cached reports are no longer used"""
+        CategoryMonthlyTotal.objects.refresh(account, start, end)
+        self.bump_ledger_version(account)
+
+    def bump_ledger_version(self, account):
+        """The transactions of the account have changed - so cached reports are no longer used"""
+        self.filter(id=getattr(account, 'id', account)).update(ledger_version=F('ledger_version') + 1)
+
 class Account(models.Model):
     objects = AccountManager()
     bank_name = models.CharField(max_length=100)
@@ -46,6 +65,9 @@ class Account(models.Model):
     account_number = models.CharField(max_length=100)
     starting_balance = models.DecimalField(max_digits=10, decimal_places=2)
 
+    # Bumped whenever the transactions change - part of the key for cached reports
+    ledger_version = models.PositiveIntegerField(default=0, editable=False)
+
     @property
     def last_transaction_number(self):
         return last if (last := Transaction.objects.filter(account=self).aggregate(models.Max('tx_number'))['tx_number__max']) else 0
@@ -80,6 +102,39 @@ class Categories(models.Model):
         return self.category_name
 
 
+CATEGORY_TREE_VERSION_KEY = 'Accounts:category_tree_version'
+FINANCIAL_YEAR_VERSION_KEY = 'Accounts:financial_year_version'
+
+class CacheVersion(models.Model):
+    """The version of data each process holds in memory (the category tree, the financial years) - see bump_version
+
+       Kept in the database rather than the cache (the default cache is per process), so every process sees it.
+    """
+    key = models.CharField(max_length=100, primary_key=True)
+    version = models.CharField(max_length=32)
+
+def bump_version(key:str):
+    """Tell every process to reload the data held under this version key
+
+       The new version is written in the same transaction as the change - so other processes see both at once,
+       and neither if the change is rolled back. Each version is new (not a count), so one which is rolled back
+       is never seen again.
+    """
+    CacheVersion.objects.update_or_create(key=key, defaults={'version': uuid.uuid4().hex})
+
+def current_version(key:str) -> str:
+    """The version of the data held under this key - compare with the version the data was loaded at"""
+    return CacheVersion.objects.filter(key=key).values_list('version', flat=True).first() or ''
+
+@receiver([post_save, post_delete], sender=Categories)
+def categories_changed(**kwargs):
+    """Tell every process to reload its category tree (see Accounts.services.category_tree)
+
+       A signal rather than a save override - so fixtures, which are saved raw, are seen too.
+    """
+    bump_version(CATEGORY_TREE_VERSION_KEY)
+
+
 class FinancialYearManager(models.Manager):
     def current(self):
         return self.get(year_start__lte=datetime.date.today(), year_end__gte=datetime.date.today())
@@ -87,16 +142,18 @@ class FinancialYearManager(models.Manager):
         return self.create(year=f'{calendar_year}-{calendar_year+1}', year_start=datetime.date(calendar_year, 10, 1), year_end=datetime.date(calendar_year+1, 9, 30))
     def get_natural_key(self,year):
         return self.get(year=year)
-    def get_transaction_list(self, account):
-        return Transaction.objects.filter(account=account, financial_year=self).order_by('transaction_date')
+    def id_for(self, day:datetime.date) -> int|None:
+        """The id of the financial year the date falls in (or None) - from the database, so never out of date"""
+        return self.filter(year_start__lte=day, year_end__gte=day).values_list('id', flat=True).first()
+    def get_transaction_list(self, account, financial_year):
+        return Transaction.objects.filter(account=account, financial_year=financial_year).order_by('transaction_date')
     def overlap(self, period_start, period_end):
-        """Return all the Financial Year that contain the period as provided"""
-        return (FinancialYear.objects.
-                    filter(
-                            Q(year_start__lte=period_start, year_end__gte=period_start)| # Contains the start date
-                            Q(year_start__lte=period_end, year_end__gte=period_end)|     # Contains the end date
-                            Q(year_start__gt=period_start, year_end__lt=period_end)      # Is in the middle of the period
-                    ).distinct('year_start').values_list('year', flat=True).order_by('year_start'))
+        """Return the names of all the Financial Years which overlap the period as provided - earliest first
+
+           From the database rather than the financial year index - so a year just created elsewhere is seen.
+        """
+        return list(self.filter(year_start__lte=period_end, year_end__gte=period_start).
+                            order_by('year_start').values_list('year', flat=True))
 
 class FinancialYear(models.Model):
     objects = FinancialYearManager()
@@ -119,6 +176,18 @@ class FinancialYear(models.Model):
     def is_complete(self):
         return self.year_end < datetime.date.today()
 
+@receiver(post_save, sender=FinancialYear)
+def financial_year_saved(instance, **kwargs):
+    """Move the transactions into (or out of) the year as its dates change - and tell every process to reload
+       its financial year index (see Accounts.services.financial_years)"""
+    Transaction.objects.assign_financial_year(instance)
+    bump_version(FINANCIAL_YEAR_VERSION_KEY)
+
+@receiver(post_delete, sender=FinancialYear)
+def financial_year_deleted(**kwargs):
+    """The year's transactions are left without a financial year by the foreign key (SET_NULL)"""
+    bump_version(FINANCIAL_YEAR_VERSION_KEY)
+
 class UploadHistoryManager(models.Manager):
     def get_by_natural_key(self, account, start_date, end_date):
         account_id = Account.objects.get_by_natural_key(*account).id
@@ -144,6 +213,11 @@ class UploadHistory(models.Model):
     def error_count(self):
         return self.errors.count()
 
+    def delete(self, *args, **kwargs):
+        deleted = super().delete(*args, **kwargs)
+        Account.objects.ledger_changed(self.account_id, self.start_date, self.end_date)
+        return deleted
+
 class UploadErrorManager(models.Manager):
     def get_by_natural_key(self, upload, transaction):
         upload_id = UploadHistory.objects.get_by_natural_key(*upload).id
@@ -165,6 +239,60 @@ class TransactionManager(models.Manager):
     def get_by_natural_key(self, account, transaction_number):
         account_id = Account.objects.get_by_natural_key(*account).id
         return self.get(account=account_id, tx_number=transaction_number)
+
+    def refresh_split_totals(self, parents):
+        """Recalculate the split totals held on each of the parent transactions from their splits
+
+           parents is a queryset (or filter) of the parent transactions; returns the number of parents updated.
+        """
+        parents = parents if isinstance(parents, models.QuerySet) else self.filter(parents)
+        splits = self.filter(parent=OuterRef('id')).order_by().values('parent')
+        return parents.update(
+            split_credit_total=Coalesce(Subquery(splits.annotate(total=Sum('credit')).values('total')), Value(Decimal('0.00'))),
+            split_debit_total=Coalesce(Subquery(splits.annotate(total=Sum('debit')).values('total')), Value(Decimal('0.00'))))
+
+    def assign_financial_year(self, financial_year) -> int:
+        """Point the transactions dated within the financial year at it - and any which no longer are away from it
+
+           Returns the number of transactions now in the year.
+        """
+        in_year = Q(transaction_date__range=(financial_year.year_start, financial_year.year_end))
+        with db_transaction.atomic():
+            self.filter(financial_year=financial_year).exclude(in_year).update(financial_year=None)
+            return self.filter(in_year).update(financial_year=financial_year)
+
+    def assign_financial_years(self, account, start:datetime.date, end:datetime.date) -> int:
+        """Point the account's transactions between start and end at the financial year each is dated in - in one query
+
+           Returns the number of transactions updated.
+        """
+        year = FinancialYear.objects.filter(year_start__lte=OuterRef('transaction_date'),
+                                            year_end__gte=OuterRef('transaction_date')).values('id')[:1]
+        return self.filter(account=account, transaction_date__range=(start, end)).update(financial_year=Subquery(year))
+
+    def with_running_balance(self, account):
+        """The account's statement rows in ledger order - (transaction_date, tx_number) - each annotated with :
+
+              running_balance : the account's starting balance plus the credits less the debits up to and including the row
+              previous_balance : the imported balance on the row before (None on the first row)
+              expected_balance : the previous balance plus the row's credit less its debit
+        """
+        ledger_order = [F('transaction_date').asc(), F('tx_number').asc()]
+        movement = Coalesce(F('credit'), Value(Decimal('0.00'))) - Coalesce(F('debit'), Value(Decimal('0.00')))
+        return (self.filter(account=account, parent__isnull=True).
+                annotate(running_balance=F('account__starting_balance') +
+                                         Window(Sum(movement), order_by=ledger_order, frame=RowRange(start=None, end=0)),
+                         previous_balance=Window(Lag('balance'), order_by=ledger_order)).
+                annotate(expected_balance=F('previous_balance') + movement).
+                order_by(*ledger_order))
+
+    def discontinuities(self, account):
+        """The statement rows whose imported balance doesn't follow on from the row before - a missing or duplicated statement"""
+        return (self.with_running_balance(account).
+                filter(balance__isnull=False, previous_balance__isnull=False).
+                exclude(balance=F('expected_balance')))
+
+
 class TransactionDetailsManager(models.Manager):
     def combined(self):
         """Return a queryset of an ordered set of transaction including any splits"""
@@ -177,13 +305,9 @@ class TransactionDetailsManager(models.Manager):
         return qs_all.order_by('transaction_date', 'actual_transaction', 'split_or_not', 'amount')
     def bank_only(self):
         """An ordered query set of just those transactions that would appear on a bank statement"""
-        splits  = (Transaction.objects.filter(parent__id=OuterRef('id')).values('parent__id').
-                           annotate(split_credit = Sum('credit', default=Decimal("0.00"))).
-                           annotate(split_debit=Sum('debit', default=Decimal("0.00"))).values('split_debit','split_credit'))
-
         return (self.get_queryset().filter(parent__isnull=True).annotate(actual_transaction=F('id')).
-                annotate(remaining_credit=F('credit') - Case(When(Exists(splits), then=Subquery(splits.values('split_credit')[:1])), default=Value(Decimal("0.00")) )).
-                annotate(remaining_debit=F('debit') - Case(When(Exists(splits), then=Subquery(splits.values('split_debit')[:1])), default=Value(Decimal("0.00")) )).
+                annotate(remaining_credit=F('credit') - F('split_credit_total')).
+                annotate(remaining_debit=F('debit') - F('split_debit_total')).
                 order_by('transaction_date','actual_transaction'))
 
 
@@ -202,11 +326,27 @@ class Transaction(models.Model):
     upload_history = models.ForeignKey(UploadHistory, on_delete=models.CASCADE, null=True, default=None)
     balance =  models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
 
+    # The financial year the transaction is dated in - so a year's transactions are one indexed lookup rather than a date range
+    financial_year = models.ForeignKey(FinancialYear, on_delete=models.SET_NULL, null=True, blank=True, editable=False,
+                                       related_name='transactions')
+
+    # Identifies a bank statement row - so re-uploaded rows can be found with one indexed lookup
+    fingerprint = models.CharField(max_length=64, null=True, blank=True, editable=False)
+
+    # The totals of this transaction's splits - kept up to date as splits are saved and deleted
+    split_credit_total = models.DecimalField(max_digits=10, decimal_places=2, default=Decimal('0.00'), editable=False)
+    split_debit_total = models.DecimalField(max_digits=10, decimal_places=2, default=Decimal('0.00'), editable=False)
+    SPLIT_TOTALS = ('split_credit_total', 'split_debit_total')
+
+    # The fields which decide what a row adds to the monthly totals - and their values when the row was loaded
+    TOTALS_FIELDS = frozenset({'account', 'transaction_date', 'category', 'parent', 'credit', 'debit'})
+    _loaded_totals = None
+
     class Meta:
         permissions = [ ('upload_transaction','Can upload upload'),
                          ('report_transaction','Can upload report')]
         ordering = ['transaction_date']
-        unique_together = [['transaction_date', 'description', 'debit', 'credit']]
+        constraints = [models.UniqueConstraint(name='UniqueTransactionFingerprint', fields=['account', 'fingerprint'])]
 
     def get_transaction_date_display(self):
         return self.transaction_date.strftime('%d/%m/%Y')
@@ -223,13 +363,119 @@ class Transaction(models.Model):
     def is_child(self):
         return self.parent is not None
 
+    @staticmethod
+    def name_from_description(description:str) -> str|None:
+        """Derive a display name from the leading text of a bank description"""
+        m = re.match(r"([A-Za-z ']*(?!\d|(\w\d)))", description)
+        return string.capwords(m.group(1)) if m else None
+
+    @staticmethod
+    def make_fingerprint(account_id, transaction_date, description, debit, credit, balance, occurrence:int = 0) -> str:
+        """A hash of the statement row - the account, date, description, amount and running balance.
+           A statement without balances can have identical rows (two equal payments on the same day) - so
+           the nth identical row (counting from 0) has n in its fingerprint too"""
+        amount = (credit or Decimal('0')) - (debit or Decimal('0'))
+        balance = f'{balance:.2f}' if balance is not None else ''
+        key = f'{account_id}|{transaction_date.isoformat()}|{description.strip()}|{amount:.2f}|{balance}'
+        if occurrence:
+            key += f'|{occurrence}'
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def get_fingerprint(self, occurrence:int = 0) -> str|None:
+        """Splits aren't statement rows - so they don't have a fingerprint"""
+        if self.parent_id is not None:
+            return None
+        return self.make_fingerprint(self.account_id, self.transaction_date, self.description,
+                                     self.debit, self.credit, self.balance, occurrence)
+
     def save(self, *args, **kwargs):
         if not self.name:
-            m = re.match(r"([A-Za-z ']*(?!\d|(\w\d)))", self.description)
-            if m:
-                self.name = string.capwords(m.group(1))
-
-        super().save(*args, **kwargs)
+            self.name = self.name_from_description(self.description)
+
+        # The fingerprint identifies the row as it was uploaded - so it is kept when the row is edited
+        if self.fingerprint is None:
+            self.fingerprint = self.get_fingerprint()
+
+        # From the database rather than the financial year index - which another process may have changed
+        self.financial_year_id = FinancialYear.objects.id_for(self.transaction_date)
+
+        # The split totals are only written by refresh_split_totals - saving a (possibly stale) parent mustn't overwrite them
+        update_fields = kwargs.get('update_fields')
+        if self.pk and not self._state.adding and update_fields is None:
+            kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields
+                                       if not field.primary_key and field.name not in self.SPLIT_TOTALS]
+
+        with db_transaction.atomic():
+            # What the row added to the monthly totals before this save - read again if it wasn't loaded with those fields
+            before = None if self._state.adding else (self._loaded_totals or self._stored_totals())
+            super().save(*args, **kwargs)
+            self._refresh_parent()
+            partial = update_fields is not None and not self.TOTALS_FIELDS.issubset(update_fields)
+            after = self._stored_totals() if partial else self._totals_entry()
+            # The splits are totalled under this row's category - so they move with it
+            moves_splits = before is not None and before[:3] != after[:3] and self._has_splits()
+            self._totals_changed(before, after, rebuild=moves_splits)
+        self._loaded_totals = after
+
+    def delete(self, *args, **kwargs):
+        with db_transaction.atomic():
+            before = self._loaded_totals or self._stored_totals()
+            # The splits are deleted with it
+            rebuild = self._has_splits()
+            deleted = super().delete(*args, **kwargs)
+            self._refresh_parent()
+            self._totals_changed(before, None, rebuild=rebuild)
+        self._loaded_totals = None
+        return deleted
+
+    def _has_splits(self) -> bool:
+        return self.parent_id is None and Transaction.objects.filter(parent_id=self.pk).exists()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if not instance.get_deferred_fields() & {cls._meta.get_field(name).attname for name in cls.TOTALS_FIELDS}:
+            instance._loaded_totals = instance._totals_entry()
+        return instance
+
+    def _totals_entry(self) -> tuple:
+        """What this row adds to the monthly totals (see CategoryMonthlyTotal)"""
+        return (self.account_id, self.transaction_date, self.category, self.parent_id,
+                Decimal(str(self.credit or 0)), Decimal(str(self.debit or 0)))
+
+    def _stored_totals(self) -> tuple|None:
+        """What the row as saved adds to the monthly totals - None if it isn't saved"""
+        stored = (Transaction.objects.filter(pk=self.pk).
+                        values_list('account_id', 'transaction_date', 'category', 'parent_id', 'credit', 'debit').first()) if self.pk else None
+        return stored and (*stored[:4], stored[4] or Decimal('0.00'), stored[5] or Decimal('0.00'))
+
+    def _totals_changed(self, before:tuple|None, after:tuple|None, rebuild:bool = False):
+        """Apply the change to this row to the monthly totals - within the save or delete, so they can't disagree.
+           Just the difference is applied - unless rebuild, when the months it was in and is now in are rebuilt."""
+        if rebuild:
+            for account_id, day in {entry[:2] for entry in (before, after) if entry}:
+                Account.objects.ledger_changed(account_id, day, day)
+            return
+
+        if before != after:
+            parent_categories = dict(Transaction.objects.filter(id__in={entry[3] for entry in (before, after) if entry and entry[3]}).
+                                                         values_list('id', 'category'))
+            for entry, sign in ((before, -1), (after, 1)):
+                if entry is None:
+                    continue
+                account_id, day, category, parent_id, credit, debit = entry
+                CategoryMonthlyTotal.objects.add(account_id, day, category, parent_categories.get(parent_id, ''),
+                                                 sign * credit, sign * debit, sign)
+        for account_id in {entry[0] for entry in (before, after) if entry}:
+            Account.objects.bump_ledger_version(account_id)
+
+    def _refresh_parent(self):
+        """Update the parent's split totals after a split is saved or deleted"""
+        if self.parent_id is None:
+            return
+        Transaction.objects.refresh_split_totals(Q(id=self.parent_id))
+        if Transaction.parent.is_cached(self):
+            self.parent.refresh_from_db(fields=self.SPLIT_TOTALS)
 
     def _get_balance_before(self):
         """The account balance before this transaction"""
@@ -238,4 +484,297 @@ class Transaction(models.Model):
         if self.parent is not None:
             return self.parent.balance
 
-        return self.balance - self.credit + self.debit
\ No newline at end of file
+        return self.balance - self.credit + self.debit
+
+
+def month_start(day:datetime.date) -> datetime.date:
+    return day.replace(day=1)
+
+def next_month(day:datetime.date) -> datetime.date:
+    """The first day of the month after day"""
+    return (day.replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+
+class CategoryMonthlyTotalManager(models.Manager):
+    @staticmethod
+    def _grouped(transactions, *fields, **expressions):
+        """The credit, debit and count of the transactions for each category"""
+        return (transactions.order_by().
+                    values('category', *fields, parent_category=Coalesce(F('parent__category'), Value('')), **expressions).
+                    annotate(credit_sum=Sum('credit', default=Decimal('0.00')),
+                             debit_sum=Sum('debit', default=Decimal('0.00')),
+                             tx_count=Count('id')))
+
+    def add(self, account_id, day:datetime.date, category:str, parent_category:str,
+            credit:Decimal, debit:Decimal, count:int):
+        """Add the change to one transaction to the total for its month - rather than rebuilding the month"""
+        key = dict(account_id=account_id, month=month_start(day), category=category, parent_category=parent_category)
+        change = dict(credit=F('credit') + credit, debit=F('debit') + debit, count=F('count') + count)
+        with db_transaction.atomic():
+            if not self.filter(**key).update(**change):
+                try:
+                    with db_transaction.atomic():
+                        self.create(**key, credit=credit, debit=debit, count=count)
+                except IntegrityError:
+                    # Created by a concurrent change since the update
+                    self.filter(**key).update(**change)
+            if count < 0:
+                self.filter(**key, count__lte=0).delete()
+
+    def refresh(self, account, start:datetime.date, end:datetime.date):
+        """Rebuild the totals for each month from start to end from the transactions themselves"""
+        first, after = month_start(start), next_month(end)
+        with db_transaction.atomic():
+            self.filter(account=account, month__gte=first, month__lt=after).delete()
+            totals = self._grouped(Transaction.objects.filter(account=account, transaction_date__gte=first, transaction_date__lt=after),
+                                   month=TruncMonth('transaction_date'))
+            self.bulk_create([CategoryMonthlyTotal(account_id=getattr(account, 'id', account), month=row['month'],
+                                                   category=row['category'], parent_category=row['parent_category'],
+                                                   credit=row['credit_sum'], debit=row['debit_sum'], count=row['tx_count'])
+                              for row in totals])
+
+    @staticmethod
+    def _period_parts(start:datetime.date, end:datetime.date) -> tuple[Q|None, Q]:
+        """Split a period into the whole months (a filter on the totals) and the part months (a filter on the transactions)"""
+        start = start.date() if isinstance(start, datetime.datetime) else start
+        end = end.date() if isinstance(end, datetime.datetime) else end
+        first_whole = start if start.day == 1 else next_month(start)
+        after_whole = next_month(end) if (end + datetime.timedelta(days=1)).day == 1 else month_start(end)
+
+        if first_whole >= after_whole:
+            return None, Q(transaction_date__range=(start, end))
+
+        part_months = Q()
+        if start < first_whole:
+            part_months |= Q(transaction_date__gte=start, transaction_date__lt=first_whole)
+        if after_whole <= end:
+            part_months |= Q(transaction_date__gte=after_whole, transaction_date__lte=end)
+        return Q(month__gte=first_whole, month__lt=after_whole), part_months
+
+    def totals(self, account, start:datetime.date, end:datetime.date) -> dict[tuple[str, str], dict]:
+        """The credit, debit and count for each (category, parent_category) between start and end (inclusive)
+
+           Whole months are read from the monthly totals, and only the part months at either end from the transactions.
+        """
+        whole_months, part_months = self._period_parts(start, end)
+
+        rolled_up = (self.filter(whole_months, account=account).
+                            order_by().values('category', 'parent_category').
+                            annotate(credit_sum=Sum('credit'), debit_sum=Sum('debit'), tx_count=Sum('count'))) if whole_months else []
+        raw = self._grouped(Transaction.objects.filter(part_months, account=account)) if part_months else []
+
+        totals = {}
+        for row in chain(rolled_up, raw):
+            entry = totals.setdefault((row['category'], row['parent_category']),
+                                      {'credit': Decimal('0.00'), 'debit': Decimal('0.00'), 'count': 0})
+            entry['credit'] += row['credit_sum']
+            entry['debit'] += row['debit_sum']
+            entry['count'] += row['tx_count']
+        return totals
+
+    def income_expenditure(self, account, start:datetime.date, end:datetime.date) -> dict[str, tuple[Decimal, Decimal]]:
+        """The income and expenditure of the statement rows (not the splits) for each category between start and end
+
+           One query - the whole months from the monthly totals and the part months from the transactions,
+           each summed with conditional aggregation.
+        """
+        whole_months, part_months = self._period_parts(start, end)
+        zero = Decimal('0.00')
+
+        queries = []
+        if whole_months:
+            queries.append(self.filter(whole_months, account=account).order_by().values('category').
+                                annotate(income=Sum('credit', filter=Q(parent_category='', credit__gt=0), default=zero),
+                                         expenditure=Sum('debit', filter=Q(parent_category='', debit__gt=0), default=zero)))
+        if part_months:
+            queries.append(Transaction.objects.filter(part_months, account=account).order_by().values('category').
+                                annotate(income=Sum('credit', filter=Q(parent__isnull=True, credit__gt=0), default=zero),
+                                         expenditure=Sum('debit', filter=Q(parent__isnull=True, debit__gt=0), default=zero)))
+
+        summary = {}
+        for row in queries[0].union(*queries[1:], all=True):
+            income, expenditure = summary.get(row['category'], (zero, zero))
+            summary[row['category']] = (income + row['income'], expenditure + row['expenditure'])
+        return summary
+
+    def by_period(self, account, periods:dict[str, tuple[datetime.date, datetime.date]]) -> dict[str, dict[str, tuple[Decimal, Decimal]]]:
+        """The income and expenditure of the statement rows for each category in each period - {category: {period: (income, expenditure)}}
+
+           periods maps a label to the (start, end) of the period - they mustn't overlap. One query however many
+           periods there are - grouped by period and category, with the whole months from the monthly totals
+           and the part months from the transactions.
+        """
+        zero = Decimal('0.00')
+        whole_months, part_months = [], []
+        for label, (start, end) in periods.items():
+            whole, part = self._period_parts(start, end)
+            if whole:
+                whole_months.append(When(whole, then=Value(label)))
+            if part:
+                part_months.append(When(part, then=Value(label)))
+
+        queries = []
+        if whole_months:
+            queries.append(self.filter(account=account).annotate(period=Case(*whole_months, default=None)).
+                                filter(period__isnull=False).order_by().values('period', 'category').
+                                annotate(income=Sum('credit', filter=Q(parent_category='', credit__gt=0), default=zero),
+                                         expenditure=Sum('debit', filter=Q(parent_category='', debit__gt=0), default=zero)))
+        if part_months:
+            queries.append(Transaction.objects.filter(account=account).annotate(period=Case(*part_months, default=None)).
+                                filter(period__isnull=False).order_by().values('period', 'category').
+                                annotate(income=Sum('credit', filter=Q(parent__isnull=True, credit__gt=0), default=zero),
+                                         expenditure=Sum('debit', filter=Q(parent__isnull=True, debit__gt=0), default=zero)))
+        if not queries:
+            return {}
+
+        summary = {}
+        for row in queries[0].union(*queries[1:], all=True):
+            by_period = summary.setdefault(row['category'], {})
+            income, expenditure = by_period.get(row['period'], (zero, zero))
+            by_period[row['period']] = (income + row['income'], expenditure + row['expenditure'])
+        return summary
+
+class CategoryMonthlyTotal(models.Model):
+    """The transaction totals for each account, month and category - used by the financial reports
+
+       Splits are totalled under the category of the transaction they split (parent_category) -
+       statement rows have a blank parent_category.
+    """
+    objects = CategoryMonthlyTotalManager()
+    account = models.ForeignKey(Account, on_delete=models.CASCADE)
+    month = models.DateField()
+    category = models.CharField(max_length=100)
+    parent_category = models.CharField(max_length=100, blank=True, default='')
+    credit = models.DecimalField(max_digits=12, decimal_places=2, default=Decimal('0.00'))
+    debit = models.DecimalField(max_digits=12, decimal_places=2, default=Decimal('0.00'))
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = [['account', 'month', 'category', 'parent_category']]
+
+    def __str__(self):
+        return f'{self.month.strftime('%b %Y')} {self.category} {self.credit} {self.debit}'
+
+
+def save_import_file(instance, filename):
+    return f'accounts/imports/{instance.account.natural_key()[0]}/{filename}'
+
+class ImportJobManager(models.Manager):
+    def fail_stalled(self) -> int:
+        """Fail the running jobs which haven't recorded any progress for APPS_SETTINGS['Accounts']['import']['job_timeout']
+           seconds (default 600) - their worker has stopped, so they would otherwise be left running for ever"""
+        timeout = settings.APPS_SETTINGS.get('Accounts', {}).get('import', {}).get('job_timeout', 600)
+        now = timezone.now()
+        stalled_since = now - datetime.timedelta(seconds=timeout)
+        return (self.filter(status=ImportJob.Status.RUNNING).
+                    filter(Q(heartbeat_at__lt=stalled_since) | Q(heartbeat_at__isnull=True, started_at__lt=stalled_since)).
+                    update(status=ImportJob.Status.FAILED, finished_at=now,
+                           message='The import stopped before it finished - please upload the file again'))
+
+    def claim_next(self):
+        """Claim the oldest queued job - so that only one worker processes it.
+           Returns None if there are no queued jobs"""
+        self.fail_stalled()
+        with db_transaction.atomic():
+            job = (self.select_for_update(skip_locked=True).
+                        filter(status=ImportJob.Status.QUEUED).order_by('created_at').first())
+            if job:
+                job.status, job.started_at = ImportJob.Status.RUNNING, timezone.now()
+                job.heartbeat_at = job.started_at
+                job.save(update_fields=['status', 'started_at', 'heartbeat_at'])
+        return job
+
+class ImportJob(models.Model):
+    """A queued upload of a bank statement - processed by the ProcessImports management command"""
+    class Status(models.TextChoices):
+        QUEUED = 'Queued', 'Queued'
+        RUNNING = 'Running', 'Running'
+        COMPLETE = 'Complete', 'Complete'
+        FAILED = 'Failed', 'Failed'
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [models.Index(name='ImportJobByStatus', fields=['status', 'created_at'])]
+
+    objects = ImportJobManager()
+    account = models.ForeignKey(Account, on_delete=models.CASCADE)
+    uploaded_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    upload_file = models.FileField(upload_to=save_import_file, null=True, blank=True)
+    file_name = models.CharField(max_length=255)
+    status = models.CharField(max_length=10, choices=Status.choices, default=Status.QUEUED)
+    rows_processed = models.IntegerField(default=0)
+    error_count = models.IntegerField(default=0)
+    message = models.CharField(max_length=200, blank=True, default='')
+    upload_history = models.ForeignKey(UploadHistory, on_delete=models.SET_NULL, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f'{self.file_name} ({self.account}) - {self.status}'
+
+    def is_finished(self):
+        return self.status in (ImportJob.Status.COMPLETE, ImportJob.Status.FAILED)
+
+    def get_result_url(self):
+        """Where to go once the import is complete"""
+        if self.status != ImportJob.Status.COMPLETE:
+            return None
+        if self.error_count:
+            return reverse('Account:UploadErrorList', kwargs={'account_id':self.account_id, 'upload_id':self.upload_history_id})
+        return reverse('Account:TransactionList', kwargs={'account_id':self.account_id})
+
+    def progress(self) -> dict:
+        return {'status': self.status,
+                'rows_processed': self.rows_processed,
+                'error_count': self.error_count,
+                'message': self.message,
+                'redirect': self.get_result_url()}
+
+
+class CategoryRule(models.Model):
+    """Categorise an imported transaction from its name or description - the first active rule (by order) which matches wins
+
+       The rules are compiled together by Accounts.services.categorisation
+    """
+    class Field(models.TextChoices):
+        NAME = 'name', 'Name'
+        DESCRIPTION = 'description', 'Description'
+
+    class Sign(models.TextChoices):
+        ANY = 'any', 'Credit or Debit'
+        CREDIT = 'credit', 'Credit'
+        DEBIT = 'debit', 'Debit'
+
+    class Source(models.TextChoices):
+        MANUAL = 'manual', 'Manual'
+        LEARNED = 'learned', 'Learned from history'
+
+    class Meta:
+        ordering = ['order', 'id']
+
+    order = models.PositiveIntegerField(default=0, help_text='Rules are tried lowest first')
+    field = models.CharField(max_length=11, choices=Field.choices, default=Field.DESCRIPTION)
+    pattern = models.CharField(max_length=200, help_text='A regular expression - found anywhere in the field, ignoring case')
+    amount_sign = models.CharField(max_length=6, choices=Sign.choices, default=Sign.ANY)
+    category = models.ForeignKey(Categories, to_field='category_name', related_name='rules', on_delete=models.CASCADE)
+    active = models.BooleanField(default=True)
+    source = models.CharField(max_length=7, choices=Source.choices, default=Source.MANUAL, editable=False)
+    support = models.PositiveIntegerField(default=0, editable=False, help_text='The past transactions a learned rule is based on')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'{self.get_field_display()} ~ {self.pattern} ({self.get_amount_sign_display()}) -> {self.category_id}'
+
+    def regex(self) -> str:
+        """The rule as a lookahead over the '<name>\\n<description>' of a transaction"""
+        line = r'[^\n]*?' if self.field == CategoryRule.Field.NAME else r'[^\n]*\n[^\n]*?'
+        return f'(?={line}(?:{self.pattern}))'
+
+    def clean(self):
+        try:
+            compiled = re.compile(self.regex(), re.IGNORECASE | re.MULTILINE)
+        except re.error as e:
+            raise ValidationError({'pattern': f'Invalid pattern : {e}'})
+        if compiled.groupindex:
+            raise ValidationError({'pattern': 'Named groups cannot be used in a pattern'})
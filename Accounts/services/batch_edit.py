@@ -0,0 +1,150 @@
+"""
+    Accounts.services.batch_edit.py :
+
+Summary :
+    Apply a list of edits to an account's transactions in one go.
+
+    Each operation is a dict with an 'op' key :
+        {'op': 'recategorise', 'id': <transaction>, 'category': <category>}
+        {'op': 'rename', 'id': <transaction>, 'name': <name>}
+        {'op': 'add_split', 'parent': <transaction>, 'category': <category>, 'credit'|'debit': <amount>}
+        {'op': 'edit_split', 'id': <split>, 'category': <category>, 'credit'|'debit': <amount>}
+        {'op': 'delete_split', 'id': <split>}
+
+    All the transactions named are fetched (and locked) in one query, the operations are checked,
+    and then applied with bulk updates; the split totals, monthly totals and ledger version are
+    brought up to date once at the end. Either every operation is applied or - if any of them is
+    invalid - none are, and BatchEditError reports what was wrong with each one.
+
+    Fixing a transaction's name or category clears any upload errors recorded against it - as the
+    single edit_transaction endpoint does.
+"""
+import logging
+from decimal import Decimal, InvalidOperation
+
+from django.db import transaction as db_transaction
+from django.db.models import Q
+
+from Accounts.models import Account, Transaction, UploadError
+from Accounts.services.category_tree import category_tree
+
+logger = logging.getLogger(__name__)
+
+OPERATIONS = {'recategorise': ('id', 'category'),
+              'rename': ('id', 'name'),
+              'add_split': ('parent', 'category'),
+              'edit_split': ('id', 'category'),
+              'delete_split': ('id',)}
+
+AMOUNT_OPERATIONS = {'add_split', 'edit_split'}
+
+
+class BatchEditError(Exception):
+    """One or more operations were invalid - results holds the outcome of each operation"""
+    def __init__(self, results:list[dict]):
+        super().__init__(f'{sum(not result["success"] for result in results)} invalid operation(s)')
+        self.results = results
+
+
+def _amount(operation:dict) -> tuple[str, Decimal]:
+    """The amount type (credit or debit) and amount of a split"""
+    amount_type = 'debit' if 'debit' in operation else 'credit'
+    try:
+        amount = Decimal(str(operation[amount_type]))
+    except (KeyError, InvalidOperation):
+        raise ValueError('A credit or debit amount is required')
+    if amount <= 0:
+        raise ValueError(f'Invalid {amount_type} {amount}')
+    return amount_type, amount
+
+
+def _check(operation, rows:dict[int, Transaction], categories) -> str|None:
+    """The reason the operation can't be applied - or None if it can"""
+    if not isinstance(operation, dict) or operation.get('op') not in OPERATIONS:
+        return f'Unknown operation {operation!r}'
+    op = operation['op']
+    if missing := [key for key in OPERATIONS[op] if key not in operation]:
+        return f'{op} needs {", ".join(missing)}'
+
+    target_key = 'parent' if op == 'add_split' else 'id'
+    target = rows.get(operation[target_key]) if isinstance(operation[target_key], int) else None
+    if target is None:
+        return f'Transaction {operation[target_key]} not found'
+    if op in ('edit_split', 'delete_split') and target.parent_id is None:
+        return f'Transaction {target.id} is not a split'
+    if op == 'add_split' and target.parent_id is not None:
+        return f'Transaction {target.id} is a split - it cannot be split again'
+    if 'category' in OPERATIONS[op] and operation['category'] not in categories:
+        return f'Unknown category {operation["category"]}'
+    if op in AMOUNT_OPERATIONS:
+        try:
+            _amount(operation)
+        except ValueError as e:
+            return str(e)
+    return None
+
+
+def apply_batch(account, operations:list[dict]) -> list[dict]:
+    """Apply the operations to the account's transactions - returns the result of each operation
+
+       Raises BatchEditError (and applies nothing) if any operation is invalid.
+    """
+    account_id = getattr(account, 'id', account)
+    if not isinstance(operations, list):
+        raise BatchEditError([{'success': False, 'error': 'operations must be a list'}])
+
+    with db_transaction.atomic():
+        ids = {operation.get(key) for operation in operations if isinstance(operation, dict) for key in ('id', 'parent')}
+        rows = Transaction.objects.select_for_update().filter(account_id=account_id).in_bulk(
+                                    [tx_id for tx_id in ids if isinstance(tx_id, int)])
+        categories = category_tree()
+
+        results = [{'index': index, 'success': not (error := _check(operation, rows, categories))} | ({'error': error} if error else {})
+                        for index, operation in enumerate(operations)]
+        if not all(result['success'] for result in results):
+            raise BatchEditError(results)
+
+        changed, fixed, new_splits, deleted = {}, set(), [], set()
+        for operation, result in zip(operations, results):
+            match operation['op']:
+                case 'recategorise' | 'rename' | 'edit_split' as op:
+                    tx = rows[operation['id']]
+                    if op == 'rename':
+                        tx.name = operation['name'] or Transaction.name_from_description(tx.description)
+                    else:
+                        tx.category = operation['category']
+                    if op == 'edit_split':
+                        amount_type, amount = _amount(operation)
+                        setattr(tx, amount_type, amount)
+                    else:
+                        fixed.add(tx.id)
+                    changed[tx.id] = tx
+                case 'add_split':
+                    parent = rows[operation['parent']]
+                    amount_type, amount = _amount(operation)
+                    split = Transaction(account_id=account_id, parent=parent, transaction_date=parent.transaction_date,
+                                        financial_year_id=parent.financial_year_id, category=operation['category'],
+                                        **{amount_type: amount})
+                    new_splits.append((result, split))
+                case 'delete_split':
+                    deleted.add(operation['id'])
+                    changed.pop(operation['id'], None)
+
+        Transaction.objects.bulk_update([tx for tx_id, tx in changed.items() if tx_id not in deleted],
+                                        ['name', 'category', 'credit', 'debit'], batch_size=500)
+        Transaction.objects.bulk_create([split for _, split in new_splits], batch_size=500)
+        for result, split in new_splits:
+            result['id'] = split.id
+        Transaction.objects.filter(id__in=deleted).delete()
+        UploadError.objects.filter(transaction_id__in=fixed).delete()
+
+        touched = list(changed.values()) + [split for _, split in new_splits] + [rows[tx_id] for tx_id in deleted]
+        parents = {tx.parent_id for tx in touched if tx.parent_id is not None}
+        if parents:
+            Transaction.objects.refresh_split_totals(Q(id__in=parents))
+        if touched:
+            dates = [tx.transaction_date for tx in touched]
+            Account.objects.ledger_changed(account_id, min(dates), max(dates))
+
+    logger.info(f'Batch edit of account {account_id} : {len(operations)} operation(s) applied')
+    return results
@@ -0,0 +1,126 @@
+"""
+    Accounts.services.categorisation.py :
+
+Summary :
+    Categorise imported transactions from rules - and learn new rules from past transactions.
+
+    Each CategoryRule is a pattern on the name or description of a transaction, for credits, debits
+    or both. All the active rules are compiled into one regular expression for credits and one for
+    debits : an alternation of lookaheads anchored at the start of '<name>\\n<description>', tried in
+    rule order, each followed by an empty named group identifying the rule - so a single search finds
+    the first rule which matches, however many rules there are.
+
+    The importer applies the rules to each row which has no category. learn_rules() proposes rules
+    (inactive, until a treasurer activates them in the admin) for the names which have consistently
+    been given the same category.
+
+    Usage :
+        matcher = RuleMatcher.from_database()
+        matcher.categorise(transaction)         # Sets the category - True if a rule matched
+
+        proposed = learn_rules(min_count=3, min_share=0.9)
+"""
+import logging
+import re
+from collections import defaultdict
+
+from django.db.models import Count, Max, Q
+
+from Accounts.models import CategoryRule, Transaction
+from Accounts.services.category_tree import category_tree
+
+logger = logging.getLogger(__name__)
+
+
+class RuleMatcher:
+    """The active rules - compiled into one regular expression for each sign of amount"""
+    flags = re.IGNORECASE | re.MULTILINE
+
+    def __init__(self, rules):
+        alternatives = {CategoryRule.Sign.CREDIT: [], CategoryRule.Sign.DEBIT: []}
+        self.categories = {}
+        for rule in rules:
+            try:
+                compiled = re.compile(rule.regex(), self.flags)
+            except re.error as e:
+                logger.error(f'Category rule {rule.id} ignored - invalid pattern {rule.pattern} : {e}')
+                continue
+            if compiled.groupindex:
+                logger.error(f'Category rule {rule.id} ignored - named groups in {rule.pattern}')
+                continue
+
+            group = f'rule{rule.id}'
+            self.categories[group] = rule.category_id
+            for sign in alternatives:
+                if rule.amount_sign in (CategoryRule.Sign.ANY, sign):
+                    alternatives[sign].append(f'{rule.regex()}(?P<{group}>)')
+
+        self.patterns = {sign: re.compile(r'\A(?:' + '|'.join(regexes) + ')', self.flags) if regexes else None
+                            for sign, regexes in alternatives.items()}
+
+    @classmethod
+    def from_database(cls) -> 'RuleMatcher':
+        return cls(CategoryRule.objects.filter(active=True).order_by('order', 'id'))
+
+    @staticmethod
+    def text(name:str|None, description:str|None) -> str:
+        return f'{(name or '').replace('\n', ' ')}\n{(description or '').replace('\n', ' ')}'
+
+    def match(self, name:str|None, description:str|None, is_debit:bool) -> str|None:
+        """The category of the first rule which matches - or None"""
+        pattern = self.patterns[CategoryRule.Sign.DEBIT if is_debit else CategoryRule.Sign.CREDIT]
+        if pattern is None:
+            return None
+        found = pattern.match(self.text(name, description))
+        return self.categories[found.lastgroup] if found else None
+
+    def categorise(self, transaction:Transaction) -> bool:
+        """Set the category of the transaction from the rules - True if a rule matched"""
+        category = self.match(transaction.name, transaction.description, bool(transaction.debit))
+        if category:
+            transaction.category = category
+        return category is not None
+
+
+def learn_rules(min_count:int = 3, min_share:float = 0.9, activate:bool = False) -> list[CategoryRule]:
+    """Propose a rule for each name whose past transactions were (nearly) always given the same category
+
+        min_count : the least number of transactions with the name and category
+        min_share : the least share of the transactions with the name which have that category
+        activate : make the new rules active straight away - otherwise they wait for a treasurer to activate them
+
+        Names which the existing rules (active or not) already categorise are skipped.
+    """
+    history = (Transaction.objects.filter(parent__isnull=True, uploaderror__isnull=True).
+                        exclude(Q(name__isnull=True) | Q(name='') | Q(category='')).
+                        order_by().values('name', 'category').
+                        annotate(count=Count('id'), debits=Count('id', filter=Q(debit__gt=0))))
+
+    by_name = defaultdict(list)
+    for row in history:
+        by_name[row['name']].append(row)
+
+    existing = RuleMatcher(CategoryRule.objects.all())
+    tree = category_tree()
+    order = (CategoryRule.objects.aggregate(Max('order'))['order__max'] or 0)
+
+    proposed = []
+    for name, rows in sorted(by_name.items()):
+        best = max(rows, key=lambda row: row['count'])
+        total = sum(row['count'] for row in rows)
+        if best['count'] < min_count or best['count'] / total < min_share or best['category'] not in tree:
+            continue
+
+        sign = (CategoryRule.Sign.DEBIT if best['debits'] == best['count'] else
+                CategoryRule.Sign.CREDIT if best['debits'] == 0 else CategoryRule.Sign.ANY)
+        if existing.match(name, '', sign == CategoryRule.Sign.DEBIT):
+            continue
+
+        order += 10
+        proposed.append(CategoryRule(order=order, field=CategoryRule.Field.NAME, pattern=f'^{re.escape(name)}$',
+                                     amount_sign=sign, category_id=best['category'], active=activate,
+                                     source=CategoryRule.Source.LEARNED, support=best['count']))
+
+    CategoryRule.objects.bulk_create(proposed)
+    logger.info(f'{len(proposed)} category rule(s) learned from past transactions')
+    return proposed
@@ -0,0 +1,91 @@
+"""
+    Accounts.services.category_tree.py :
+
+Summary :
+    The categories - held in memory.
+
+    The categories are read on every uploaded row, every category drop-down and every page of the
+    transaction list, but only change a few times a year. So the whole tree is loaded with one query
+    and kept in the process; it is reloaded when :
+
+        * a category is saved or deleted - the post_save/post_delete receivers in Accounts.models bump
+          its version (a CacheVersion row in the database, seen by every process), and each process
+          reloads when it sees a new version - one small query rather than the whole tree
+
+    Usage :
+        tree = category_tree()
+        tree.get('Sale').credit_debit           # 'C'
+        tree.children('Sale')                   # ['Stall', ...]
+        tree.top_level('D')                     # The debit categories which aren't sub-categories
+        'Sale' in tree.splittable               # True if Sale has sub-categories
+"""
+import threading
+from collections import namedtuple
+
+from Accounts.models import Categories, CATEGORY_TREE_VERSION_KEY, current_version
+
+
+class CategoryNode(namedtuple('CategoryNode', 'category_name credit_debit parent children')):
+    """A category - its parent's name (or None) and the names of its children"""
+    __slots__ = ()
+
+    @property
+    def splittable(self) -> bool:
+        return bool(self.children)
+
+    def __str__(self):
+        return self.category_name
+
+
+class CategoryTree:
+    def __init__(self, rows):
+        """rows are (category_name, credit_debit, parent name) for every category"""
+        children = {}
+        for name, _, parent in rows:
+            if parent is not None:
+                children.setdefault(parent, []).append(name)
+
+        self.nodes = {name: CategoryNode(name, credit_debit, parent, tuple(sorted(children.get(name, ()))))
+                            for name, credit_debit, parent in sorted(rows)}
+        self.splittable = frozenset(name for name, node in self.nodes.items() if node.children)
+
+    def __contains__(self, name):
+        return name in self.nodes
+
+    def __iter__(self):
+        return iter(self.nodes.values())
+
+    def get(self, name) -> CategoryNode|None:
+        return self.nodes.get(name)
+
+    def children(self, name) -> list[str]:
+        node = self.nodes.get(name)
+        return list(node.children) if node else []
+
+    def top_level(self, credit_debit:str|None = None) -> list[str]:
+        return [node.category_name for node in self.nodes.values()
+                    if node.parent is None and (credit_debit is None or node.credit_debit == credit_debit)]
+
+
+_tree: CategoryTree|None = None
+_tree_version = None
+_lock = threading.Lock()
+
+
+def category_tree() -> CategoryTree:
+    """The category tree - loaded from the database only when it has changed"""
+    global _tree, _tree_version
+    version = current_version(CATEGORY_TREE_VERSION_KEY)
+    if _tree is not None and version == _tree_version:
+        return _tree
+
+    with _lock:
+        _tree = CategoryTree(Categories.objects.values_list('category_name', 'credit_debit', 'parent__category_name'))
+        _tree_version = version
+        return _tree
+
+
+def invalidate():
+    """Discard this process's copy of the tree - the next use reloads it"""
+    global _tree
+    _tree = None
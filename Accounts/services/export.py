@@ -0,0 +1,220 @@
+"""
+    Accounts.services.export.py :
+
+Summary :
+    Streaming exports of transactions and report tables - as CSV or XLSX.
+
+    An export is a list of tables - each a (title, columns, rows) tuple, where rows is an iterable
+    (usually a generator over a queryset iterator) so the rows are read from the database a chunk at
+    a time, and written to the response as they are read; however long the ledger the export never
+    holds more than a chunk in memory.
+
+    CSV exports with more than one table put each table under its title, separated by a blank row.
+    XLSX exports put each table on its own worksheet; the workbook is written with the standard
+    library zipfile module - which can stream to an unseekable file - so there is no extra dependency.
+
+    Usage :
+        return streaming_response('ledger-2025', 'xlsx', [transaction_table(account)])
+
+    Settings - APPS_SETTINGS['Accounts']['export'] :
+        chunk_size : The number of rows to read from the database at a time (default 2000)
+"""
+import codecs
+import csv
+import datetime
+import zipfile
+from decimal import Decimal
+from typing import Iterable, Iterator
+from xml.sax.saxutils import escape
+
+from django.conf import settings
+from django.http import StreamingHttpResponse
+
+from Accounts.models import CategoryMonthlyTotal, Transaction
+
+Table = tuple[str, list[str], Iterable[tuple]]
+
+
+def export_settings() -> dict:
+    return settings.APPS_SETTINGS.get('Accounts', {}).get('export', {})
+
+
+def chunk_size() -> int:
+    return export_settings().get('chunk_size', 2000)
+
+
+# ---- The tables
+
+def transaction_table(account, start:datetime.date|None = None, end:datetime.date|None = None, financial_year:int|None = None) -> Table:
+    """Every transaction on the account (between start and end, or in the financial year) - each statement row followed by its splits"""
+    transactions = Transaction.details.combined().filter(account=account)
+    if financial_year:
+        transactions = transactions.filter(financial_year=financial_year)
+    elif start and end:
+        transactions = transactions.filter(transaction_date__range=(start, end))
+
+    rows = transactions.values_list('tx_number', 'transaction_date', 'description', 'name', 'category',
+                                    'parent__tx_number', 'debit', 'credit', 'balance')
+    return ('Transactions',
+            ['Number', 'Date', 'Description', 'Name', 'Category', 'Split of', 'Debit', 'Credit', 'Balance'],
+            rows.iterator(chunk_size=chunk_size()))
+
+
+def category_table(account, start:datetime.date, end:datetime.date) -> Table:
+    """The credit, debit and number of transactions in each category between start and end"""
+    totals = CategoryMonthlyTotal.objects.totals(account, start, end)
+    return ('Category Summary',
+            ['Category', 'Sub-category of', 'Credit', 'Debit', 'Transactions'],
+            ((category, parent_category, entry['credit'], entry['debit'], entry['count'])
+                    for (category, parent_category), entry in sorted(totals.items())))
+
+
+# ---- The formats
+
+class _Echo:
+    """A file which hands back what is written - so csv.writer can format a row without buffering it"""
+    def write(self, value):
+        return value
+
+
+def csv_stream(tables:list[Table]) -> Iterator[bytes]:
+    writer = csv.writer(_Echo())
+    yield codecs.BOM_UTF8                               # So spreadsheets read the file as utf-8
+    for index, (title, columns, rows) in enumerate(tables):
+        if len(tables) > 1:
+            yield (writer.writerow([]) if index else '').encode('utf-8') + writer.writerow([title]).encode('utf-8')
+        yield writer.writerow(columns).encode('utf-8')
+        for row in rows:
+            yield writer.writerow(row).encode('utf-8')
+
+
+class _ChunkBuffer:
+    """An unseekable file which hands back what has been written to it since it was last emptied"""
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+_EXCEL_EPOCH = datetime.date(1899, 12, 30)
+
+_CONTENT_TYPES = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                  '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+                  '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+                  '<Default Extension="xml" ContentType="application/xml"/>'
+                  '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+                  '<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+                  '{sheets}</Types>')
+_SHEET_CONTENT_TYPE = ('<Override PartName="/xl/worksheets/sheet{index}.xml" '
+                       'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>')
+_ROOT_RELS = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+              '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+              '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+              '</Relationships>')
+_WORKBOOK = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+             '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+             'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships"><sheets>{sheets}</sheets></workbook>')
+_WORKBOOK_SHEET = '<sheet name="{name}" sheetId="{index}" r:id="rId{index}"/>'
+_WORKBOOK_RELS = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                  '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">{sheets}'
+                  '<Relationship Id="rIdStyles" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>'
+                  '</Relationships>')
+_WORKBOOK_SHEET_REL = ('<Relationship Id="rId{index}" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+                       'Target="worksheets/sheet{index}.xml"/>')
+# Style 1 is a date, style 2 is a bold heading
+_STYLES = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+           '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+           '<fonts count="2"><font><sz val="11"/><name val="Calibri"/></font><font><b/><sz val="11"/><name val="Calibri"/></font></fonts>'
+           '<fills count="2"><fill><patternFill patternType="none"/></fill><fill><patternFill patternType="gray125"/></fill></fills>'
+           '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+           '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+           '<cellXfs count="3"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+           '<xf numFmtId="14" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+           '<xf numFmtId="0" fontId="1" fillId="0" borderId="0" xfId="0" applyFont="1"/></cellXfs>'
+           '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+           '</styleSheet>')
+_SHEET_START = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>')
+_SHEET_END = '</sheetData></worksheet>'
+
+
+def _xlsx_cell(value, style:int = 0) -> str:
+    match value:
+        case None:
+            return '<c/>'
+        case bool():
+            return f'<c t="b"><v>{int(value)}</v></c>'
+        case int() | float() | Decimal():
+            return f'<c><v>{value}</v></c>'
+        case datetime.datetime():
+            return f'<c s="1"><v>{(value.date() - _EXCEL_EPOCH).days}</v></c>'
+        case datetime.date():
+            return f'<c s="1"><v>{(value - _EXCEL_EPOCH).days}</v></c>'
+        case _:
+            style = f' s="{style}"' if style else ''
+            return f'<c t="inlineStr"{style}><is><t xml:space="preserve">{escape(str(value))}</t></is></c>'
+
+
+def _xlsx_row(row, style:int = 0) -> str:
+    return '<row>' + ''.join(_xlsx_cell(value, style) for value in row) + '</row>'
+
+
+def _sheet_name(title:str, used:list[str]) -> str:
+    """Worksheet names are unique, at most 31 characters and can't contain []:*?/\\"""
+    name = ''.join('_' if char in '[]:*?/\\' else char for char in title)[:31] or 'Sheet'
+    base, suffix = name, 1
+    while name in used:
+        suffix += 1
+        name = f'{base[:31 - len(str(suffix)) - 1]} {suffix}'
+    return name
+
+
+def xlsx_stream(tables:list[Table], batch_size:int = 500) -> Iterator[bytes]:
+    buffer = _ChunkBuffer()
+    names = []
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as workbook:
+        for index, (title, columns, rows) in enumerate(tables, start=1):
+            names.append(_sheet_name(title, names))
+            with workbook.open(f'xl/worksheets/sheet{index}.xml', 'w', force_zip64=True) as sheet:
+                sheet.write((_SHEET_START + _xlsx_row(columns, style=2)).encode('utf-8'))
+                batch = []
+                for row in rows:
+                    batch.append(_xlsx_row(row))
+                    if len(batch) >= batch_size:
+                        sheet.write(''.join(batch).encode('utf-8'))
+                        batch.clear()
+                        yield buffer.take()
+                sheet.write((''.join(batch) + _SHEET_END).encode('utf-8'))
+            yield buffer.take()
+
+        indexes = range(1, len(names) + 1)
+        workbook.writestr('[Content_Types].xml', _CONTENT_TYPES.format(sheets=''.join(_SHEET_CONTENT_TYPE.format(index=index) for index in indexes)))
+        workbook.writestr('_rels/.rels', _ROOT_RELS)
+        workbook.writestr('xl/workbook.xml', _WORKBOOK.format(sheets=''.join(_WORKBOOK_SHEET.format(name=escape(name, {'"': '&quot;'}), index=index)
+                                                                              for index, name in zip(indexes, names))))
+        workbook.writestr('xl/_rels/workbook.xml.rels', _WORKBOOK_RELS.format(sheets=''.join(_WORKBOOK_SHEET_REL.format(index=index) for index in indexes)))
+        workbook.writestr('xl/styles.xml', _STYLES)
+    yield buffer.take()
+
+
+EXPORT_FORMATS = {
+    'csv': ('text/csv', csv_stream),
+    'xlsx': ('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', xlsx_stream),
+}
+
+
+def streaming_response(file_stem:str, export_format:str, tables:list[Table]) -> StreamingHttpResponse:
+    """A response which writes the tables as they are read - export_format is one of EXPORT_FORMATS"""
+    content_type, stream = EXPORT_FORMATS[export_format]
+    return StreamingHttpResponse(stream(tables), content_type=content_type,
+                                 headers={'Content-Disposition': f'attachment; filename="{file_stem}.{export_format}"'})
@@ -0,0 +1,130 @@
+"""
+    Accounts.services.financial_years.py :
+
+Summary :
+    The financial years - held in memory as a sorted list of intervals.
+
+    Reports, the transaction list and the importer all need to know which financial year a date
+    falls in. The years are loaded with one query, sorted by start date, and each date is found
+    with a binary search - rather than a query for every lookup. Like the category tree, the index
+    is reloaded when :
+
+        * a financial year is saved or deleted - the post_save/post_delete receivers in
+          Accounts.models bump its version (a CacheVersion row in the database, seen by every
+          process), and each process reloads when it sees a new version - one small query rather
+          than the whole index
+
+    The financial year recorded on each transaction is not taken from the index, but from the
+    database - see Transaction.save and TransactionManager.assign_financial_years (used by the importer).
+
+    Usage :
+        years = financial_years()
+        years.for_date(date(2025, 3, 1))            # The YearInterval containing the date - or None
+        years.get('2024-2025')                      # The YearInterval with that name - or None
+        years.overlapping(start, end)               # The years which overlap the period - earliest first
+"""
+import datetime
+import threading
+from bisect import bisect_right
+from collections import namedtuple
+
+from Accounts.models import FinancialYear, FINANCIAL_YEAR_VERSION_KEY, current_version
+
+YearInterval = namedtuple('YearInterval', 'id year year_start year_end active')
+
+
+def _as_date(day:datetime.date|datetime.datetime) -> datetime.date:
+    return day.date() if isinstance(day, datetime.datetime) else day
+
+
+class FinancialYearIndex:
+    def __init__(self, rows):
+        """rows are (id, year, year_start, year_end, active) for every financial year"""
+        self.intervals = sorted((YearInterval(*row) for row in rows), key=lambda interval: interval.year_start)
+        self._starts = [interval.year_start for interval in self.intervals]
+        self._by_name = {interval.year: interval for interval in self.intervals}
+
+    def __iter__(self):
+        return iter(self.intervals)
+
+    def __len__(self):
+        return len(self.intervals)
+
+    def get(self, year:str) -> YearInterval|None:
+        return self._by_name.get(year)
+
+    def for_date(self, day:datetime.date) -> YearInterval|None:
+        """The financial year containing the date - or None"""
+        day = _as_date(day)
+        index = bisect_right(self._starts, day) - 1
+        if index >= 0 and day <= self.intervals[index].year_end:
+            return self.intervals[index]
+        return None
+
+    def id_for(self, day:datetime.date) -> int|None:
+        interval = self.for_date(day)
+        return interval.id if interval else None
+
+    def containing(self, start:datetime.date, end:datetime.date) -> YearInterval|None:
+        """The financial year which contains the whole period - or None"""
+        interval = self.for_date(start)
+        return interval if interval and _as_date(end) <= interval.year_end else None
+
+    def overlapping(self, start:datetime.date, end:datetime.date) -> list[YearInterval]:
+        """The financial years which overlap the period - earliest first"""
+        start, end = _as_date(start), _as_date(end)
+        index = max(bisect_right(self._starts, start) - 1, 0)
+        overlaps = []
+        for interval in self.intervals[index:]:
+            if interval.year_start > end:
+                break
+            if interval.year_end >= start:
+                overlaps.append(interval)
+        return overlaps
+
+    def previous(self, interval:YearInterval) -> YearInterval|None:
+        """The financial year before this one - or None"""
+        index = self.intervals.index(interval)
+        return self.intervals[index - 1] if index > 0 else None
+
+    def up_to(self, interval:YearInterval, count:int) -> list[YearInterval]:
+        """The count financial years ending with this one - earliest first"""
+        index = self.intervals.index(interval)
+        return self.intervals[max(index - count + 1, 0):index + 1]
+
+    def newest_first(self) -> list[YearInterval]:
+        return self.intervals[::-1]
+
+    def earliest(self) -> YearInterval:
+        if not self.intervals:
+            raise FinancialYear.DoesNotExist('No financial years defined')
+        return self.intervals[0]
+
+    def latest(self) -> YearInterval:
+        if not self.intervals:
+            raise FinancialYear.DoesNotExist('No financial years defined')
+        return self.intervals[-1]
+
+
+_index: FinancialYearIndex|None = None
+_index_version = None
+_lock = threading.Lock()
+
+
+def financial_years() -> FinancialYearIndex:
+    """The financial year index - loaded from the database only when it has changed"""
+    global _index, _index_version
+    version = current_version(FINANCIAL_YEAR_VERSION_KEY)
+    if _index is not None and version == _index_version:
+        return _index
+
+    with _lock:
+        _index = FinancialYearIndex(FinancialYear.objects.values_list('id', 'year', 'year_start', 'year_end', 'active'))
+        _index_version = version
+        return _index
+
+
+def invalidate():
+    """Discard this process's copy of the index - the next use reloads it"""
+    global _index
+    _index = None
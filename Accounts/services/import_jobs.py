@@ -0,0 +1,73 @@
+"""
+    Accounts.services.import_jobs.py :
+
+Summary :
+    Background processing of queued bank statement uploads.
+
+    Large uploads are saved as an ImportJob and processed by the ProcessImports management
+    command, so that the web worker returns immediately. The import itself runs in its own
+    thread (and so its own database connection and transaction) while the calling thread
+    records progress against the job - so the progress is visible to the upload page while
+    the import is still uncommitted.
+
+    Each progress update is also a heartbeat - a job which hasn't recorded progress for
+    APPS_SETTINGS['Accounts']['import']['job_timeout'] seconds (default 600) has lost its worker,
+    and is failed the next time a worker looks for a job (an import is one database transaction,
+    so nothing from it was written).
+"""
+import logging
+import threading
+
+from django.db import connection
+from django.utils import timezone
+
+from Accounts.models import ImportJob
+from Accounts.services.importer import TransactionImporter, UploadRejected
+
+logger = logging.getLogger(__name__)
+
+
+def queue_import(account, uploaded_by, file) -> ImportJob:
+    """Save the uploaded file and queue it for the import worker"""
+    return ImportJob.objects.create(account=account, uploaded_by=uploaded_by,
+                                    upload_file=file, file_name=file.name)
+
+
+def run_job(job:ImportJob, poll_interval:float = 1.0) -> ImportJob:
+    """Import the file for a claimed job, recording progress as each batch is written"""
+    importer = TransactionImporter(job.account, job.uploaded_by)
+    outcome = {}
+
+    def _import():
+        try:
+            with job.upload_file.open('rb') as upload:
+                outcome['history'] = importer.import_file(upload, file_name=job.file_name)
+        except UploadRejected as e:
+            outcome['message'] = str(e)
+        except Exception as e:
+            logger.exception(f'Import job {job.id} failed')
+            outcome['message'] = f'Import failed : {e}'
+        finally:
+            connection.close()
+
+    worker = threading.Thread(target=_import, name=f'ImportJob-{job.id}', daemon=True)
+    worker.start()
+    while worker.is_alive():
+        worker.join(poll_interval)
+        ImportJob.objects.filter(pk=job.pk).update(rows_processed=importer.row_count,
+                                                   error_count=importer.error_count,
+                                                   heartbeat_at=timezone.now())
+
+    # A failed import is rolled back - so nothing was written
+    job.upload_history = outcome.get('history')
+    job.rows_processed, job.error_count = (importer.row_count, importer.error_count) if job.upload_history else (0, 0)
+    job.status = ImportJob.Status.COMPLETE if job.upload_history else ImportJob.Status.FAILED
+    job.message = outcome.get('message', '')[:200]
+    job.finished_at = timezone.now()
+    job.save()
+
+    # The upload is no longer needed once it is in the database
+    job.upload_file.delete(save=True)
+
+    logger.info(f'Import job {job.id} {job.status} - {job.rows_processed} rows, {job.error_count} error(s)')
+    return job
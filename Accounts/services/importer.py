@@ -0,0 +1,260 @@
+"""
+    Accounts.services.importer.py :
+
+Summary :
+    Bulk import of bank statement uploads.
+
+    The uploaded file is streamed through a generator pipeline :
+        read (chunked, incremental decode) -> parse -> validate -> batch write
+    The file can be in any of the statement formats (CSV, OFX, QIF or camt.053 - see
+    Accounts.services.statement_formats); each is parsed into the same rows, and validated
+    and written the same way.
+    Rows are validated against a single category map, and transactions and upload errors
+    are written with `bulk_create` a batch at a time - so memory stays flat for large
+    statements, and an upload costs a handful of queries per batch.
+
+    Rows which have already been uploaded are recognised by their fingerprint (one indexed
+    lookup per batch) and skipped - so overlapping statements (e.g. rolling 90 day exports)
+    can be uploaded without being trimmed first.
+
+    A file can also be previewed - parsed, categorised and validated exactly as it would be imported,
+    and checked for rows already uploaded, but without writing anything - so a bad file is rejected
+    at the cost of one parse and a fingerprint lookup per batch.
+
+    The batch size defaults to APPS_SETTINGS['Accounts']['import']['batch_size']
+"""
+import logging
+from collections import Counter, namedtuple
+from itertools import batched, chain
+from typing import Iterable, Iterator
+
+from django.conf import settings
+from django.db import transaction as db_transaction
+
+from Accounts.models import Account, Transaction, UploadError, UploadHistory
+from Accounts.services.category_tree import category_tree
+from Accounts.services.categorisation import RuleMatcher
+from Accounts.services.numbering import number_transactions
+from Accounts.services.statement_formats import StatementRow, UploadRejected, statement_format
+
+logger = logging.getLogger(__name__)
+
+
+def import_settings() -> dict:
+    return settings.APPS_SETTINGS.get('Accounts', {}).get('import', {})
+
+
+PreviewError = namedtuple('PreviewError', 'row transaction_date description debit credit category error')
+
+
+class TransactionImporter:
+    """Import a bank statement into a single account
+
+        Usage :
+            importer = TransactionImporter(account, request.user)
+            history = importer.import_file(uploaded_file)
+            if importer.error_count:
+                ...
+    """
+    batch_size = 500
+
+    def __init__(self, account, uploaded_by, batch_size:int|None = None):
+        self.account = account
+        self.uploaded_by = uploaded_by
+        self.batch_size = batch_size if batch_size else import_settings().get('batch_size', self.batch_size)
+        self.error_count = 0
+        self.row_count = 0
+        self.skipped_count = 0
+        self.categorised_count = 0
+
+        # Each row is validated against the category tree - held in memory
+        self.categories = category_tree()
+
+        # Rows without a category are categorised by the rules - compiled once for the whole file
+        self.rules = RuleMatcher.from_database()
+
+    @staticmethod
+    def make_transaction(row:StatementRow) -> Transaction:
+        """Build an (unsaved) transaction from a row of the uploaded statement - whatever its format"""
+        description = row.description.strip()[:Transaction._meta.get_field('description').max_length]
+        return Transaction(transaction_date=row.transaction_date,
+                           description=description,
+                           name=Transaction.name_from_description(description),
+                           debit=row.debit, credit=row.credit,
+                           balance=row.balance,
+                           category=row.category)
+
+    def validate(self, transaction:Transaction) -> str|None:
+        """Check the category of the transaction - return the error message (if any)"""
+        category = self.categories.get(transaction.category)
+        if category is None:
+            return f'Unknown category {transaction.category}'
+        credit_debit = category.credit_debit
+        if credit_debit == 'C' and transaction.debit:
+            return 'Invalid category for credit'
+        if credit_debit == 'D' and transaction.credit:
+            return 'Invalid category for debit'
+        return None
+
+    def read_file(self, file, file_name:str|None = None) -> Iterator[Transaction]:
+        """Parse the uploaded file a row at a time - in whichever statement format it is"""
+        file_name = file_name if file_name else file.name
+        statement = statement_format(file, file_name)
+        logger.debug(f'Reading {file_name} as {statement.name}')
+        for row in statement.parse(file, file_name):
+            yield self.make_transaction(row)
+
+    def import_file(self, file, file_name:str|None = None) -> UploadHistory:
+        """Parse, validate and write the uploaded file"""
+        file_name = file_name if file_name else file.name
+
+        # Read the header now so that missing columns are reported before anything is written
+        transactions = self.read_file(file, file_name)
+        try:
+            first = next(transactions)
+        except StopIteration:
+            raise UploadRejected(f'No new transactions found in {file_name}')
+
+        return self.import_transactions(chain([first], transactions))
+
+    def classify(self, transactions:Iterable[Transaction]) -> Iterator[tuple[Transaction, str|None]]:
+        """Pair each transaction with its validation error (if any) - categorising it first if it has no category"""
+        for tx in transactions:
+            if not tx.category and self.rules.categorise(tx):
+                self.categorised_count += 1
+            yield tx, self.validate(tx)
+
+    @staticmethod
+    def fingerprint(tx:Transaction, occurrences:Counter) -> str:
+        """The fingerprint of a statement row. A row without a running balance (QIF for instance) isn't unique -
+           two equal payments on the same day are identical rows - so the rows are counted, and the nth identical
+           row in the file has its own fingerprint"""
+        if tx.balance is not None:
+            return tx.get_fingerprint()
+        key = (tx.transaction_date, tx.description.strip(), (tx.credit or 0) - (tx.debit or 0))
+        occurrence = occurrences[key]
+        occurrences[key] += 1
+        return tx.get_fingerprint(occurrence)
+
+    def already_uploaded(self, fingerprints:list[str]) -> set[str]:
+        """The fingerprints of the rows already in the account - one indexed lookup for the whole batch"""
+        return set(Transaction.objects.filter(account=self.account, fingerprint__in=fingerprints).
+                                       values_list('fingerprint', flat=True))
+
+    def preview_file(self, file, file_name:str|None = None) -> dict:
+        """What importing the file would do - without writing anything
+
+            rows : The number of rows in the file
+            new, duplicates : The rows which would be imported, and those already uploaded (or repeated in the file)
+            categorised : The rows which the category rules would categorise
+            first_date, last_date : The dates of the new rows
+            error_count, errors : The new rows which would be upload errors - errors lists the first of them
+        """
+        file_name = file_name if file_name else file.name
+        max_errors = import_settings().get('preview_max_errors', 100)
+        self.error_count, self.row_count, self.skipped_count, self.categorised_count = 0, 0, 0, 0
+        first_date, last_date = None, None
+        errors, seen, occurrences = [], set(), Counter()
+
+        # The header is row 1 of the file
+        for batch in batched(enumerate(self.classify(self.read_file(file, file_name)), start=2), self.batch_size):
+            for _, (tx, _) in batch:
+                tx.account = self.account
+                tx.fingerprint = self.fingerprint(tx, occurrences)
+            seen.update(self.already_uploaded([tx.fingerprint for _, (tx, _) in batch]))
+
+            for row, (tx, error) in batch:
+                if tx.fingerprint in seen:
+                    self.skipped_count += 1
+                    continue
+                seen.add(tx.fingerprint)
+                self.row_count += 1
+                first_date = min(first_date or tx.transaction_date, tx.transaction_date)
+                last_date = max(last_date or tx.transaction_date, tx.transaction_date)
+                if error:
+                    self.error_count += 1
+                    if len(errors) < max_errors:
+                        errors.append(PreviewError(row, tx.transaction_date, tx.description, tx.debit, tx.credit, tx.category, error))
+
+        if not self.row_count and not self.skipped_count:
+            raise UploadRejected(f'No new transactions found in {file_name}')
+
+        logger.info(f'Previewed {file_name} for {self.account} - {self.row_count} new, {self.skipped_count} already uploaded, '
+                    f'{self.error_count} error(s)')
+        return {'file_name': file_name, 'rows': self.row_count + self.skipped_count,
+                'new': self.row_count, 'duplicates': self.skipped_count, 'categorised': self.categorised_count,
+                'first_date': first_date, 'last_date': last_date,
+                'error_count': self.error_count, 'errors': errors}
+
+    def import_transactions(self, transactions:Iterable[Transaction]) -> UploadHistory:
+        """Validate and bulk write the parsed transactions - a batch at a time
+
+            Transactions which are already in the account are skipped
+        """
+        history_inst = None
+        first_date, last_date = None, None
+        file_first, file_last = None, None
+        self.error_count, self.row_count, self.skipped_count, self.categorised_count = 0, 0, 0, 0
+        seen, occurrences = set(), Counter()
+
+        with db_transaction.atomic():
+            for batch in batched(self.classify(transactions), self.batch_size):
+                batch_dates = [tx.transaction_date for tx, _ in batch]
+                file_first = min(file_first or batch_dates[0], *batch_dates)
+                file_last = max(file_last or batch_dates[0], *batch_dates)
+
+                for tx, _ in batch:
+                    tx.account = self.account
+                    tx.fingerprint = self.fingerprint(tx, occurrences)
+
+                seen.update(self.already_uploaded([tx.fingerprint for tx, _ in batch]))
+                new_rows = []
+                for tx, error in batch:
+                    if tx.fingerprint not in seen:
+                        seen.add(tx.fingerprint)
+                        new_rows.append((tx, error))
+                self.skipped_count += len(batch) - len(new_rows)
+                if not new_rows:
+                    continue
+
+                new_dates = [tx.transaction_date for tx, _ in new_rows]
+                first_date = min(first_date or new_dates[0], *new_dates)
+                last_date = max(last_date or new_dates[0], *new_dates)
+
+                if history_inst is None:
+                    # The dates are completed once the whole file has been read
+                    history_inst = UploadHistory.objects.create(account=self.account,
+                                                                start_date=first_date,
+                                                                end_date=last_date,
+                                                                uploaded_by=self.uploaded_by)
+
+                # Each row is numbered by its date - into the gap in front of the later transactions, or appended
+                for tx, _ in new_rows:
+                    tx.upload_history = history_inst
+                number_transactions(self.account, [tx for tx, _ in new_rows])
+
+                Transaction.objects.bulk_create([tx for tx, _ in new_rows])
+                errors = [UploadError(transaction=tx, upload_history=history_inst, error_message=error)
+                                                                        for tx, error in new_rows if error]
+                UploadError.objects.bulk_create(errors)
+
+                self.row_count += len(new_rows)
+                self.error_count += len(errors)
+                logger.debug(f'Imported batch of {len(new_rows)} transactions into {self.account} - {len(batch) - len(new_rows)} already uploaded')
+
+            if history_inst is None:
+                if file_first is None:
+                    raise UploadRejected('No new transactions found')
+                raise UploadRejected(f'Transactions already uploaded for {self.account.bank_name} between '
+                                     f'{file_first.strftime('%d/%m/%Y')} and {file_last.strftime('%d/%m/%Y')}')
+
+            history_inst.start_date, history_inst.end_date = first_date, last_date
+            history_inst.save(update_fields=['start_date', 'end_date'])
+
+            # Each row is given the financial year its date falls in - from the database, in one update for the whole file
+            Transaction.objects.assign_financial_years(self.account, first_date, last_date)
+            Account.objects.ledger_changed(self.account, first_date, last_date)
+
+        logger.info(f'Imported {self.row_count} transactions into {self.account} - '
+                    f'{self.skipped_count} already uploaded, {self.categorised_count} categorised by rules, {self.error_count} error(s)')
+        return history_inst
@@ -0,0 +1,71 @@
+"""
+    Accounts.services.ledger.py :
+
+Summary :
+    Ledger health - is an account's history of statement rows complete ?
+
+    Each imported row carries the balance from the bank statement, so the balance on a row should be
+    the balance on the row before plus its credit less its debit. A row where it isn't marks a
+    missing (or duplicated) statement. The rows which break the chain are found in one query using
+    window functions over the ledger order (see TransactionManager.with_running_balance).
+
+    The result is cached against the account's ledger version, so it is only worked out again once
+    the account's transactions change.
+
+    Settings - APPS_SETTINGS['Accounts']['ledger'] :
+        cache_timeout : Seconds to keep the ledger health of an account (default 24 hours)
+        max_breaks : The most breaks to list (default 100)
+"""
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Max, Min
+
+from Accounts.models import Account, Transaction
+
+LedgerBreak = namedtuple('LedgerBreak', 'id tx_number transaction_date description previous_balance expected_balance balance')
+
+
+def ledger_settings() -> dict:
+    return settings.APPS_SETTINGS.get('Accounts', {}).get('ledger', {})
+
+
+def _build_health(account_id:int, ledger_version:int) -> dict:
+    summary = (Transaction.objects.filter(account=account_id, parent__isnull=True).
+                    aggregate(transactions=Count('id'), first_date=Min('transaction_date'), last_date=Max('transaction_date')))
+    last = Transaction.objects.with_running_balance(account_id).values('running_balance', 'balance').last()
+
+    breaks = [LedgerBreak(*row) for row in
+                Transaction.objects.discontinuities(account_id).
+                    values_list('id', 'tx_number', 'transaction_date', 'description',
+                                'previous_balance', 'expected_balance', 'balance')[:ledger_settings().get('max_breaks', 100)]]
+
+    closing_balance = last['running_balance'] if last else None
+    statement_balance = last['balance'] if last else None
+    drift = statement_balance - closing_balance if last and statement_balance is not None else None
+
+    return summary | {'account_id': account_id, 'ledger_version': ledger_version,
+                      'closing_balance': closing_balance, 'statement_balance': statement_balance, 'drift': drift,
+                      'breaks': breaks, 'healthy': not breaks and not drift}
+
+
+def ledger_health(account) -> dict:
+    """The health of the account's ledger - from the cache if the transactions haven't changed
+
+        transactions, first_date, last_date : The statement rows on the account
+        closing_balance : The starting balance plus all the credits less all the debits
+        statement_balance : The balance imported on the latest row
+        drift : How far the statement balance is from the closing balance - non zero if the starting balance is wrong
+        breaks : The rows whose balance doesn't follow on from the row before
+        healthy : True if there are no breaks and no drift
+    """
+    account_id = getattr(account, 'id', account)
+    ledger_version = Account.objects.filter(id=account_id).values_list('ledger_version', flat=True).get()
+    key = f'Accounts:ledger_health:{account_id}:{ledger_version}'
+    if (health := cache.get(key)) is not None:
+        return health
+
+    health = _build_health(account_id, ledger_version)
+    cache.set(key, health, ledger_settings().get('cache_timeout', 24 * 60 * 60))
+    return health
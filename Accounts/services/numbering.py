@@ -0,0 +1,106 @@
+"""
+    Accounts.services.numbering.py :
+
+Summary :
+    Transaction numbering.
+
+    Statement rows are numbered APPS_SETTINGS['Accounts']['import']['tx_number_gap'] apart,
+    so that an earlier statement uploaded later can be numbered into the gap in front of the
+    transactions which follow it - without rewriting them.
+
+    Each new row is numbered by its own date - spread across the gap in front of the first
+    transaction with a later date, or appended after the last transaction - so the numbers are
+    always in date order, even for a statement which overlaps the transactions already uploaded.
+
+    If a gap fills up, the later transactions are shifted up to make room; the
+    CompactTransactionNumbers management command re-spaces the numbers of an account.
+"""
+import logging
+from bisect import bisect_right
+from itertools import batched, groupby
+
+from django.conf import settings
+from django.db import transaction as db_transaction
+from django.db.models import F, Max
+
+from Accounts.models import Transaction
+
+logger = logging.getLogger(__name__)
+
+
+def number_gap() -> int:
+    """The spacing between the numbers of appended transactions"""
+    return settings.APPS_SETTINGS.get('Accounts', {}).get('import', {}).get('tx_number_gap', 1000)
+
+
+def number_transactions(account, transactions:list[Transaction]) -> int:
+    """Number the (unsaved) statement rows by their dates - returns the number of transactions shifted to make room
+
+        The numbers of the transactions around the rows are read with three queries - those within the rows'
+        dates, and the last before and first after them.
+    """
+    if not transactions:
+        return 0
+    gap = number_gap()
+    numbered = Transaction.objects.filter(account=account, parent__isnull=True)
+    first = min(tx.transaction_date for tx in transactions)
+    last = max(tx.transaction_date for tx in transactions)
+
+    existing = list(numbered.filter(transaction_date__range=(first, last)).
+                            order_by('transaction_date', 'tx_number').values_list('transaction_date', 'tx_number'))
+    after = numbered.filter(transaction_date__gt=last).order_by('transaction_date', 'tx_number').values_list('transaction_date', 'tx_number').first()
+    if after:
+        existing.append(after)
+    before = numbered.filter(transaction_date__lt=first).aggregate(Max('tx_number'))['tx_number__max'] or 0
+
+    dates, numbers = [day for day, _ in existing], [number for _, number in existing]
+    shifted = 0
+
+    # The rows which go into the same gap - in date order (and file order within a date)
+    in_order = sorted(enumerate(transactions), key=lambda item: (item[1].transaction_date, item[0]))
+    for index, rows in groupby(in_order, key=lambda item: bisect_right(dates, item[1].transaction_date)):
+        rows = [tx for _, tx in rows]
+        previous = numbers[index - 1] if index else before
+
+        if index == len(numbers):
+            # After the last transaction - appended, leaving gaps for later insertions
+            for offset, tx in enumerate(rows, start=1):
+                tx.tx_number = previous + offset * gap
+            continue
+
+        following = numbers[index]
+        if following - previous - 1 < len(rows):
+            # The gap is full - shift the later transactions up to make room
+            shift = len(rows) - (following - previous) + gap
+            shifted += numbered.filter(tx_number__gte=following).update(tx_number=F('tx_number') + shift)
+            numbers[index:] = [number + shift for number in numbers[index:]]
+        # Spread across the gap - leaving room on both sides for later insertions
+        step = (numbers[index] - previous) // (len(rows) + 1)
+        for offset, tx in enumerate(rows, start=1):
+            tx.tx_number = previous + offset * step
+
+    if shifted:
+        logger.warning(f'Transaction numbers for {account} are full - {shifted} transactions renumbered; '
+                       f'run the CompactTransactionNumbers command')
+    return shifted
+
+
+def compact_numbers(account, batch_size:int = 500) -> int:
+    """Re-space the transaction numbers of an account - returns the number of transactions renumbered
+
+        Splits are not numbered, and keep the number of zero they were created with.
+    """
+    gap = number_gap()
+    with db_transaction.atomic():
+        numbered = (Transaction.objects.select_for_update().
+                        filter(account=account, parent__isnull=True).
+                        order_by('transaction_date', 'tx_number', 'id').
+                        values_list('id', 'tx_number'))
+
+        changed = [Transaction(id=tx_id, tx_number=gap * index)
+                        for index, (tx_id, tx_number) in enumerate(numbered, start=1) if tx_number != gap * index]
+        for batch in batched(changed, batch_size):
+            Transaction.objects.bulk_update(batch, ['tx_number'])
+
+    logger.info(f'Renumbered {len(changed)} transactions in {account}')
+    return len(changed)
@@ -0,0 +1,331 @@
+"""
+    Accounts.services.statement_formats.py :
+
+Summary :
+    The bank statement formats an upload can be in - each parsed into the same normalised rows.
+
+    Every format turns an uploaded file into StatementRows :
+        (transaction_date, description, debit, credit, balance, category)
+    and the importer validates and writes those rows in batches whatever the format was. A format
+    is a StatementFormat subclass registered with @register; the format of an upload is recognised
+    from the start of its content, or failing that its file extension - anything else is read as CSV.
+
+    Formats :
+        csv  : The bank's CSV export - the columns in expected_fields (Category is optional)
+        ofx  : OFX 1.x (SGML) and 2.x (XML) - also Quicken's QFX
+        qif  : Quicken Interchange Format - bank (or cash/credit card) accounts
+        camt : ISO 20022 camt.053 - bank to customer statements
+
+    The balance on each row is the running balance after the row. OFX gives only the closing balance,
+    so the balances are worked back from it; camt.053 gives the opening balance, so they are worked
+    forward from it. QIF has no balances - its rows have none.
+
+    Settings - APPS_SETTINGS['Accounts']['import'] :
+        qif_date_order : The order of the day, month and year in QIF dates (default 'DMY')
+"""
+import codecs
+import re
+from collections import namedtuple
+from csv import DictReader
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation
+from functools import lru_cache
+from typing import Iterator
+from xml.etree import ElementTree
+
+from django.conf import settings
+
+StatementRow = namedtuple('StatementRow', 'transaction_date description debit credit balance category')
+
+expected_fields = ['Transaction Date','Sort Code','Account Number','Transaction Description','Debit Amount','Credit Amount','Balance','Category']
+
+ZERO = Decimal('0')
+
+
+class UploadRejected(Exception):
+    """The upload can't be imported - the message is reported against the upload form"""
+
+
+def iter_lines(file, encoding:str='utf-8-sig') -> Iterator[str]:
+    """Yield the lines of an uploaded file - reading it in chunks through an incremental decoder"""
+    decoder = codecs.getincrementaldecoder(encoding)()
+    pending = ''
+    for chunk in file.chunks():
+        pending += decoder.decode(chunk)
+        lines = pending.splitlines(keepends=True)
+
+        # The last line may be incomplete - keep it until the next chunk arrives
+        pending = lines.pop() if lines and not lines[-1].endswith(('\n', '\r')) else ''
+        yield from lines
+
+    pending += decoder.decode(b'', final=True)
+    if pending:
+        yield pending
+
+
+@lru_cache(maxsize=4096)
+def parse_date(value:str) -> date:
+    """A statement date - a statement has few distinct dates, so each is only parsed once"""
+    return datetime.strptime(value, '%d/%m/%Y').date()
+
+
+def parse_amount(value:str) -> Decimal:
+    """An amount - ignoring currency symbols, thousands separators and spaces"""
+    try:
+        return Decimal(re.sub(r'[^0-9.+-]', '', value))
+    except InvalidOperation:
+        raise ValueError(f'Invalid amount {value}')
+
+
+def signed(amount:Decimal) -> tuple[Decimal, Decimal]:
+    """The debit and credit of a signed amount - negative amounts are debits"""
+    return (-amount, ZERO) if amount < 0 else (ZERO, amount)
+
+
+def _decode(data:bytes) -> str:
+    try:
+        return data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        return data.decode('cp1252')
+
+
+class StatementFormat:
+    """A statement format - recognised by sniff() or its extensions, and read by parse()"""
+    name = ''
+    extensions: tuple[str, ...] = ()
+
+    def sniff(self, head:bytes) -> bool:
+        """True if the start of the file is in this format"""
+        return False
+
+    def parse(self, file, file_name:str) -> Iterator[StatementRow]:
+        """The rows of the statement - raises UploadRejected if the file can't be read"""
+        raise NotImplementedError
+
+
+STATEMENT_FORMATS: list[StatementFormat] = []
+
+
+def register(format_class:type[StatementFormat]) -> type[StatementFormat]:
+    """Add a format to those recognised - the formats are tried in the order they are registered"""
+    STATEMENT_FORMATS.append(format_class())
+    return format_class
+
+
+def statement_format(file, file_name:str) -> StatementFormat:
+    """The format of the uploaded file - from its content, then its extension; CSV if neither is recognised"""
+    head = file.read(2048)
+    file.seek(0)
+    for statement in STATEMENT_FORMATS:
+        if statement.sniff(head):
+            return statement
+    extension = file_name.rsplit('.', 1)[-1].lower() if '.' in file_name else ''
+    for statement in STATEMENT_FORMATS:
+        if extension in statement.extensions:
+            return statement
+    return CsvFormat()
+
+
+class CsvFormat(StatementFormat):
+    name = 'csv'
+    extensions = ('csv',)
+
+    def parse(self, file, file_name:str) -> Iterator[StatementRow]:
+        reader = DictReader(iter_lines(file), delimiter=',')
+
+        missing = set(expected_fields) - set(reader.fieldnames or []) - {'Category'}
+        if missing:
+            raise UploadRejected(f'Missing columns {','.join(missing)} in {file_name}')
+
+        for row in reader:
+            try:
+                yield StatementRow(transaction_date=parse_date(row['Transaction Date']),
+                                   description=row['Transaction Description'],
+                                   debit=Decimal(row['Debit Amount'] or '0'), credit=Decimal(row['Credit Amount'] or '0'),
+                                   balance=Decimal(row['Balance']),
+                                   category=row.get('Category', '') or '')
+            except (ValueError, InvalidOperation) as e:
+                raise UploadRejected(f'Invalid data on line {reader.line_num} of {file_name} : {e}')
+
+
+@register
+class OfxFormat(StatementFormat):
+    name = 'ofx'
+    extensions = ('ofx', 'qfx')
+    _transaction = re.compile(r'<STMTTRN>(.*?)</STMTTRN>', re.IGNORECASE | re.DOTALL)
+    _element = re.compile(r'<(\w+)>([^<\r\n]*)')
+    _closing_balance = re.compile(r'<LEDGERBAL>.*?<BALAMT>([^<\r\n]*)', re.IGNORECASE | re.DOTALL)
+
+    def sniff(self, head:bytes) -> bool:
+        start = head.lstrip().upper()
+        return start.startswith(b'OFXHEADER') or (start.startswith(b'<?XML') and b'<?OFX' in start) or start.startswith(b'<OFX>')
+
+    @staticmethod
+    def _date(value:str) -> date:
+        """OFX dates are YYYYMMDD - optionally followed by a time and timezone"""
+        return datetime.strptime(value[:8], '%Y%m%d').date()
+
+    def parse(self, file, file_name:str) -> Iterator[StatementRow]:
+        # An OFX statement is small, and the balances are worked back from the closing balance - so it is read whole
+        text = _decode(b''.join(file.chunks()))
+        rows = []
+        for number, block in enumerate(self._transaction.findall(text), start=1):
+            elements = {tag.upper(): value.strip() for tag, value in self._element.findall(block)}
+            try:
+                amount = parse_amount(elements['TRNAMT'])
+                description = ' '.join(part for part in (elements.get('NAME', ''), elements.get('MEMO', '')) if part)
+                rows.append((self._date(elements['DTPOSTED']), description, amount))
+            except KeyError as e:
+                raise UploadRejected(f'Invalid data in transaction {number} of {file_name} : no {e.args[0]}')
+            except ValueError as e:
+                raise UploadRejected(f'Invalid data in transaction {number} of {file_name} : {e}')
+        if not rows and '<OFX>' not in text.upper():
+            raise UploadRejected(f'No OFX statement found in {file_name}')
+
+        # Oldest first - transactions on the same day stay in the order the bank listed them
+        rows.sort(key=lambda row: row[0])
+        balances = [None] * len(rows)
+        if closing := self._closing_balance.search(text):
+            try:
+                balance = parse_amount(closing.group(1))
+            except ValueError:
+                raise UploadRejected(f'Invalid closing balance {closing.group(1)} in {file_name}')
+            for index in range(len(rows) - 1, -1, -1):
+                balances[index] = balance
+                balance -= rows[index][2]
+
+        for (transaction_date, description, amount), balance in zip(rows, balances):
+            yield StatementRow(transaction_date, description, *signed(amount), balance, '')
+
+
+@register
+class QifFormat(StatementFormat):
+    name = 'qif'
+    extensions = ('qif',)
+
+    def sniff(self, head:bytes) -> bool:
+        return head.lstrip(codecs.BOM_UTF8 + b' \t\r\n').upper().startswith((b'!TYPE:', b'!ACCOUNT', b'!OPTION'))
+
+    @staticmethod
+    def _date(value:str) -> date:
+        """QIF dates have one or two digit parts, any separator, and often ' before a two digit year"""
+        parts = [int(part) for part in re.split(r"[^0-9]+", value.strip()) if part]
+        if len(parts) != 3:
+            raise ValueError(f'Invalid date {value}')
+        order = settings.APPS_SETTINGS.get('Accounts', {}).get('import', {}).get('qif_date_order', 'DMY')
+        fields = dict(zip(order.upper(), parts))
+        year = fields['Y'] + 2000 if fields['Y'] < 100 else fields['Y']
+        return date(year, fields['M'], fields['D'])
+
+    def parse(self, file, file_name:str) -> Iterator[StatementRow]:
+        record, line_number, in_transactions = {}, 0, False
+        for line_number, line in enumerate(iter_lines(file), start=1):
+            line = line.rstrip('\r\n')
+            if not line:
+                continue
+            if line.startswith('!'):
+                # Only the transactions of bank, cash and card accounts - not account lists, categories or memorised items
+                in_transactions = line[1:].strip().lower() in ('type:bank', 'type:cash', 'type:ccard', 'type:oth a', 'type:oth l')
+                continue
+            if not in_transactions:
+                continue
+            if line.startswith('^'):
+                if record:
+                    yield self._row(record, line_number, file_name)
+                record = {}
+                continue
+
+            # Split lines (S, E and $) are the bank's own splits - only the whole transaction is imported
+            code, value = line[0], line[1:].strip()
+            if code in 'DTUPML' and code not in record:
+                record[code] = value
+
+        if record:
+            yield self._row(record, line_number, file_name)
+
+    def _row(self, record:dict, line_number:int, file_name:str) -> StatementRow:
+        try:
+            amount = parse_amount(record.get('T') or record['U'])
+            transaction_date = self._date(record['D'])
+        except KeyError as e:
+            raise UploadRejected(f'Invalid data in the transaction ending on line {line_number} of {file_name} : no {e.args[0]}')
+        except ValueError as e:
+            raise UploadRejected(f'Invalid data in the transaction ending on line {line_number} of {file_name} : {e}')
+
+        # A category in [brackets] is a transfer to another account - not a category
+        category = record.get('L', '')
+        category = '' if category.startswith('[') else category.split(':')[-1].split('/')[0]
+        description = ' '.join(part for part in (record.get('P', ''), record.get('M', '')) if part)
+        return StatementRow(transaction_date, description, *signed(amount), None, category)
+
+
+@register
+class Camt053Format(StatementFormat):
+    name = 'camt'
+    extensions = ('xml', 'camt', 'c53')
+
+    def sniff(self, head:bytes) -> bool:
+        return b'camt.053' in head or b'BkToCstmrStmt' in head
+
+    @staticmethod
+    def _local(tag:str) -> str:
+        return tag.rsplit('}', 1)[-1]
+
+    @classmethod
+    def _find(cls, element, *path):
+        """The first descendant along the path of (namespace free) names - or None"""
+        for name in path:
+            element = next((child for child in element if cls._local(child.tag) == name), None)
+            if element is None:
+                return None
+        return element
+
+    @classmethod
+    def _text(cls, element, *path) -> str:
+        found = cls._find(element, *path)
+        return (found.text or '').strip() if found is not None else ''
+
+    @classmethod
+    def _amount(cls, element) -> Decimal:
+        """The signed amount of a balance or entry - debits are negative"""
+        amount = Decimal(cls._text(element, 'Amt'))
+        return -amount if cls._text(element, 'CdtDbtInd') == 'DBIT' else amount
+
+    @classmethod
+    def _description(cls, entry) -> str:
+        details = cls._find(entry, 'NtryDtls', 'TxDtls')
+        if details is not None:
+            parties = cls._find(details, 'RltdPties')
+            name = ''
+            if parties is not None:
+                name = cls._text(parties, 'Cdtr', 'Nm') or cls._text(parties, 'Dbtr', 'Nm')
+            remittance = cls._text(details, 'RmtInf', 'Ustrd')
+            if name or remittance:
+                return ' '.join(part for part in (name, remittance) if part)
+        return cls._text(entry, 'AddtlNtryInf')
+
+    def parse(self, file, file_name:str) -> Iterator[StatementRow]:
+        balance, number = None, 0
+        try:
+            for event, element in ElementTree.iterparse(file, events=('start', 'end')):
+                name = self._local(element.tag)
+                if event == 'start':
+                    if name == 'Stmt':
+                        balance = None
+                    continue
+
+                if name == 'Bal' and self._text(element, 'Tp', 'CdOrPrtry', 'Cd') in ('OPBD', 'PRCD'):
+                    balance = self._amount(element)
+                elif name == 'Ntry':
+                    number += 1
+                    # Pending entries aren't booked yet - they will be on a later statement
+                    if 'PDNG' not in (self._text(element, 'Sts'), self._text(element, 'Sts', 'Cd')):
+                        amount = self._amount(element)
+                        booked = self._text(element, 'BookgDt', 'Dt') or self._text(element, 'BookgDt', 'DtTm')[:10]
+                        balance = balance + amount if balance is not None else None
+                        yield StatementRow(date.fromisoformat(booked), self._description(element), *signed(amount), balance, '')
+                    element.clear()
+        except ElementTree.ParseError as e:
+            raise UploadRejected(f'Invalid camt.053 statement {file_name} : {e}')
+        except (ValueError, InvalidOperation) as e:
+            raise UploadRejected(f'Invalid data in entry {number} of {file_name} : {e}')
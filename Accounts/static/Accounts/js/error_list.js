@@ -6,6 +6,42 @@ function foreach(array, callback) {
     }
 }
 
+const batch_delay = 250;
+let pending = new Map();
+let batch_timer = null;
+
+function _send_batch() {
+    /** Send all the category changes made since the last batch - in one request **/
+    const changes = pending;
+    pending = new Map();
+    batch_timer = null;
+    const account = document.getElementById("id_account").value;
+    const operations = Array.from(changes, ([tx_id, change]) => ({op: "recategorise", id: parseInt(tx_id), category: change.category}));
+    _invoke_rest_api("batch_edit", account, csrf_token, {operations: operations}, function(account, response) {
+        const message_element = document.getElementById("id_message");
+        if (response.success !== 200) {
+            // Nothing in the batch was saved - put every select back to its saved category, and say why
+            for (const [tx_id, change] of changes) {
+                if (!pending.has(tx_id))
+                    change.select.value = _saved_category(change.select);
+            }
+            message_element.innerText = `Category changes not saved - ${response.message}`;
+            message_element.hidden = false;
+            return;
+        }
+        message_element.hidden = true;
+        for (const [tx_id, change] of changes) {
+            change.row.querySelector("td.category").innerText = change.category;
+        }
+    });
+}
+
+function _saved_category(select) {
+    /** The category the select showed when the page was loaded - the one saved for the transaction **/
+    const saved = Array.from(select.options).find(option => option.defaultSelected);
+    return saved ? saved.value : "";
+}
+
 function _set_category_change_event() {
     const category_element = document.querySelectorAll("div#details table#id_transactions tr.row td.category select.category");
     foreach(category_element, function(element) {
@@ -14,9 +50,12 @@ function _set_category_change_event() {
             const category = element.target.value;
             const id = row.getAttribute("id");
             const tx_id = id.split("_")[1];
-            _invoke_rest_api("edit_transaction", tx_id, csrf_token, {category: category}, function(response) {
-                row.querySelector("td.category").innerText = category;
-            });
+
+            // Changes made in quick succession are saved together
+            pending.set(tx_id, {row: row, select: element.target, category: category});
+            if (batch_timer)
+                clearTimeout(batch_timer);
+            batch_timer = setTimeout(_send_batch, batch_delay);
         });
     })
 }
@@ -0,0 +1,31 @@
+import {_invoke_rest_api} from "./common.js";
+
+const poll_interval = 2000;
+
+function _show_progress(job_id, response) {
+    /** Update the page with the job progress - and move on once the import is complete **/
+    if (response.redirect) {
+        window.location.href = response.redirect;
+        return;
+    }
+    document.getElementById("id_status").innerText = response.status;
+    document.getElementById("id_rows_processed").innerText = response.rows_processed;
+    document.getElementById("id_error_count").innerText = response.error_count;
+    document.getElementById("id_message").innerText = response.message;
+
+    if (response.status === "Failed") {
+        document.getElementById("id_upload_again").hidden = false;
+        return;
+    }
+    setTimeout(_poll, poll_interval);
+}
+
+function _poll() {
+    _invoke_rest_api("import_progress", job_id, csrf_token, null, _show_progress, 'GET');
+}
+
+const script_tag = document.querySelector('script[src$="import_job.js"]');
+const csrf_token = script_tag.getAttribute("csrf");
+const job_id = script_tag.getAttribute("job_id");
+
+document.addEventListener('DOMContentLoaded', _poll);
@@ -0,0 +1,7 @@
+const account_element = document.getElementById("id_account")
+account_element.addEventListener("change", function() {
+        const account = account_element.value;
+        if (account == null || account.trim() === "")
+            return;
+        window.location.href = "/Account/report/ledger/" + account + "/";
+});
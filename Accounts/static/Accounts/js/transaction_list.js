@@ -338,7 +338,7 @@ function _revert_edit_on_child(row_element) {
                     urlParams.set("year", year_element.value);
                 else
                     urlParams.delete("year");
-                urlParams.set("page", "1");
+                ["after", "before", "last"].forEach(param => urlParams.delete(param));
                 window.location.search = urlParams.toString();
             }
         });
@@ -0,0 +1,90 @@
+"""
+Tests of the batch edit api - many edits to an account's transactions in one request.
+"""
+from datetime import date
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from Accounts.models import Account, Categories, CategoryMonthlyTotal, Transaction, UploadError
+from Accounts.services import category_tree
+from Accounts.services.importer import TransactionImporter
+
+from .test_importer import csv_file
+
+
+class BatchEditTests(TestCase):
+    fixtures = ['account_test_categories.json', 'test_bank_account.json']
+
+    def setUp(self):
+        self.account = Account.objects.get(bank_name="Floyd's Bank")
+        self.treasurer = get_user_model().objects.create_superuser(email='treasurer@test.com', password='wibble')
+        rows = [(date(2025, 1, 10), 'Mr Smith', '', '10.00', '10.00', 'Sale'),
+                (date(2025, 1, 31), 'Big Company', '', '100.00', '110.00', 'Sponsorship'),
+                (date(2025, 2, 14), 'Printers', '20.00', '', '90.00', 'Advertisement')]
+        TransactionImporter(self.account, self.treasurer).import_file(csv_file(rows))
+        Categories.objects.create(category_name='Stall', parent=Categories.objects.get(category_name='Sale'))
+        self.tx = {tx.name: tx for tx in Transaction.objects.all()}
+        self.url = reverse('Account:batch_edit', kwargs={'account_id': self.account.id})
+        self.client.force_login(self.treasurer)
+
+    def batch(self, *operations):
+        return self.client.put(self.url, {'operations': list(operations)}, content_type='application/json')
+
+    def test_100_apply_operations(self):
+        """Each kind of operation is applied - and the totals brought up to date"""
+        sale = self.tx['Mr Smith']
+        split = Transaction.objects.create(account=self.account, parent=sale, transaction_date=sale.transaction_date,
+                                           category='Stall', credit=Decimal('2.00'))
+        UploadError.objects.create(transaction=self.tx['Big Company'], upload_history=self.tx['Big Company'].upload_history,
+                                   error_message='Unknown category')
+
+        response = self.batch({'op': 'recategorise', 'id': self.tx['Big Company'].id, 'category': 'Sale'},
+                              {'op': 'rename', 'id': self.tx['Printers'].id, 'name': 'Print Shop'},
+                              {'op': 'add_split', 'parent': sale.id, 'category': 'Stall', 'credit': '3.00'},
+                              {'op': 'edit_split', 'id': split.id, 'category': 'Stall', 'credit': '4.00'})
+        self.assertEqual(response.status_code, 200)
+        results = response.json()['results']
+        self.assertTrue(all(result['success'] for result in results))
+        new_split = Transaction.objects.get(id=results[2]['id'])
+
+        self.assertEqual(Transaction.objects.get(id=self.tx['Big Company'].id).category, 'Sale')
+        self.assertEqual(Transaction.objects.get(id=self.tx['Printers'].id).name, 'Print Shop')
+        self.assertEqual((new_split.parent_id, new_split.credit), (sale.id, Decimal('3.00')))
+        self.assertEqual(Transaction.objects.get(id=sale.id).split_credit_total, Decimal('7.00'))
+        self.assertFalse(UploadError.objects.exists())
+        self.assertEqual(CategoryMonthlyTotal.objects.get(month=date(2025, 1, 1), category='Sale', parent_category='').credit,
+                         Decimal('110.00'))
+
+        response = self.batch({'op': 'delete_split', 'id': split.id})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Transaction.objects.get(id=sale.id).split_credit_total, Decimal('3.00'))
+
+    def test_110_invalid_operation_applies_nothing(self):
+        """If any operation is invalid none are applied - and each result says what was wrong"""
+        response = self.batch({'op': 'recategorise', 'id': self.tx['Mr Smith'].id, 'category': 'Sponsorship'},
+                              {'op': 'edit_split', 'id': self.tx['Printers'].id, 'category': 'Stall', 'debit': '1.00'},
+                              {'op': 'recategorise', 'id': 9999, 'category': 'Sale'},
+                              {'op': 'add_split', 'parent': self.tx['Mr Smith'].id, 'category': 'Wibble', 'credit': '1.00'},
+                              {'op': 'explode'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([result.get('error') for result in response.json()['results']],
+                         [None, f'Transaction {self.tx["Printers"].id} is not a split', 'Transaction 9999 not found',
+                          'Unknown category Wibble', "Unknown operation {'op': 'explode'}"])
+        self.assertEqual(Transaction.objects.get(id=self.tx['Mr Smith'].id).category, 'Sale')
+
+    def test_120_fixed_number_of_queries(self):
+        """Recategorising many transactions costs the same as recategorising one"""
+        def recategorise(*names):
+            return self.batch(*({'op': 'recategorise', 'id': self.tx[name].id, 'category': 'Sponsorship'} for name in names))
+
+        category_tree.category_tree()
+        with CaptureQueriesContext(connection) as one:
+            recategorise('Mr Smith')
+        with self.assertNumQueries(len(one)):
+            recategorise('Mr Smith', 'Big Company')
+
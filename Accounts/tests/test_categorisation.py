@@ -0,0 +1,73 @@
+"""
+Tests of the category rules - applied on import, and learned from past transactions.
+"""
+from datetime import date, timedelta as td
+
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ValidationError
+from django.test import TestCase
+
+from Accounts.models import Account, CategoryRule, Transaction, UploadError
+from Accounts.services.categorisation import RuleMatcher, learn_rules
+from Accounts.services.importer import TransactionImporter
+
+from .test_importer import csv_file
+
+
+class CategoryRuleTests(TestCase):
+    fixtures = ['account_test_categories.json', 'test_bank_account.json']
+
+    def setUp(self):
+        self.account = Account.objects.get(bank_name="Floyd's Bank")
+        self.treasurer = get_user_model().objects.create_user(email='treasurer@test.com', password='wibble')
+
+    def test_100_first_matching_rule_wins(self):
+        """Rules are tried in order - and only those for the sign of the amount"""
+        rules = [CategoryRule(id=1, order=1, field=CategoryRule.Field.DESCRIPTION, pattern='insure', category_id='Insurance',
+                              amount_sign=CategoryRule.Sign.DEBIT),
+                 CategoryRule(id=2, order=2, field=CategoryRule.Field.NAME, pattern='^mr ', category_id='Sale'),
+                 CategoryRule(id=3, order=3, field=CategoryRule.Field.DESCRIPTION, pattern='FPI', category_id='Sponsorship')]
+        matcher = RuleMatcher(rules)
+        self.assertEqual(matcher.match('Mr Smith', 'MR SMITH FPI', is_debit=False), 'Sale')
+        self.assertEqual(matcher.match('Big Co', 'BIG CO FPI', is_debit=False), 'Sponsorship')
+        self.assertEqual(matcher.match('Insure Ltd', 'INSURE LTD FPI', is_debit=True), 'Insurance')
+        self.assertEqual(matcher.match('Insure Ltd', 'INSURE LTD', is_debit=False), None)
+        self.assertEqual(matcher.match('Ms Mr', 'MS MR', is_debit=False), None)
+
+    def test_110_invalid_pattern(self):
+        rule = CategoryRule(pattern='(unclosed', category_id='Sale')
+        with self.assertRaises(ValidationError):
+            rule.clean()
+        self.assertEqual(RuleMatcher([CategoryRule(id=1, pattern='(?P<x>a)', category_id='Sale')]).match('a', 'a', False), None)
+
+    def test_120_import_uses_rules(self):
+        """Rows without a category are categorised by the rules - only those left over are upload errors"""
+        CategoryRule.objects.create(order=1, pattern='village hall', category_id='VillageHall', amount_sign=CategoryRule.Sign.DEBIT)
+        CategoryRule.objects.create(order=2, field=CategoryRule.Field.NAME, pattern='^mr ', category_id='Sale')
+        start = date(2025, 1, 1)
+        rows = [(start, 'MR SMITH', '', '10.00', '10.00', ''),
+                (start + td(days=1), 'BRANTHAM VILLAGE HALL', '5.00', '', '5.00', ''),
+                (start + td(days=2), 'MR JONES', '', '5.00', '10.00', 'Sponsorship'),
+                (start + td(days=3), 'SOMEONE ELSE', '', '1.00', '11.00', '')]
+        importer = TransactionImporter(self.account, self.treasurer)
+        importer.import_file(csv_file(rows))
+
+        self.assertEqual(list(Transaction.objects.order_by('transaction_date').values_list('category', flat=True)),
+                         ['Sale', 'VillageHall', 'Sponsorship', ''])
+        self.assertEqual((importer.categorised_count, importer.error_count), (2, 1))
+        self.assertEqual(UploadError.objects.get().transaction.description, 'SOMEONE ELSE')
+
+    def test_130_learn_rules(self):
+        """Names which were consistently given a category become (inactive) rules"""
+        start = date(2025, 1, 1)
+        rows = ([(start + td(days=index), 'MR SMITH', '', '10.00', f'{10 * (index + 1)}.00', 'Sale') for index in range(3)] +
+                [(start + td(days=10 + index), 'BIG CO', '', '1.00', f'{31 + index}.00', category)
+                        for index, category in enumerate(['Sponsorship', 'Sale', 'Sponsorship'])])
+        TransactionImporter(self.account, self.treasurer).import_file(csv_file(rows))
+
+        learned = learn_rules(min_count=3)
+        self.assertEqual([(rule.pattern, rule.category_id, rule.amount_sign, rule.active, rule.support) for rule in learned],
+                         [(r'^Mr\ Smith$', 'Sale', CategoryRule.Sign.CREDIT, False, 3)])
+
+        # Not proposed again
+        self.assertEqual(learn_rules(min_count=3), [])
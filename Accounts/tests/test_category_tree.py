@@ -0,0 +1,40 @@
+"""
+Tests of the category tree - held in memory until a category changes.
+"""
+from django.db import transaction
+from django.test import TestCase
+
+from Accounts.models import Categories
+from Accounts.services import category_tree
+
+
+class CategoryTreeTests(TestCase):
+    fixtures = ['account_test_categories.json']
+
+    def test_100_tree(self):
+        tree = category_tree.category_tree()
+        self.assertEqual(tree.get('Sale').credit_debit, 'C')
+        self.assertEqual(tree.top_level('D'), sorted(Categories.objects.filter(credit_debit='D').values_list('category_name', flat=True)))
+        self.assertNotIn('Sale', tree.splittable)
+
+    def test_110_loaded_once(self):
+        """The tree is read from the database once - until a category changes"""
+        category_tree.category_tree()
+        with self.assertNumQueries(1):          # Just the version
+            category_tree.category_tree()
+
+        Categories.objects.create(category_name='Stall', parent=Categories.objects.get(category_name='Sale'))
+        tree = category_tree.category_tree()
+        self.assertEqual(tree.children('Sale'), ['Stall'])
+        self.assertIn('Sale', tree.splittable)
+
+        Categories.objects.get(category_name='Stall').delete()
+        self.assertNotIn('Sale', category_tree.category_tree().splittable)
+
+    def test_120_rolled_back(self):
+        """A category which is rolled back is dropped from the tree - the version is rolled back with it"""
+        with self.assertRaises(ZeroDivisionError), transaction.atomic():
+            Categories.objects.create(category_name='Stall', parent=Categories.objects.get(category_name='Sale'))
+            self.assertIn('Sale', category_tree.category_tree().splittable)
+            1 / 0
+        self.assertNotIn('Sale', category_tree.category_tree().splittable)
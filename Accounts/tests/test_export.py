@@ -0,0 +1,91 @@
+"""
+Tests of the streaming exports - the transaction list and the report tables as csv and xlsx.
+"""
+import csv
+import io
+import zipfile
+from datetime import date
+from decimal import Decimal
+from xml.etree import ElementTree
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+from django.urls import reverse
+
+from Accounts.models import Account, FinancialYear, Transaction
+from Accounts.services.export import xlsx_stream, csv_stream
+from Accounts.services.importer import TransactionImporter
+
+from .test_importer import csv_file
+
+NS = {'s': 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'}
+
+
+def xlsx_rows(content:bytes, sheet:int = 1) -> list[list[str]]:
+    """The text of each cell in the sheet of the workbook"""
+    with zipfile.ZipFile(io.BytesIO(content)) as workbook:
+        root = ElementTree.fromstring(workbook.read(f'xl/worksheets/sheet{sheet}.xml'))
+    return [[''.join(cell.itertext()) for cell in row.findall('s:c', NS)] for row in root.iterfind('.//s:row', NS)]
+
+
+class ExportTests(TestCase):
+    fixtures = ['account_test_categories.json', 'test_bank_account.json']
+
+    def setUp(self):
+        self.account = Account.objects.get(bank_name="Floyd's Bank")
+        self.treasurer = get_user_model().objects.create_superuser(email='treasurer@test.com', password='wibble')
+        rows = [(date(2025, 1, 10), 'Mr Smith', '', '10.00', '10.00', 'Sale'),
+                (date(2025, 1, 31), 'Big Company', '', '100.00', '110.00', 'Sponsorship'),
+                (date(2025, 2, 14), 'Printers & Co', '20.00', '', '90.00', 'Advertisement')]
+        TransactionImporter(self.account, self.treasurer).import_file(csv_file(rows))
+        sponsor = Transaction.objects.get(name='Big Company')
+        Transaction.objects.create(account=self.account, parent=sponsor, transaction_date=sponsor.transaction_date,
+                                   category='Sale', credit=Decimal('30.00'))
+        self.url = reverse('Account:TransactionList', kwargs={'account_id': self.account.id})
+        self.client.force_login(self.treasurer)
+
+    def test_100_transactions_csv(self):
+        """The csv export lists each transaction followed by its splits"""
+        response = self.client.get(self.url, {'export': 'csv'})
+        self.assertTrue(response.streaming)
+        self.assertIn('attachment', response['Content-Disposition'])
+        rows = list(csv.reader(io.StringIO(b''.join(response.streaming_content).decode('utf-8-sig'))))
+        self.assertEqual(rows[0][:3], ['Number', 'Date', 'Description'])
+        self.assertEqual([(row[2], row[4], row[7]) for row in rows[1:]],
+                         [('Mr Smith', 'Sale', '10.00'), ('Big Company', 'Sponsorship', '100.00'),
+                          ('', 'Sale', '30.00'), ('Printers & Co', 'Advertisement', '0.00')])
+
+    def test_110_transactions_xlsx(self):
+        """The xlsx export is a workbook with a row for each transaction"""
+        response = self.client.get(self.url, {'export': 'xlsx'})
+        rows = xlsx_rows(b''.join(response.streaming_content))
+        self.assertEqual(rows[0][:3], ['Number', 'Date', 'Description'])
+        self.assertEqual([(row[2], row[4]) for row in rows[1:]],
+                         [('Mr Smith', 'Sale'), ('Big Company', 'Sponsorship'), ('', 'Sale'), ('Printers & Co', 'Advertisement')])
+        self.assertEqual(rows[1][1], str((date(2025, 1, 10) - date(1899, 12, 30)).days))
+
+    def test_120_xlsx_streamed_in_chunks(self):
+        """Rows are written to the response a batch at a time - not all at the end"""
+        rows = ((index, f'Row {index}') for index in range(2000))
+        chunks = list(xlsx_stream([('Big <sheet>', ['Number', 'Name'], rows)], batch_size=100))
+        self.assertGreater(len(chunks), 10)
+        content = b''.join(chunks)
+        self.assertEqual(len(xlsx_rows(content)), 2001)
+        with zipfile.ZipFile(io.BytesIO(content)) as workbook:
+            self.assertIn(b'name="Big &lt;sheet&gt;"', workbook.read('xl/workbook.xml'))
+
+    def test_130_csv_tables(self):
+        """Each table of a multi-table csv is headed by its title"""
+        content = b''.join(csv_stream([('First', ['A'], [(1,)]), ('Second', ['B'], [(2,)])])).decode('utf-8-sig')
+        self.assertEqual(list(csv.reader(io.StringIO(content))), [['First'], ['A'], ['1'], [], ['Second'], ['B'], ['2']])
+
+    def test_140_report_export(self):
+        """The report tables and category summary are exported as worksheets"""
+        FinancialYear.objects.create(year='2025', year_start=date(2025, 1, 1), year_end=date(2025, 12, 31))
+        url = reverse('Account:report', kwargs={'account_id': self.account.id})
+        response = self.client.get(url, {'type': 'year', 'year': '2025', 'export': 'xlsx'})
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="YearlyReport-2025.xlsx"')
+        content = b''.join(response.streaming_content)
+        self.assertEqual(xlsx_rows(content, 1)[1:], [['Sponsorship', '100.00', ''], ['Sale', '10.00', ''], ['Total', '110.00', '']])
+        self.assertEqual(xlsx_rows(content, 4)[1:], [['Sponsorship', 'Sale', '30.00']])
+        self.assertIn(['Advertisement', '', '0.00', '20.00', '1'], xlsx_rows(content, 6))
@@ -0,0 +1,120 @@
+"""
+Tests of the financial year index - and the financial year held on each transaction.
+"""
+from datetime import date
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+from django.urls import reverse
+
+from Accounts.models import Account, FinancialYear, Transaction
+from Accounts.services import financial_years
+from Accounts.services.importer import TransactionImporter
+
+from .test_importer import csv_file
+
+
+class FinancialYearIndexTests(TestCase):
+    def setUp(self):
+        for calendar_year in (2022, 2023, 2024):
+            FinancialYear.objects.create_from_year(calendar_year)
+
+    def test_100_lookups(self):
+        """Dates are found in the right year - including the first and last days, and the gaps between years"""
+        FinancialYear.objects.create(year='2026-2027', year_start=date(2026, 1, 1), year_end=date(2026, 12, 31))
+        years = financial_years.financial_years()
+
+        self.assertEqual(years.for_date(date(2022, 10, 1)).year, '2022-2023')
+        self.assertEqual(years.for_date(date(2023, 9, 30)).year, '2022-2023')
+        self.assertEqual(years.for_date(date(2025, 2, 14)).year, '2024-2025')
+        self.assertIsNone(years.for_date(date(2022, 9, 30)))
+        self.assertIsNone(years.for_date(date(2025, 11, 1)))
+        self.assertEqual(years.containing(date(2023, 1, 1), date(2023, 6, 30)).year, '2022-2023')
+        self.assertIsNone(years.containing(date(2023, 1, 1), date(2023, 10, 31)))
+        self.assertEqual([interval.year for interval in years.overlapping(date(2023, 9, 1), date(2026, 3, 1))],
+                         ['2022-2023', '2023-2024', '2024-2025', '2026-2027'])
+        self.assertEqual(FinancialYear.objects.overlap(date(2020, 1, 1), date(2022, 12, 31)), ['2022-2023'])
+        self.assertEqual(years.previous(years.get('2023-2024')).year, '2022-2023')
+        self.assertEqual([interval.year for interval in years.up_to(years.get('2023-2024'), 5)], ['2022-2023', '2023-2024'])
+
+    def test_105_overlap_from_database(self):
+        """The overlap check reads the database - a year the index hasn't seen yet still counts"""
+        financial_years.financial_years()
+        # bulk_create sends no signal - as if the version change wasn't seen yet
+        FinancialYear.objects.bulk_create([FinancialYear(year='2025-2026', year_start=date(2025, 10, 1), year_end=date(2026, 9, 30))])
+        self.assertEqual(FinancialYear.objects.overlap(date(2026, 1, 1), date(2026, 12, 31)), ['2025-2026'])
+        self.assertEqual(FinancialYear.objects.overlap(date(2024, 9, 1), date(2025, 10, 1)), ['2023-2024', '2024-2025', '2025-2026'])
+
+    def test_110_loaded_once(self):
+        """The index is read from the database once - until a financial year changes"""
+        financial_years.financial_years()
+        with self.assertNumQueries(1):          # Just the version
+            financial_years.financial_years().for_date(date(2023, 1, 1))
+
+        FinancialYear.objects.create_from_year(2025)
+        self.assertEqual(financial_years.financial_years().latest().year, '2025-2026')
+        FinancialYear.objects.get(year='2025-2026').delete()
+        self.assertEqual(financial_years.financial_years().latest().year, '2024-2025')
+
+
+class TransactionFinancialYearTests(TestCase):
+    fixtures = ['account_test_categories.json', 'test_bank_account.json']
+
+    def setUp(self):
+        self.account = Account.objects.get(bank_name="Floyd's Bank")
+        self.treasurer = get_user_model().objects.create_superuser(email='treasurer@test.com', password='wibble')
+        FinancialYear.objects.create_from_year(2023)
+        FinancialYear.objects.create_from_year(2024)
+        rows = [(date(2023, 11, 10), 'Mr Smith', '', '10.00', '10.00', 'Sale'),
+                (date(2024, 9, 30), 'Mr Jones', '', '5.00', '15.00', 'Sale'),
+                (date(2024, 10, 1), 'Mrs Smith', '', '7.00', '22.00', 'Sale'),
+                (date(2025, 11, 1), 'Big Company', '', '100.00', '122.00', 'Sponsorship')]
+        TransactionImporter(self.account, self.treasurer).import_file(csv_file(rows))
+
+    def years(self):
+        return dict(Transaction.objects.values_list('name', 'financial_year__year'))
+
+    def test_200_set_at_import(self):
+        self.assertEqual(self.years(), {'Mr Smith': '2023-2024', 'Mr Jones': '2023-2024',
+                                        'Mrs Smith': '2024-2025', 'Big Company': None})
+
+    def test_210_follows_the_years(self):
+        """Creating, moving and deleting a financial year moves its transactions"""
+        FinancialYear.objects.create_from_year(2025)
+        self.assertEqual(self.years()['Big Company'], '2025-2026')
+
+        year = FinancialYear.objects.get(year='2023-2024')
+        year.year_end = date(2024, 6, 30)
+        year.save()
+        self.assertEqual(self.years()['Mr Jones'], None)
+
+        year.delete()
+        self.assertEqual(self.years()['Mr Smith'], None)
+
+    def test_220_set_on_save(self):
+        tx = Transaction.objects.get(name='Mrs Smith')
+        tx.transaction_date = date(2024, 9, 29)
+        tx.save()
+        self.assertEqual(self.years()['Mrs Smith'], '2023-2024')
+
+    def test_230_transaction_list_by_year(self):
+        """The transaction list for a year is the transactions in that financial year"""
+        self.client.force_login(self.treasurer)
+        response = self.client.get(reverse('Account:TransactionList', kwargs={'account_id': self.account.id}),
+                                   {'year': '2023-2024'})
+        self.assertEqual([tx.name for tx in response.context['object_list']], ['Mr Smith', 'Mr Jones'])
+
+    def test_240_not_stale_index(self):
+        """A year this process's index hasn't seen yet (added by another process) is still found at import and on save"""
+        financial_years.financial_years()
+        # bulk_create sends no signal - as if the year was added where this process can't see the version change
+        FinancialYear.objects.bulk_create([FinancialYear(year='2025-2026', year_start=date(2025, 10, 1), year_end=date(2026, 9, 30))])
+        self.assertIsNone(financial_years.financial_years().for_date(date(2025, 11, 1)))
+
+        TransactionImporter(self.account, self.treasurer).import_file(
+                    csv_file([(date(2025, 11, 2), 'Mr Brown', '', '3.00', '125.00', 'Sale')]))
+        self.assertEqual(self.years()['Mr Brown'], '2025-2026')
+
+        tx = Transaction.objects.get(name='Big Company')
+        tx.save()
+        self.assertEqual(self.years()['Big Company'], '2025-2026')
@@ -0,0 +1,270 @@
+"""
+Tests of the bulk transaction importer - these exercise the import engine directly
+(without the upload page) so they don't need a browser.
+"""
+import tempfile
+from datetime import date, timedelta as td
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from Accounts.models import Account, Transaction, UploadError, UploadHistory, ImportJob
+from Accounts.services.importer import TransactionImporter, UploadRejected
+from Accounts.services.import_jobs import queue_import, run_job
+from Accounts.services.numbering import number_gap, compact_numbers
+
+header = 'Transaction Date,Transaction Type,Sort Code,Account Number,Transaction Description,Debit Amount,Credit Amount,Balance,Category\n'
+
+
+def csv_file(rows, name='statement.csv', columns=header):
+    """Build an uploaded CSV file from a list of (date, description, debit, credit, balance, category) tuples"""
+    lines = [columns] + [f'{tx_date.strftime('%d/%m/%Y')},FPI,55-55-55,12345678,{description},{debit},{credit},{balance},{category}\n'
+                         for tx_date, description, debit, credit, balance, category in rows]
+    return SimpleUploadedFile(name, ''.join(lines).encode('utf-8'), content_type='text/csv')
+
+
+class TransactionImporterTests(TestCase):
+    fixtures = ['account_test_categories.json', 'test_bank_account.json']
+
+    def setUp(self):
+        self.account = Account.objects.get(bank_name="Floyd's Bank")
+        self.treasurer = get_user_model().objects.create_user(email='treasurer@test.com', password='wibble')
+        self.start = date.today() - td(days=100)
+
+    def test_100_bulk_import(self):
+        """All rows are written with their derived names and spaced numbers"""
+        rows = [(self.start + td(days=index), f"Sarah's SweetShop {index}", '', '10.00', f'{10 * (index + 1)}.00', 'Sale')
+                for index in range(25)]
+
+        importer = TransactionImporter(self.account, self.treasurer, batch_size=10)
+        history = importer.import_file(csv_file(rows))
+
+        self.assertEqual(importer.error_count, 0)
+        self.assertEqual(history.start_date, self.start)
+        self.assertEqual(history.end_date, self.start + td(days=24))
+        tx = Transaction.objects.filter(upload_history=history).order_by('tx_number')
+        self.assertEqual(list(tx.values_list('tx_number', flat=True)), [number_gap() * index for index in range(1, 26)])
+        self.assertEqual(tx.first().name, "Sarah's Sweetshop")
+        self.assertEqual(tx.last().balance, Decimal('250.00'))
+
+    def test_110_errors_recorded(self):
+        """Unknown categories, and categories of the wrong type are recorded as upload errors"""
+        rows = [(self.start, 'Mr Smith', '', '10.00', '10.00', 'Unexpected'),
+                (self.start + td(days=1), 'Big Company', '', '100.00', '110.00', 'Sponsorship'),
+                (self.start + td(days=2), 'Printers', '20.00', '', '90.00', 'Sponsorship'),
+                (self.start + td(days=3), 'Mr Jones', '', '5.00', '95.00', '')]
+
+        importer = TransactionImporter(self.account, self.treasurer)
+        history = importer.import_file(csv_file(rows))
+
+        self.assertEqual(importer.error_count, 3)
+        self.assertEqual(sorted(UploadError.objects.filter(upload_history=history).values_list('error_message', flat=True)),
+                         ['Invalid category for credit', 'Unknown category ', 'Unknown category Unexpected'])
+
+    def test_120_missing_columns(self):
+        """Missing columns reject the upload without writing anything"""
+        with self.assertRaisesRegex(UploadRejected, 'Missing columns Balance'):
+            TransactionImporter(self.account, self.treasurer).import_file(
+                csv_file([], columns='Transaction Date,Sort Code,Account Number,Transaction Description,Debit Amount,Credit Amount\n'))
+        self.assertFalse(UploadHistory.objects.exists())
+
+    def test_130_overlap_rejected(self):
+        """A second upload covering the same dates is rejected"""
+        rows = [(self.start, 'Mr Smith', '', '10.00', '10.00', 'Sale')]
+        TransactionImporter(self.account, self.treasurer).import_file(csv_file(rows))
+
+        with self.assertRaisesRegex(UploadRejected, 'Transactions already uploaded'):
+            TransactionImporter(self.account, self.treasurer).import_file(csv_file(rows))
+        self.assertEqual(Transaction.objects.count(), 1)
+
+    def test_140_out_of_order(self):
+        """An earlier statement is numbered into the gap without renumbering the later transactions"""
+        later = [(self.start + td(days=10), 'Mr Jones', '', '10.00', '30.00', 'Sale')]
+        earlier = [(self.start, 'Mr Smith', '', '10.00', '10.00', 'Sale'),
+                   (self.start + td(days=1), 'Mrs Smith', '', '10.00', '20.00', 'Sale')]
+        TransactionImporter(self.account, self.treasurer).import_file(csv_file(later))
+        TransactionImporter(self.account, self.treasurer).import_file(csv_file(earlier))
+
+        self.assertEqual(list(Transaction.objects.order_by('transaction_date').values_list('tx_number', flat=True)),
+                         [number_gap() // 3, 2 * (number_gap() // 3), number_gap()])
+
+    def test_142_overlapping_both_sides(self):
+        """A statement with rows before and after an existing transaction is numbered in date order - across batches"""
+        TransactionImporter(self.account, self.treasurer).import_file(
+                csv_file([(self.start + td(days=10), 'Mr Jones', '', '10.00', '10.00', 'Sale')]))
+
+        rows = [(self.start + td(days=day), f'Mr Smith {day}', '', '1.00', f'{day}.00', 'Sale') for day in (12, 3, 8, 15, 1, 10, 9, 20)]
+        TransactionImporter(self.account, self.treasurer, batch_size=3).import_file(csv_file(rows))
+
+        by_number = list(Transaction.objects.order_by('tx_number').values_list('transaction_date', 'description'))
+        self.assertEqual(len(by_number), 9)
+        self.assertEqual([day for day, _ in by_number], sorted(day for day, _ in by_number))
+        # A new row on the same day as an existing one goes after it
+        self.assertEqual([description for day, description in by_number if day == self.start + td(days=10)],
+                         ['Mr Jones', 'Mr Smith 10'])
+
+    @override_settings(APPS_SETTINGS={'Accounts': {'import': {'tx_number_gap': 4}}})
+    def test_145_out_of_order_gap_full(self):
+        """When the gap is full the later transactions are shifted - and compaction re-spaces them"""
+        later = [(self.start + td(days=10 + index), f'Mr Jones {index}', '', '1.00', f'{index + 1}.00', 'Sale')
+                 for index in range(2)]
+        earlier = [(self.start + td(days=index), f'Mr Smith {index}', '', '1.00', f'{index + 1}.00', 'Sale')
+                   for index in range(5)]
+        TransactionImporter(self.account, self.treasurer).import_file(csv_file(later))
+        TransactionImporter(self.account, self.treasurer).import_file(csv_file(earlier))
+
+        numbers = list(Transaction.objects.order_by('transaction_date').values_list('tx_number', flat=True))
+        self.assertEqual(numbers, [1, 2, 3, 4, 5, 9, 13])
+
+        self.assertEqual(compact_numbers(self.account), 7)
+        self.assertEqual(list(Transaction.objects.order_by('transaction_date').values_list('tx_number', flat=True)),
+                         list(range(4, 29, 4)))
+        self.assertEqual(compact_numbers(self.account), 0)
+
+    def test_150_streamed_in_small_chunks(self):
+        """Lines and multibyte characters split across chunk boundaries are reassembled"""
+        rows = [(self.start + td(days=index), f'Café £{index}', '', '1.00', f'{index + 1}.00', 'Sale')
+                for index in range(12)]
+        upload = csv_file(rows)
+        upload.DEFAULT_CHUNK_SIZE = 7
+
+        importer = TransactionImporter(self.account, self.treasurer, batch_size=5)
+        history = importer.import_file(upload)
+
+        self.assertEqual(importer.row_count, 12)
+        self.assertEqual(list(Transaction.objects.filter(upload_history=history).order_by('tx_number').
+                              values_list('description', flat=True)),
+                         [f'Café £{index}' for index in range(12)])
+
+    def test_160_overlap_in_later_batch_rolls_back(self):
+        """An invalid row found after the first batch is written leaves nothing behind"""
+        existing = [(self.start + td(days=20), 'Mr Smith', '', '10.00', '10.00', 'Sale')]
+        TransactionImporter(self.account, self.treasurer).import_file(csv_file(existing))
+
+        rows = [(self.start + td(days=index), f'Mr Jones {index}', '', '1.00', '1.00', 'Sale') for index in range(30)]
+        rows[25] = (self.start + td(days=25), 'Mr Jones', '', 'wibble', '1.00', 'Sale')
+        with self.assertRaisesRegex(UploadRejected, 'Invalid data on line 27'):
+            TransactionImporter(self.account, self.treasurer, batch_size=10).import_file(csv_file(rows))
+
+        self.assertEqual(Transaction.objects.count(), 1)
+        self.assertEqual(UploadHistory.objects.count(), 1)
+
+    def test_170_overlapping_statement_deduplicated(self):
+        """Rows already uploaded are skipped - only the new rows are imported"""
+        rows = [(self.start + td(days=index), f'Mr Smith {index}', '', '1.00', f'{index + 1}.00', 'Sale')
+                for index in range(20)]
+        TransactionImporter(self.account, self.treasurer).import_file(csv_file(rows[:12]))
+
+        importer = TransactionImporter(self.account, self.treasurer, batch_size=5)
+        history = importer.import_file(csv_file(rows[5:]))
+
+        self.assertEqual(importer.skipped_count, 7)
+        self.assertEqual(importer.row_count, 8)
+        self.assertEqual(history.start_date, self.start + td(days=12))
+        self.assertEqual(history.end_date, self.start + td(days=19))
+        self.assertEqual(list(Transaction.objects.order_by('transaction_date').values_list('tx_number', flat=True)),
+                         [number_gap() * index for index in range(1, 21)])
+
+    def test_180_same_row_different_balance_kept(self):
+        """Only the row with a known running balance is skipped"""
+        TransactionImporter(self.account, self.treasurer).import_file(
+                csv_file([(self.start, 'Mr Smith', '', '10.00', '10.00', 'Sale')]))
+
+        importer = TransactionImporter(self.account, self.treasurer)
+        importer.import_file(csv_file([(self.start, 'Mr Smith', '', '10.00', '10.00', 'Sale'),
+                                       (self.start + td(days=1), 'Mr Smith', '', '10.00', '20.00', 'Sale')]))
+
+        self.assertEqual((importer.skipped_count, importer.row_count), (1, 1))
+        self.assertEqual(Transaction.objects.filter(description='Mr Smith').count(), 2)
+
+    def test_190_preview_writes_nothing(self):
+        """A preview reports the errors and duplicates an import would find - without writing anything"""
+        TransactionImporter(self.account, self.treasurer).import_file(
+                csv_file([(self.start, 'Mr Smith', '', '10.00', '10.00', 'Sale')]))
+        rows = [(self.start, 'Mr Smith', '', '10.00', '10.00', 'Sale'),
+                (self.start + td(days=1), 'Big Company', '', '100.00', '110.00', 'Sponsorship'),
+                (self.start + td(days=2), 'Printers', '20.00', '', '90.00', 'Sponsorship'),
+                (self.start + td(days=3), 'Mr Jones', '', '5.00', '95.00', 'Unexpected')]
+        counts = (Transaction.objects.count(), UploadHistory.objects.count(), UploadError.objects.count())
+
+        with self.assertNumQueries(4):           # The category tree version, the rules, and a fingerprint lookup for each batch
+            preview = TransactionImporter(self.account, self.treasurer, batch_size=2).preview_file(csv_file(rows))
+
+        self.assertEqual((Transaction.objects.count(), UploadHistory.objects.count(), UploadError.objects.count()), counts)
+        self.assertEqual((preview['rows'], preview['new'], preview['duplicates'], preview['error_count']), (4, 3, 1, 2))
+        self.assertEqual((preview['first_date'], preview['last_date']), (self.start + td(days=1), self.start + td(days=3)))
+        self.assertEqual([(error.row, error.error) for error in preview['errors']],
+                         [(4, 'Invalid category for credit'), (5, 'Unknown category Unexpected')])
+
+    def test_195_preview_page(self):
+        """The upload page previews the file when asked - and imports nothing"""
+        self.treasurer.is_superuser = True
+        self.treasurer.save()
+        self.client.force_login(self.treasurer)
+        rows = [(self.start, 'Mr Smith', '', '10.00', '10.00', 'Unexpected')]
+
+        response = self.client.post(reverse('Account:upload_transactions'),
+                                    {'account': self.account.id, 'file': csv_file(rows), 'preview': ''})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['preview']['error_count'], 1)
+        self.assertContains(response, 'Unknown category Unexpected')
+        self.assertFalse(Transaction.objects.exists())
+
+
+@override_settings(MEDIA_ROOT=tempfile.gettempdir())
+class ImportJobTests(TransactionTestCase):
+    """Queued imports run in their own thread - so these need real commits"""
+    fixtures = ['account_test_categories.json', 'test_bank_account.json']
+
+    def setUp(self):
+        self.account = Account.objects.get(bank_name="Floyd's Bank")
+        self.treasurer = get_user_model().objects.create_user(email='treasurer@test.com', password='wibble')
+        self.start = date.today() - td(days=100)
+
+    def test_200_queued_job_processed(self):
+        """A queued job is claimed, imported and records where to go next"""
+        rows = [(self.start + td(days=index), f'Mr Smith {index}', '', '1.00', f'{index + 1}.00', 'Sale') for index in range(10)]
+        job = queue_import(self.account, self.treasurer, csv_file(rows))
+        self.assertEqual(job.status, ImportJob.Status.QUEUED)
+
+        claimed = ImportJob.objects.claim_next()
+        self.assertEqual(claimed, job)
+        self.assertIsNone(ImportJob.objects.claim_next())
+
+        job = run_job(claimed, poll_interval=0.1)
+        self.assertEqual(job.status, ImportJob.Status.COMPLETE)
+        self.assertEqual(job.rows_processed, 10)
+        self.assertEqual(Transaction.objects.filter(upload_history=job.upload_history).count(), 10)
+        self.assertEqual(job.get_result_url(), reverse('Account:TransactionList', kwargs={'account_id': self.account.id}))
+        self.assertFalse(job.upload_file)
+
+    def test_210_rejected_job_fails(self):
+        """A rejected upload fails the job with the reason"""
+        job = queue_import(self.account, self.treasurer,
+                           csv_file([], columns='Transaction Date,Sort Code,Account Number,Transaction Description\n'))
+
+        job = run_job(ImportJob.objects.claim_next(), poll_interval=0.1)
+        self.assertEqual(job.status, ImportJob.Status.FAILED)
+        self.assertIn('Missing columns', job.message)
+        self.assertIsNone(job.get_result_url())
+
+    def test_220_stalled_job_fails(self):
+        """A job whose worker has stopped is failed - rather than left running for ever"""
+        job = queue_import(self.account, self.treasurer, csv_file([(self.start, 'Mr Smith', '', '1.00', '1.00', 'Sale')]))
+        self.assertEqual(ImportJob.objects.claim_next(), job)
+
+        # Still making progress
+        self.assertIsNone(ImportJob.objects.claim_next())
+        job.refresh_from_db()
+        self.assertEqual(job.status, ImportJob.Status.RUNNING)
+
+        ImportJob.objects.filter(pk=job.pk).update(heartbeat_at=timezone.now() - td(seconds=601))
+        self.assertIsNone(ImportJob.objects.claim_next())
+        job.refresh_from_db()
+        self.assertEqual(job.status, ImportJob.Status.FAILED)
+        self.assertIn('stopped before it finished', job.message)
@@ -0,0 +1,73 @@
+"""
+Tests of the ledger health - the running balance and the breaks in the statement balances.
+"""
+from datetime import date
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import TestCase
+from django.urls import reverse
+
+from Accounts.models import Account, Transaction
+from Accounts.services.importer import TransactionImporter
+from Accounts.services.ledger import ledger_health
+
+from .test_importer import csv_file
+
+
+class LedgerHealthTests(TestCase):
+    fixtures = ['account_test_categories.json', 'test_bank_account.json']
+
+    def setUp(self):
+        cache.clear()
+        self.account = Account.objects.get(bank_name="Floyd's Bank")
+        self.treasurer = get_user_model().objects.create_superuser(email='treasurer@test.com', password='wibble')
+
+    def upload(self, rows):
+        TransactionImporter(self.account, self.treasurer).import_file(csv_file(rows))
+
+    def test_100_running_balance(self):
+        """The running balance follows the ledger order - including transactions on the same day"""
+        self.upload([(date(2025, 1, 10), 'Mr Smith', '', '10.00', '10.00', 'Sale'),
+                     (date(2025, 1, 10), 'Printers', '4.00', '', '6.00', 'Advertisement'),
+                     (date(2025, 2, 1), 'Mr Jones', '', '5.00', '11.00', 'Sale')])
+        rows = Transaction.objects.with_running_balance(self.account)
+        self.assertEqual([(tx.name, tx.running_balance, tx.previous_balance) for tx in rows],
+                         [('Mr Smith', Decimal('10.00'), None),
+                          ('Printers', Decimal('6.00'), Decimal('10.00')),
+                          ('Mr Jones', Decimal('11.00'), Decimal('6.00'))])
+
+        health = ledger_health(self.account)
+        self.assertTrue(health['healthy'])
+        self.assertEqual((health['transactions'], health['closing_balance'], health['statement_balance']),
+                         (3, Decimal('11.00'), Decimal('11.00')))
+
+    def test_110_missing_statement(self):
+        """A gap in the statement balances is reported at the row after the gap"""
+        self.upload([(date(2025, 1, 10), 'Mr Smith', '', '10.00', '10.00', 'Sale'),
+                     (date(2025, 3, 1), 'Mr Jones', '', '5.00', '45.00', 'Sale'),
+                     (date(2025, 3, 2), 'Mrs Smith', '', '5.00', '50.00', 'Sale')])
+        health = ledger_health(self.account)
+        self.assertFalse(health['healthy'])
+        self.assertEqual([(row.description, row.expected_balance, row.balance) for row in health['breaks']],
+                         [('Mr Jones', Decimal('15.00'), Decimal('45.00'))])
+        self.assertEqual(health['drift'], Decimal('30.00'))
+
+    def test_120_cached_until_ledger_changes(self):
+        """The health is worked out once - until the account's transactions change"""
+        self.upload([(date(2025, 1, 10), 'Mr Smith', '', '10.00', '10.00', 'Sale'),
+                     (date(2025, 3, 1), 'Mr Jones', '', '5.00', '45.00', 'Sale')])
+        ledger_health(self.account)
+        with self.assertNumQueries(1):
+            self.assertFalse(ledger_health(self.account)['healthy'])
+
+        self.upload([(date(2025, 2, 1), 'Big Company', '', '30.00', '40.00', 'Sponsorship')])
+        self.assertTrue(ledger_health(self.account)['healthy'])
+
+    def test_130_view(self):
+        self.upload([(date(2025, 1, 10), 'Mr Smith', '', '10.00', '10.00', 'Sale')])
+        self.client.force_login(self.treasurer)
+        response = self.client.get(reverse('Account:LedgerHealth', kwargs={'account_id': self.account.id}))
+        self.assertContains(response, 'id_healthy')
+        self.assertEqual(self.client.get(reverse('Account:LedgerHealth', kwargs={'account_id': 999})).status_code, 404)
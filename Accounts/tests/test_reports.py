@@ -0,0 +1,250 @@
+"""
+Tests of the report data - the monthly category totals and the figures built from them.
+"""
+from datetime import date
+from decimal import Decimal
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import TestCase
+
+from Accounts.models import Account, Transaction, CategoryMonthlyTotal, FinancialYear
+from Accounts.services.importer import TransactionImporter
+from Accounts.views.reports import ComparativeReport, FlexibleReport, FinancialSummary
+
+from .test_importer import csv_file
+
+
+class CategoryMonthlyTotalTests(TestCase):
+    fixtures = ['account_test_categories.json', 'test_bank_account.json']
+
+    def setUp(self):
+        self.account = Account.objects.get(bank_name="Floyd's Bank")
+        self.treasurer = get_user_model().objects.create_user(email='treasurer@test.com', password='wibble')
+        rows = [(date(2025, 1, 10), 'Mr Smith', '', '10.00', '10.00', 'Sale'),
+                (date(2025, 1, 31), 'Big Company', '', '100.00', '110.00', 'Sponsorship'),
+                (date(2025, 2, 1), 'Mr Jones', '', '5.00', '115.00', 'Sale'),
+                (date(2025, 2, 14), 'Printers', '20.00', '', '95.00', 'Advertisement'),
+                (date(2025, 3, 3), 'Mrs Smith', '', '7.00', '102.00', 'Sale')]
+        TransactionImporter(self.account, self.treasurer).import_file(csv_file(rows))
+
+    def raw_totals(self, start, end):
+        """The totals computed directly from the transactions"""
+        totals = {}
+        for tx in Transaction.objects.filter(account=self.account, transaction_date__range=(start, end)):
+            entry = totals.setdefault((tx.category, tx.parent.category if tx.parent else ''),
+                                      {'credit': Decimal('0.00'), 'debit': Decimal('0.00'), 'count': 0})
+            entry['credit'] += tx.credit or 0
+            entry['debit'] += tx.debit or 0
+            entry['count'] += 1
+        return totals
+
+    def test_100_upload_builds_totals(self):
+        """An upload writes a total for each month and category"""
+        self.assertEqual(sorted(CategoryMonthlyTotal.objects.values_list('month', 'category', 'credit', 'count')),
+                         [(date(2025, 1, 1), 'Sale', Decimal('10.00'), 1),
+                          (date(2025, 1, 1), 'Sponsorship', Decimal('100.00'), 1),
+                          (date(2025, 2, 1), 'Advertisement', Decimal('0.00'), 1),
+                          (date(2025, 2, 1), 'Sale', Decimal('5.00'), 1),
+                          (date(2025, 3, 1), 'Sale', Decimal('7.00'), 1)])
+
+    def test_110_edit_and_split_update_totals(self):
+        """Editing the category, adding a split and deleting a transaction keep the totals current"""
+        tx = Transaction.objects.get(name='Mr Jones')
+        tx.category = 'Sponsorship'
+        tx.save()
+        Transaction.objects.create(account=self.account, parent=tx, transaction_date=tx.transaction_date,
+                                   category='Sale', credit=Decimal('2.00'))
+        Transaction.objects.get(name='Printers').delete()
+
+        february = CategoryMonthlyTotal.objects.filter(account=self.account, month=date(2025, 2, 1))
+        self.assertEqual(sorted(february.values_list('category', 'parent_category', 'credit')),
+                         [('Sale', 'Sponsorship', Decimal('2.00')), ('Sponsorship', '', Decimal('5.00'))])
+
+    def test_115_single_row_change_applied_incrementally(self):
+        """A change to one row adjusts its month's totals - the same as rebuilding them, without the rebuild"""
+        def rebuilt():
+            totals = sorted(CategoryMonthlyTotal.objects.values_list('month', 'category', 'parent_category', 'credit', 'debit', 'count'))
+            CategoryMonthlyTotal.objects.refresh(self.account, date(2025, 1, 1), date(2025, 3, 31))
+            return totals, sorted(CategoryMonthlyTotal.objects.values_list('month', 'category', 'parent_category', 'credit', 'debit', 'count'))
+
+        tx = Transaction.objects.get(name='Mr Smith')
+        tx.transaction_date, tx.credit = date(2025, 2, 20), Decimal('12.00')
+        with mock.patch.object(CategoryMonthlyTotal.objects, 'refresh', wraps=CategoryMonthlyTotal.objects.refresh) as refresh:
+            tx.save()
+        refresh.assert_not_called()
+        applied, expected = rebuilt()
+        self.assertEqual(applied, expected)
+        self.assertNotIn((date(2025, 1, 1), 'Sale'), [row[:2] for row in applied])
+
+        # Moving a transaction with splits moves the splits' totals too
+        parent = Transaction.objects.get(name='Mr Jones')
+        Transaction.objects.create(account=self.account, parent=parent, transaction_date=parent.transaction_date,
+                                   category='Sale', credit=Decimal('2.00'))
+        parent.category = 'Sponsorship'
+        parent.save()
+        Transaction.objects.get(name='Printers').delete()
+        applied, expected = rebuilt()
+        self.assertEqual(applied, expected)
+
+    def test_120_part_months_match_transactions(self):
+        """Periods made up of whole and part months give the same totals as the transactions"""
+        for start, end in [(date(2025, 1, 1), date(2025, 3, 31)),
+                           (date(2025, 1, 15), date(2025, 3, 2)),
+                           (date(2025, 1, 31), date(2025, 2, 1)),
+                           (date(2025, 2, 2), date(2025, 2, 28)),
+                           (date(2025, 2, 1), date(2025, 2, 28))]:
+            with self.subTest(start=start, end=end):
+                self.assertEqual(CategoryMonthlyTotal.objects.totals(self.account, start, end), self.raw_totals(start, end))
+
+    def test_125_income_expenditure(self):
+        """Income and expenditure count the statement rows and not their splits"""
+        tx = Transaction.objects.get(name='Mr Jones')
+        Transaction.objects.create(account=self.account, parent=tx, transaction_date=tx.transaction_date,
+                                   category='Sponsorship', credit=Decimal('2.00'))
+
+        self.assertEqual(CategoryMonthlyTotal.objects.income_expenditure(self.account, date(2025, 1, 15), date(2025, 3, 2)),
+                         {'Sponsorship': (Decimal('100.00'), Decimal('0.00')),
+                          'Sale': (Decimal('5.00'), Decimal('0.00')),
+                          'Advertisement': (Decimal('0.00'), Decimal('20.00'))})
+
+    def test_130_report_data(self):
+        """The report figures are built from the category totals - in a fixed number of queries"""
+        report = FlexibleReport({'account_selection': self.account.id, 'report_type': 'custom',
+                                 'start_date': date(2025, 1, 5), 'end_date': date(2025, 2, 28)})
+        report._start_date, report._end_date = date(2025, 1, 5), date(2025, 2, 28)
+        report.prepare_report()
+        with self.assertNumQueries(3):
+            report.get_report_data()
+
+        self.assertEqual(report.context['income'], {'Sponsorship': (Decimal('100.00'), ''), 'Sale': (Decimal('15.00'), '')})
+        self.assertEqual(report.context['income_total'], Decimal('115.00'))
+        self.assertEqual(report.context['expenditure'], {'Advertisement': (Decimal('20.00'), None)})
+        self.assertEqual(report.context['expenditure_total'], Decimal('20.00'))
+
+    def test_140_sponsors_and_details(self):
+        """The main sponsors and split details are gathered from the period's transactions"""
+        tx = Transaction.objects.get(name='Big Company')
+        Transaction.objects.create(account=self.account, parent=tx, transaction_date=tx.transaction_date,
+                                   category='Sale', credit=Decimal('30.00'))
+        report = FlexibleReport({'account_selection': self.account.id, 'report_type': 'custom',
+                                 'start_date': date(2025, 1, 1), 'end_date': date(2025, 3, 31)})
+        report._start_date, report._end_date = date(2025, 1, 1), date(2025, 3, 31)
+        report.prepare_report()
+        report.get_report_data()
+
+        self.assertEqual(report.context['main_sponsors'], [{'name': 'Big Company', 'total': Decimal('100.00')}])
+        self.assertEqual([(row['parent__category'], row['category'], row['credit']) for row in report.context['income_details']],
+                         [('Sponsorship', 'Sale', Decimal('30.00'))])
+        self.assertEqual(report.context['expenditure_details'], [])
+
+    def test_150_carried_over(self):
+        """The balances either side of the previous period are carried over"""
+        report = FinancialSummary({'account_selection': self.account.id})
+        report._start_date, report._end_date = date(2025, 3, 1), date(2025, 3, 31)
+        report._prev_start_date, report._prev_end_date = date(2025, 2, 1), date(2025, 2, 28)
+        report.get_report_data()
+
+        self.assertEqual(report.context['carried_over'], (Decimal('95.00'), Decimal('110.00')))
+        self.assertEqual(report.context['income'], {'Sale': (Decimal('7.00'), Decimal('5.00'))})
+        self.assertEqual(report.context['income_total'], Decimal('102.00'))
+
+    def test_160_closed_period_cached(self):
+        """A report for a closed period is rendered once - until the account's transactions change"""
+        cache.clear()
+
+        def report():
+            inst = FlexibleReport({'account_selection': self.account.id, 'report_type': 'custom',
+                                   'start_date': date(2025, 1, 1), 'end_date': date(2025, 3, 31)})
+            inst._start_date, inst._end_date = date(2025, 1, 1), date(2025, 3, 31)
+            inst.prepare_report()
+            return inst
+
+        first = report().get_report()
+        with self.assertNumQueries(1):
+            self.assertEqual(report().get_report(), first)
+        with self.assertNumQueries(1):
+            self.assertEqual(report().get_pdf(lambda html: html.encode()), first.encode())
+
+        tx = Transaction.objects.get(name='Mr Jones')
+        tx.category = 'Sponsorship'
+        tx.save()
+        self.assertNotEqual(report().get_report(), first)
+
+    def test_165_financial_years_in_key(self):
+        """A cached report isn't used once the financial years change - or for a different period"""
+        def report(end):
+            inst = FlexibleReport({'account_selection': self.account.id, 'report_type': 'custom',
+                                   'start_date': date(2025, 1, 1), 'end_date': date(2025, 3, 31)})
+            inst._start_date, inst._end_date = date(2025, 1, 1), end
+            return inst
+
+        key = report(date(2025, 3, 31)).cache_key('html')
+        self.assertNotEqual(report(date(2025, 2, 28)).cache_key('html'), key)
+        FinancialYear.objects.create_from_year(2024)
+        self.assertNotEqual(report(date(2025, 3, 31)).cache_key('html'), key)
+
+    def test_170_open_period_not_cached(self):
+        """A report for a period which hasn't ended is always rebuilt"""
+        inst = FlexibleReport({'account_selection': self.account.id, 'report_type': 'custom',
+                               'start_date': date(2025, 1, 1), 'end_date': date.today()})
+        inst._start_date, inst._end_date = date(2025, 1, 1), date.today()
+        self.assertIsNone(inst.cache_key('html'))
+
+
+class ComparativeReportTests(TestCase):
+    fixtures = ['account_test_categories.json', 'test_bank_account.json']
+
+    def setUp(self):
+        self.account = Account.objects.get(bank_name="Floyd's Bank")
+        self.treasurer = get_user_model().objects.create_user(email='treasurer@test.com', password='wibble')
+        for calendar_year in (2021, 2022, 2023):
+            FinancialYear.objects.create_from_year(calendar_year)
+        rows = [(date(2021, 11, 10), 'Mr Smith', '', '10.00', '10.00', 'Sale'),
+                (date(2022, 3, 15), 'Big Company', '', '100.00', '110.00', 'Sponsorship'),
+                (date(2022, 10, 1), 'Mr Jones', '', '5.00', '115.00', 'Sale'),
+                (date(2023, 2, 14), 'Printers', '20.00', '', '95.00', 'Advertisement'),
+                (date(2023, 9, 30), 'Big Company', '', '50.00', '145.00', 'Sponsorship'),
+                (date(2023, 12, 3), 'Mrs Smith', '', '7.00', '152.00', 'Sale')]
+        TransactionImporter(self.account, self.treasurer).import_file(csv_file(rows))
+
+    def report(self, year='2023-2024', span=3):
+        inst = ComparativeReport({'account_selection': self.account.id, 'type_selection': 'comparative',
+                                  'year_selection': year, 'span': span})
+        inst.prepare_report()
+        return inst
+
+    def test_200_by_period(self):
+        """The income and expenditure for each period - whole and part months alike"""
+        periods = {'first': (date(2021, 10, 1), date(2022, 9, 30)),
+                   'part': (date(2022, 10, 1), date(2023, 2, 20))}
+        with self.assertNumQueries(1):
+            summary = CategoryMonthlyTotal.objects.by_period(self.account, periods)
+
+        self.assertEqual(summary, {'Sale': {'first': (Decimal('10.00'), Decimal('0.00')), 'part': (Decimal('5.00'), Decimal('0.00'))},
+                                   'Sponsorship': {'first': (Decimal('100.00'), Decimal('0.00'))},
+                                   'Advertisement': {'part': (Decimal('0.00'), Decimal('20.00'))}})
+
+    def test_210_years_side_by_side(self):
+        """Each category has a column for each financial year - from one query"""
+        report = self.report()
+        with self.assertNumQueries(1):
+            report.get_report_data()
+
+        self.assertEqual(report.context['year_columns'], ['2021-2022', '2022-2023', '2023-2024'])
+        self.assertEqual(report.context['income'], {'Sale': [Decimal('10.00'), Decimal('5.00'), Decimal('7.00')],
+                                                    'Sponsorship': [Decimal('100.00'), Decimal('50.00'), None]})
+        self.assertEqual(report.context['income_totals'], [Decimal('110.00'), Decimal('55.00'), Decimal('7.00')])
+        self.assertEqual(report.context['expenditure'], {'Advertisement': [None, Decimal('20.00'), None]})
+        self.assertEqual(report.context['surplus'], [Decimal('110.00'), Decimal('35.00'), Decimal('7.00')])
+
+    def test_220_span(self):
+        """The report covers the chosen number of years up to the selected year"""
+        report = self.report(year='2022-2023', span=5)
+        self.assertEqual(report.context['year_columns'], ['2021-2022', '2022-2023'])
+        self.assertEqual((report.context['start_date'], report.context['end_date']), (date(2021, 10, 1), date(2023, 9, 30)))
+
+        report.get_report_data()
+        self.assertEqual([table[1] for table in report.get_tables()], [['Category', '2021-2022', '2022-2023']] * 3)
+        self.assertIn('Sponsorship', report.get_rendered_report())
@@ -0,0 +1,163 @@
+"""
+Tests of the statement formats - each parsed into the same rows, and imported through the same pipeline.
+"""
+import importlib
+from datetime import date
+from decimal import Decimal
+
+from django.apps import apps
+from django.contrib.auth import get_user_model
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase
+
+from Accounts.models import Account, Transaction, UploadError
+from Accounts.services.importer import TransactionImporter
+from Accounts.services.statement_formats import StatementRow, UploadRejected, statement_format
+
+OFX = b"""OFXHEADER:100
+DATA:OFXSGML
+VERSION:102
+
+<OFX>
+<BANKMSGSRSV1><STMTTRNRS><STMTRS>
+<CURDEF>GBP
+<BANKTRANLIST>
+<DTSTART>20250101
+<DTEND>20250131
+<STMTTRN>
+<TRNTYPE>CREDIT
+<DTPOSTED>20250110120000[0:GMT]
+<TRNAMT>10.00
+<FITID>1
+<NAME>MR SMITH
+<MEMO>STALL
+</STMTTRN>
+<STMTTRN>
+<TRNTYPE>DEBIT
+<DTPOSTED>20250114
+<TRNAMT>-1,020.50
+<FITID>2
+<NAME>PRINTERS LTD
+</STMTTRN>
+</BANKTRANLIST>
+<LEDGERBAL>
+<BALAMT>989.50
+<DTASOF>20250131
+</LEDGERBAL>
+</STMTRS></STMTTRNRS></BANKMSGSRSV1>
+</OFX>
+"""
+
+QIF = b"""!Type:Bank
+D10/01'25
+T10.00
+PMr Smith
+LSale
+^
+D14/01/2025
+T-20.50
+PPrinters Ltd
+MPosters
+L[Savings]
+^
+"""
+
+CAMT = b"""<?xml version="1.0" encoding="UTF-8"?>
+<Document xmlns="urn:iso:std:iso:20022:tech:xsd:camt.053.001.02">
+<BkToCstmrStmt><Stmt>
+  <Bal><Tp><CdOrPrtry><Cd>OPBD</Cd></CdOrPrtry></Tp><Amt Ccy="GBP">100.00</Amt><CdtDbtInd>CRDT</CdtDbtInd></Bal>
+  <Bal><Tp><CdOrPrtry><Cd>CLBD</Cd></CdOrPrtry></Tp><Amt Ccy="GBP">89.50</Amt><CdtDbtInd>CRDT</CdtDbtInd></Bal>
+  <Ntry><Amt Ccy="GBP">10.00</Amt><CdtDbtInd>CRDT</CdtDbtInd><Sts>BOOK</Sts><BookgDt><Dt>2025-01-10</Dt></BookgDt>
+    <NtryDtls><TxDtls><RltdPties><Dbtr><Nm>Mr Smith</Nm></Dbtr></RltdPties><RmtInf><Ustrd>Stall</Ustrd></RmtInf></TxDtls></NtryDtls></Ntry>
+  <Ntry><Amt Ccy="GBP">20.50</Amt><CdtDbtInd>DBIT</CdtDbtInd><Sts>BOOK</Sts><BookgDt><Dt>2025-01-14</Dt></BookgDt>
+    <AddtlNtryInf>Printers Ltd</AddtlNtryInf></Ntry>
+  <Ntry><Amt Ccy="GBP">5.00</Amt><CdtDbtInd>CRDT</CdtDbtInd><Sts>PDNG</Sts><BookgDt><Dt>2025-01-15</Dt></BookgDt></Ntry>
+</Stmt></BkToCstmrStmt>
+</Document>
+"""
+
+
+def parse(content:bytes, name:str) -> list[StatementRow]:
+    upload = SimpleUploadedFile(name, content)
+    return list(statement_format(upload, name).parse(upload, name))
+
+
+class StatementFormatTests(TestCase):
+    fixtures = ['account_test_categories.json', 'test_bank_account.json']
+
+    def test_100_recognised(self):
+        """The format is recognised from the content - whatever the file is called"""
+        for content, expected in [(OFX, 'ofx'), (QIF, 'qif'), (CAMT, 'camt'), (b'Transaction Date,Balance\n', 'csv')]:
+            with self.subTest(expected=expected):
+                self.assertEqual(statement_format(SimpleUploadedFile('download.txt', content), 'download.txt').name, expected)
+
+    def test_110_ofx(self):
+        """The balances are worked back from the closing balance"""
+        self.assertEqual(parse(OFX, 'statement.ofx'),
+                         [StatementRow(date(2025, 1, 10), 'MR SMITH STALL', Decimal('0'), Decimal('10.00'), Decimal('2010.00'), ''),
+                          StatementRow(date(2025, 1, 14), 'PRINTERS LTD', Decimal('1020.50'), Decimal('0'), Decimal('989.50'), '')])
+
+    def test_120_qif(self):
+        """QIF dates in either style are read - and transfers aren't categories"""
+        self.assertEqual(parse(QIF, 'statement.qif'),
+                         [StatementRow(date(2025, 1, 10), 'Mr Smith', Decimal('0'), Decimal('10.00'), None, 'Sale'),
+                          StatementRow(date(2025, 1, 14), 'Printers Ltd Posters', Decimal('20.50'), Decimal('0'), None, '')])
+
+    def test_130_camt(self):
+        """The balances are worked forward from the opening balance - and pending entries are left out"""
+        self.assertEqual(parse(CAMT, 'statement.xml'),
+                         [StatementRow(date(2025, 1, 10), 'Mr Smith Stall', Decimal('0'), Decimal('10.00'), Decimal('110.00'), ''),
+                          StatementRow(date(2025, 1, 14), 'Printers Ltd', Decimal('20.50'), Decimal('0'), Decimal('89.50'), '')])
+
+    def test_140_invalid(self):
+        with self.assertRaisesRegex(UploadRejected, 'Invalid data in the transaction ending on line 4 of statement.qif : Invalid amount wibble'):
+            parse(b'!Type:Bank\nD10/01/2025\nTwibble\n^\n', 'statement.qif')
+        with self.assertRaisesRegex(UploadRejected, 'Invalid camt.053 statement'):
+            parse(CAMT[:300], 'statement.xml')
+
+    def test_150_imported_alike(self):
+        """Each format is imported through the same pipeline - validated, deduplicated and written"""
+        account = Account.objects.get(bank_name="Floyd's Bank")
+        treasurer = get_user_model().objects.create_user(email='treasurer@test.com', password='wibble')
+        importer = TransactionImporter(account, treasurer)
+
+        importer.import_file(SimpleUploadedFile('statement.qif', QIF))
+        self.assertEqual((importer.row_count, importer.error_count), (2, 1))
+        self.assertEqual(UploadError.objects.get().transaction.name, 'Printers Ltd Posters')
+
+        # The same statement again is recognised as already uploaded
+        with self.assertRaisesRegex(UploadRejected, 'Transactions already uploaded'):
+            TransactionImporter(account, treasurer).import_file(SimpleUploadedFile('statement.qif', QIF))
+        self.assertEqual(Transaction.objects.count(), 2)
+
+    def test_160_identical_rows(self):
+        """Two equal payments on the same day in a statement without balances are both imported - once"""
+        account = Account.objects.get(bank_name="Floyd's Bank")
+        treasurer = get_user_model().objects.create_user(email='treasurer@test.com', password='wibble')
+        twice = QIF + b"D14/01/2025\nT-20.50\nPPrinters Ltd\nMPosters\nL[Savings]\n^\n"
+
+        TransactionImporter(account, treasurer).import_file(SimpleUploadedFile('statement.qif', twice))
+        self.assertEqual(Transaction.objects.filter(name='Printers Ltd Posters').count(), 2)
+
+        with self.assertRaisesRegex(UploadRejected, 'Transactions already uploaded'):
+            TransactionImporter(account, treasurer).import_file(SimpleUploadedFile('statement.qif', twice))
+
+        # The same rows in another account are that account's own transactions
+        other = Account.objects.create(bank_name='Other Bank', sort_code='11-11-11', account_number='87654321',
+                                       starting_balance=Decimal('0'))
+        TransactionImporter(other, treasurer).import_file(SimpleUploadedFile('statement.qif', twice))
+        self.assertEqual(Transaction.objects.filter(account=other).count(), 3)
+
+    def test_170_existing_rows_fingerprinted(self):
+        """Identical rows already in the database are each given their own fingerprint when the fingerprints are added"""
+        migration = importlib.import_module('Accounts.migrations.0026_transaction_fingerprint')
+        account = Account.objects.get(bank_name="Floyd's Bank")
+        Transaction.objects.bulk_create([Transaction(account=account, transaction_date=date(2025, 1, 14), tx_number=number,
+                                                     description=description, debit=Decimal('20.50'), credit=None)
+                                         for number, description in ((1, 'Printers'), (2, 'Printers '), (3, 'Printers'))])
+
+        migration.set_fingerprint(apps, None)
+        fingerprints = list(Transaction.objects.order_by('tx_number').values_list('fingerprint', flat=True))
+        self.assertEqual(fingerprints, [Transaction.make_fingerprint(account.id, date(2025, 1, 14), 'Printers',
+                                                                     Decimal('20.50'), None, None, occurrence)
+                                        for occurrence in range(3)])
@@ -0,0 +1,138 @@
+"""
+Tests of the paging of the transaction list, and the split totals it shows - without a browser.
+"""
+from datetime import date, timedelta as td
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from Accounts.models import Account, Categories, Transaction
+from Accounts.services.importer import TransactionImporter
+
+from .test_importer import csv_file
+
+
+class TransactionListTests(TestCase):
+    fixtures = ['account_test_categories.json', 'test_bank_account.json']
+
+    def setUp(self):
+        self.account = Account.objects.get(bank_name="Floyd's Bank")
+        self.treasurer = get_user_model().objects.create_superuser(email='treasurer@test.com', password='wibble')
+        start = date.today() - td(days=100)
+        rows = [(start + td(days=index // 2), f'Mr Smith {index}', '', '1.00', f'{index + 1}.00', 'Sale') for index in range(25)]
+        TransactionImporter(self.account, self.treasurer).import_file(csv_file(rows))
+        self.ordered = list(Transaction.objects.order_by('transaction_date', 'id').values_list('id', flat=True))
+        self.url = reverse('Account:TransactionList', kwargs={'account_id': self.account.id})
+        self.client.force_login(self.treasurer)
+
+    def page_ids(self, response):
+        return [tx.id for tx in response.context['page_obj']]
+
+    def test_100_first_page(self):
+        response = self.client.get(self.url)
+        page = response.context['page_obj']
+        self.assertEqual(self.page_ids(response), self.ordered[:10])
+        self.assertFalse(page.has_previous())
+        self.assertTrue(page.has_next())
+
+    def test_110_next_and_previous(self):
+        """Pages follow on from the cursor - across transactions on the same date"""
+        first = self.client.get(self.url).context['page_obj']
+        second = self.client.get(self.url, {'after': first.next_cursor()}).context['page_obj']
+        self.assertEqual([tx.id for tx in second], self.ordered[10:20])
+
+        third = self.client.get(self.url, {'after': second.next_cursor()}).context['page_obj']
+        self.assertEqual([tx.id for tx in third], self.ordered[20:])
+        self.assertFalse(third.has_next())
+
+        back = self.client.get(self.url, {'before': third.previous_cursor()}).context['page_obj']
+        self.assertEqual([tx.id for tx in back], self.ordered[10:20])
+        self.assertTrue(back.has_previous())
+
+    def test_120_last_page(self):
+        page = self.client.get(self.url, {'last': ''}).context['page_obj']
+        self.assertEqual([tx.id for tx in page], self.ordered[-10:])
+        self.assertFalse(page.has_next())
+
+    def test_130_invalid_cursor(self):
+        self.assertEqual(self.client.get(self.url, {'after': 'wibble'}).status_code, 400)
+
+    def test_140_splittable_flag(self):
+        """Only transactions in a category with sub-categories can be split"""
+        Categories.objects.create(category_name='Stall', parent=Categories.objects.get(category_name='Sale'))
+        Transaction.objects.filter(id=self.ordered[1]).update(category='Sponsorship')
+
+        page = self.client.get(self.url).context['page_obj']
+        self.assertEqual([tx.splittable for tx in page][:3], [True, False, True])
+
+    def test_150_page_queries(self):
+        """A page costs a fixed number of queries - however many of its transactions are split"""
+        cursor = self.client.get(self.url).context['page_obj'].next_cursor()
+        with CaptureQueriesContext(connection) as unsplit:
+            self.client.get(self.url, {'after': cursor})
+
+        for tx_id in self.ordered[10:20]:
+            Transaction.objects.create(account=self.account, parent_id=tx_id, transaction_date=date.today(),
+                                       category='Sale', credit=1)
+        with self.assertNumQueries(len(unsplit)):
+            self.client.get(self.url, {'after': cursor})
+
+
+class SplitTotalTests(TestCase):
+    fixtures = ['account_test_categories.json', 'test_bank_account.json']
+
+    def setUp(self):
+        self.account = Account.objects.get(bank_name="Floyd's Bank")
+        self.treasurer = get_user_model().objects.create_superuser(email='treasurer@test.com', password='wibble')
+        rows = [(date(2025, 1, 10), 'Mr Smith', '', '10.00', '10.00', 'Sale'),
+                (date(2025, 1, 31), 'Printers', '20.00', '', '-10.00', 'Advertisement')]
+        TransactionImporter(self.account, self.treasurer).import_file(csv_file(rows))
+        self.api = reverse('Account:delete_transaction', kwargs={'transaction_id': 0}).removesuffix('delete_transaction/0/')
+        self.client.force_login(self.treasurer)
+
+    def remaining(self, name):
+        tx = Transaction.details.bank_only().get(name=name)
+        return tx.remaining_credit, tx.remaining_debit
+
+    def test_100_splits_maintain_totals(self):
+        """Adding, editing and deleting splits through the api keep the parent's totals current"""
+        sale = Transaction.objects.get(name='Mr Smith')
+        response = self.client.put(f'{self.api}add_split/{sale.id}/',
+                                   {'category': 'Stall', 'credit': '4.00'}, content_type='application/json')
+        split_id = response.json()['id']
+        self.client.put(f'{self.api}add_split/{sale.id}/',
+                        {'category': 'Stall', 'credit': '1.50'}, content_type='application/json')
+        self.assertEqual(self.remaining('Mr Smith'), (Decimal('4.50'), Decimal('0.00')))
+
+        self.client.put(f'{self.api}edit_split/{split_id}/',
+                        {'category': 'Stall', 'credit': '6.00'}, content_type='application/json')
+        self.assertEqual(self.remaining('Mr Smith'), (Decimal('2.50'), Decimal('0.00')))
+
+        self.client.put(f'{self.api}delete_transaction/{split_id}/',
+                        content_type='application/json')
+        self.assertEqual(self.remaining('Mr Smith'), (Decimal('8.50'), Decimal('0.00')))
+        self.assertEqual(self.remaining('Printers'), (Decimal('0.00'), Decimal('20.00')))
+
+    def test_110_saving_parent_keeps_totals(self):
+        """Saving a parent loaded before its splits changed doesn't lose the totals"""
+        stale = Transaction.objects.get(name='Mr Smith')
+        Transaction.objects.create(account=self.account, parent_id=stale.id, transaction_date=stale.transaction_date,
+                                   category='Sale', credit=Decimal('3.00'))
+        stale.name = 'Mr J Smith'
+        stale.save()
+        self.assertEqual(self.remaining('Mr J Smith'), (Decimal('7.00'), Decimal('0.00')))
+
+    def test_120_rebuild_command(self):
+        """The rebuild command recalculates totals which have drifted"""
+        sale = Transaction.objects.get(name='Mr Smith')
+        Transaction.objects.create(account=self.account, parent=sale, transaction_date=sale.transaction_date,
+                                   category='Sale', credit=Decimal('3.00'))
+        Transaction.objects.filter(id=sale.id).update(split_credit_total=Decimal('0.00'))
+
+        call_command('RebuildSplitTotals', account=[self.account.id], verbosity=0)
+        self.assertEqual(self.remaining('Mr Smith'), (Decimal('7.00'), Decimal('0.00')))
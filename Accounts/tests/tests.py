@@ -21,6 +21,7 @@ from .utils import UploadMixin
 from GarageSale.tests.common import SmartHTMLTestMixins, SeleniumCommonMixin, IdentifyMixin
 
 from Accounts.models import Account, FinancialYear, Transaction, UploadHistory, UploadError, Categories
+from Accounts.services.numbering import number_gap
 
 root_screenshot_directory = Path('./testing_screenshots')
 
@@ -118,9 +119,9 @@ class AccountUploadTests(UploadMixin, SmartHTMLTestMixins, IdentifyMixin, Seleni
             first_tx, last_tx = (Transaction.objects.order_by('transaction_date').first(),
                                             Transaction.objects.order_by('transaction_date').last() )
             self.assertEqual(first_tx.transaction_date, range_start)
-            self.assertEqual(first_tx.tx_number, 1)
+            self.assertEqual(first_tx.tx_number, number_gap())
             self.assertEqual(last_tx.transaction_date, range_end)
-            self.assertEqual(last_tx.tx_number, 2)
+            self.assertEqual(last_tx.tx_number, 2 * number_gap())
 
             WebDriverWait(self.selenium, timeout=5).until(
                 lambda _: self.selenium.find_element(By.CSS_SELECTOR, 'div#details').is_displayed())
@@ -129,11 +130,11 @@ class AccountUploadTests(UploadMixin, SmartHTMLTestMixins, IdentifyMixin, Seleni
             self._upload_data(batch_A)
             self.assertEqual(Transaction.objects.count(), 4)
             tx_numbers = Transaction.objects.order_by('transaction_date').values_list('tx_number', flat=True)
-            self.assertEqual(list(tx_numbers), list(range(1,5)))
+            self.assertEqual(list(tx_numbers), [1, 2, number_gap(), 2 * number_gap()])
 
             second_range_start, second_range_end = batch_A.range()
             self.assertEqual(UploadHistory.objects.count(), 2)
-            self.assertEqual(self.account.last_transaction_number, 4)
+            self.assertEqual(self.account.last_transaction_number, 2 * number_gap())
 
     def test_965_upload_ACB(self):
         """Test a scenario where we upload in the order A C B -
@@ -156,10 +157,11 @@ class AccountUploadTests(UploadMixin, SmartHTMLTestMixins, IdentifyMixin, Seleni
             self._upload_data(batch_b)
             self.assertEqual(Transaction.objects.count(), 6)
             tx_numbers = Transaction.objects.order_by('transaction_date').values_list('tx_number', flat=True)
-            self.assertEqual(list(tx_numbers), list(range(1,7)))
+            gap = number_gap()
+            self.assertEqual(list(tx_numbers), [gap, 2 * gap, 2 * gap + 1, 2 * gap + 2, 3 * gap, 4 * gap])
 
             self.assertEqual(UploadHistory.objects.count(), 3)
-            self.assertEqual(self.account.last_transaction_number, 6)
+            self.assertEqual(self.account.last_transaction_number, 4 * gap)
 
 class UploadErrorPageTests(UploadMixin, IdentifyMixin,SmartHTMLTestMixins, SeleniumCommonMixin):
     """Pre-load the DB with known upload errors and ensure that the right errors are listed on the page"""
@@ -20,7 +20,6 @@ class UploadMixin(SeleniumCommonMixin):
         remove = remove or set()
         with TestFileContent(content=data, remove=remove) as f:
             self.selenium.get(self.live_server_url + reverse('Account:upload_transactions'))
-            last_tx = self.account.last_transaction_number
             select_element = self.selenium.find_element(By.ID, 'id_account')
             select = Select(select_element)
             select.select_by_value(str(self.account.id))
@@ -50,7 +49,11 @@ class UploadMixin(SeleniumCommonMixin):
             tx = Transaction.objects.filter(account=self.account, upload_history=uh)
             self.assertEqual(len(tx), len(f))
             self.account.refresh_from_db()
-            self.assertEqual(self.account.last_transaction_number, last_tx + len(f))
+
+            # Every statement row has its own number - in date order
+            tx_numbers = list(Transaction.objects.filter(account=self.account, parent__isnull=True).
+                                    order_by('transaction_date', 'tx_number').values_list('tx_number', flat=True))
+            self.assertEqual(tx_numbers, sorted(set(tx_numbers)))
 
             # Test the upload history was created
             if not expect_error_count:
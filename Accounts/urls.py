@@ -8,12 +8,15 @@ app_name = "Account"
 urlpatterns = [
     path('', views.EntryPoint, name='EntryPoint'),
     path('upload/', views.upload_transactions, name='upload_transactions'),
+    path('upload/job/<int:job_id>/', views.import_job, name='ImportJob'),
     path('uploadErrors/', views.UploadErrorList.as_view(), name='UploadErrorList'),
     path('uploadErrors/<int:account_id>/', views.UploadErrorList.as_view(), name='UploadErrorList'),
     path('uploadErrors/<int:account_id>/<int:upload_id>/', views.UploadErrorList.as_view(), name='UploadErrorList'),
 
     path('report/transactions/', views.TransactionList.as_view(), name='TransactionList'),
     path('report/transactions/<int:account_id>/', views.TransactionList.as_view(), name='TransactionList'),
+    path('report/ledger/', views.LedgerHealth.as_view(), name='LedgerHealth'),
+    path('report/ledger/<int:account_id>/', views.LedgerHealth.as_view(), name='LedgerHealth'),
 
     path('financialyear/', views.FinancialYearList.as_view(), name='FinancialYearList'),
     path('financialyear/view/<str:fy>/',views.FinancialYearDetail.as_view(), name='FinancialYearDetail'),
@@ -33,5 +36,7 @@ urlpatterns = [
     path('edit_transaction/<int:transaction_id>/', views.restapi.edit_transaction, name='edit_transaction'),
     path('edit_split/<int:transaction_id>/', views.restapi.edit_split, name='edit_split'),
     path('add_split/<int:transaction_id>/', views.restapi.add_split, name='edit_split'),
-    path( 'delete_transaction/<int:transaction_id>/', views.restapi.delete_transaction, name='delete_transaction')
+    path( 'delete_transaction/<int:transaction_id>/', views.restapi.delete_transaction, name='delete_transaction'),
+    path('batch_edit/<int:account_id>/', views.restapi.batch_edit, name='batch_edit'),
+    path('import_progress/<int:job_id>/', views.restapi.import_progress, name='import_progress'),
 ]
\ No newline at end of file
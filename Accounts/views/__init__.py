@@ -1,4 +1,4 @@
 from .financialyear import FinancialYearList, FinancialYearClose, FinancialYearEdit, FinancialYearDetail, FinancialYearCreate
 from .category import category_list
-from .views import EntryPoint, upload_transactions, UploadErrorList, TransactionList, FinancialReport
+from .views import EntryPoint, upload_transactions, import_job, UploadErrorList, TransactionList, LedgerHealth, FinancialReport
 from . import restapi
\ No newline at end of file
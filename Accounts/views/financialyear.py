@@ -1,5 +1,6 @@
 from datetime import date, timedelta
 
+from django.db import transaction
 from django.shortcuts import redirect
 from django.template.response import TemplateResponse
 from django.templatetags.static import static
@@ -98,12 +99,16 @@ class FinancialYearCreate(CreateView):
         form = self.get_form()
         if form.is_valid():
             start, end = form.cleaned_data['year_start'], form.cleaned_data['year_end']
-            years_overlap = FinancialYear.objects.overlap(start, end)
-            if years_overlap.count() > 0:
+            with transaction.atomic():
+                # Lock the existing years - so a second request (or a double submit) checks after this one has created its year
+                list(FinancialYear.objects.select_for_update().values_list('id', flat=True))
+                years_overlap = FinancialYear.objects.overlap(start, end)
+                if not years_overlap:
+                    obj = FinancialYear.objects.create(year=form.cleaned_data['year'], year_start=start, year_end=end, active=False)
+            if years_overlap:
                 form.add_error('', 'Dates overlap 1 or more existing Financial Years')
                 return TemplateResponse(request=self.request, template='FinancialYear/FinancialYearEdit.html', context={'form':form})
             else:
-                obj = FinancialYear.objects.create(year=form.cleaned_data['year'], year_start=start, year_end=end, active=False)
                 return redirect(request=request, to=reverse('Account:FinancialYearList'))
         else:
             return TemplateResponse(request=self.request, template='FinancialYear/FinancialYearEdit.html', context={'form': form})
@@ -1,13 +1,17 @@
+import hashlib
 from datetime import datetime, date, timedelta as td
 from decimal import Decimal
-from typing import Tuple
+from typing import Callable, Tuple
 
-from django.db.models import Sum, Q
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q, OuterRef, Subquery
 from django.http import HttpRequest
 from django.template.loader import get_template
 from django.urls import reverse
 
-from Accounts.models import FinancialYear, PublishedReports, Transaction, Account
+from Accounts.models import PublishedReports, Transaction, Account, CategoryMonthlyTotal, CacheVersion, FINANCIAL_YEAR_VERSION_KEY
+from Accounts.services.financial_years import financial_years
 
 
 # For Python 3.12
@@ -25,6 +29,7 @@ class Report:
         self._end_date = None
         self._prev_start_date, self._prev_end_date = None, None
         self._carried_over = True
+        self._versions = None
         self._context |= {'warnings': [], 'operations':[]}
 
     @property
@@ -43,50 +48,140 @@ class Report:
         """Return the name of the file to be saved"""
         return '', ''
 
+    @staticmethod
+    def _ranked(summary:dict, index:int) -> dict:
+        """The income (0) or expenditure (1) for each category which has any - largest first"""
+        return dict(sorted(((category, amounts[index]) for category, amounts in summary.items() if amounts[index] > 0),
+                           key=lambda item: item[1], reverse=True))
+
+    def _sponsors_and_details(self):
+        """The main sponsors and the split details - from one pass over the transactions for the period"""
+        sponsors, income_details, expenditure_details = {}, [], []
+        rows = (self._context['this_period'].
+                    filter(Q(parent__isnull=False) | Q(parent__isnull=True, credit__gt=0, category='Sponsorship')).
+                    values('name', 'parent_id', 'parent__category', 'category', 'debit', 'credit'))
+        for row in rows:
+            if row['parent_id'] is None:
+                sponsors[row['name']] = sponsors.get(row['name'], Decimal('0.00')) + row['credit']
+                continue
+            if row['credit'] is not None:
+                income_details.append(row)
+            if row['debit'] is not None:
+                expenditure_details.append(row)
+
+        main_sponsors = [{'name': name, 'total': total}
+                                for name, total in sorted(sponsors.items(), key=lambda item: item[1], reverse=True)[:5]]
+        return main_sponsors, income_details, expenditure_details
+
     def get_report_data(self):
         """Fetch the data for the yearly report and return the rendered HTML"""
 
-        previous_income = {i['category']:i['income'] for i in self._context['previous_period'].filter(credit__gt = 0).values('category').
-                                                    annotate(income=Sum('credit'))} if self._context['previous_period'] else {}
-        previous_expenditure =  {i['category']: i['expenditure'] for i in self._context['previous_period'].filter(debit__gt=0).
-                                    values('category').annotate(expenditure=Sum('debit'))} if self._context['previous_period'] else {}
+        income = self._ranked(self._context['this_period_totals'], 0)
+        expenditure = self._ranked(self._context['this_period_totals'], 1)
+
+        previous_totals = self._context['previous_period_totals']
+        previous_income = self._ranked(previous_totals, 0) if previous_totals is not None else {}
+        previous_expenditure = self._ranked(previous_totals, 1) if previous_totals is not None else {}
+
+        main_sponsors, income_details, expenditure_details = self._sponsors_and_details()
+
         self._context |= {
             'full_data': self._context['this_period'],
-            'income': {i['category']: (i['income'], previous_income.get(i['category'],'') )
-                                                    for i in self._context['this_period'].filter(parent__isnull=True,
-                                                            credit__gt =0).values('category').
-                                                            annotate(income=Sum('credit')).order_by('-income')},
-            'income_total': (income if (income := self._context['this_period'].filter(parent__isnull=True, credit__gt =0).aggregate(
-                                        income=Sum('credit'))['income']) else Decimal("0.0") )+
+            'income': {category: (amount, previous_income.get(category, '')) for category, amount in income.items()},
+            'income_total': sum(income.values(), Decimal("0.0")) +
                                 (self._context['carried_over'][0] if self._carried_over and self._context['carried_over'][0] else Decimal('0.00')),
 
-            'expenditure': {i['category']: (i['expenditure'], previous_expenditure.get(i['category'], None))
-                            for i in self._context['this_period'].filter(parent__isnull=True, debit__gt=0).values('category').
-                            annotate(expenditure=Sum('debit')).order_by('-expenditure')},
+            'expenditure': {category: (amount, previous_expenditure.get(category, None)) for category, amount in expenditure.items()},
 
-            'expenditure_total': self._context['this_period'].filter(parent__isnull=True, debit__gt=0).aggregate(
-                                            expenditure=Sum('debit'))['expenditure'],
+            'expenditure_total': sum(expenditure.values()) if expenditure else None,
 
-            "previous_income_total" : (self._context['this_period'].filter(parent__isnull=True,
-                                                    credit__gt =0).aggregate(income=Sum('credit'))['income']
-                                                if self._context['this_period'] else None),
-            "previous_expenditure_total": (self._context['this_period'].filter(parent__isnull=True,
-                                                    credit__gt=0).aggregate(expenditure=Sum('debit'))['expenditure']
-                                               if self._context['this_period'] else None),
+            "previous_income_total" : sum(previous_income.values(), Decimal("0.0")) if previous_totals is not None else None,
+            "previous_expenditure_total": sum(previous_expenditure.values(), Decimal("0.0")) if previous_totals is not None else None,
 
-            'main_sponsors': self._context['this_period'].filter(parent__isnull=True, credit__gt=0, category='Sponsorship').values('name').annotate(total=Sum('credit')).order_by('-total')[:5],
+            'main_sponsors': main_sponsors,
             'summary': self.get_summary(),
         }
 
         # Gather details if any exists :
-        child_tx = self._context['this_period'].filter(parent__isnull=False)
-        self._context |= {'income_details': child_tx.filter(credit__isnull=False).values('parent__category', 'category','debit', 'credit')}
-        self._context |= {'expenditure_details': child_tx.filter(debit__isnull=False).values('parent__category', 'category','debit', 'credit')}
+        self._context |= {'income_details': income_details, 'expenditure_details': expenditure_details}
+
+    def get_tables(self) -> list[tuple[str, list[str], list[tuple]]]:
+        """The tables of the report - for export as csv or xlsx (after get_report_data)"""
+        context = self._context
+        return [('Income', ['Category', 'This period', 'Previous period'],
+                        [(category, amount, previous) for category, (amount, previous) in context['income'].items()] +
+                        [('Total', context['income_total'], context['previous_income_total'])]),
+                ('Expenditure', ['Category', 'This period', 'Previous period'],
+                        [(category, amount, previous) for category, (amount, previous) in context['expenditure'].items()] +
+                        [('Total', context['expenditure_total'], context['previous_expenditure_total'])]),
+                ('Main Sponsors', ['Name', 'Total'],
+                        [(sponsor['name'], sponsor['total']) for sponsor in context['main_sponsors']]),
+                ('Income Details', ['Category', 'Sub-category', 'Amount'],
+                        [(row['parent__category'], row['category'], row['credit']) for row in context['income_details']]),
+                ('Expenditure Details', ['Category', 'Sub-category', 'Amount'],
+                        [(row['parent__category'], row['category'], row['debit']) for row in context['expenditure_details']])]
+
+    def export_operations(self) -> list[dict]:
+        return [{'url': self.url + f'&export={export_format}', 'type': export_format, 'name': f'Download as {export_format}'}
+                    for export_format in ('csv', 'xlsx')]
 
     def get_rendered_report(self) -> str:
         template = get_template(self.template_name)
         return template.render(self._context)
 
+    def prepare_report(self):
+        """Set the period and the operations for the report - everything but the data"""
+
+    def cache_key(self, kind:str) -> str|None:
+        """The cache key for the rendered report (or None if it shouldn't be cached)
+
+           Only reports for periods which have ended are cached - the key includes the ledger version of
+           the account, so a change to the transactions means the report is rebuilt. It also includes the
+           period the report resolved to and the financial year version - the url may only name a financial
+           year, and editing the year's dates changes what the report covers.
+        """
+        end_date = self._end_date.date() if isinstance(self._end_date, datetime) else self._end_date
+        if not end_date or end_date >= date.today():
+            return None
+
+        account_id = self._context['account_selection']
+        if self._versions is None:
+            # The ledger version and the financial year version (which every process sees - see CacheVersion) in one query
+            year_version = CacheVersion.objects.filter(key=FINANCIAL_YEAR_VERSION_KEY).values('version')[:1]
+            self._versions = (Account.objects.filter(id=account_id).annotate(year_version=Subquery(year_version)).
+                                            values_list('ledger_version', 'year_version').first())
+        ledger_version, year_version = self._versions or (None, None)
+        period = f'{self._start_date}:{self._end_date}:{self._prev_start_date}:{self._prev_end_date}'
+        digest = hashlib.sha256(f'{self.url}|{period}'.encode()).hexdigest()
+        return f'Accounts:report:{account_id}:{ledger_version}:{year_version}:{kind}:{digest}'
+
+    @staticmethod
+    def cache_timeout() -> int:
+        return settings.APPS_SETTINGS.get('Accounts', {}).get('reporting', {}).get('cache_timeout', 24 * 60 * 60)
+
+    def get_report(self) -> str:
+        """The rendered report - from the cache if the ledger hasn't changed since it was last rendered"""
+        key = self.cache_key('html')
+        if key and (report := cache.get(key)) is not None:
+            return report
+
+        self.get_report_data()
+        report = self.get_rendered_report()
+        if key:
+            cache.set(key, report, self.cache_timeout())
+        return report
+
+    def get_pdf(self, render:Callable[[str], bytes]) -> bytes:
+        """The report as a pdf - render is given the html report and returns the pdf"""
+        key = self.cache_key('pdf')
+        if key and (pdf := cache.get(key)) is not None:
+            return pdf
+
+        pdf = render(self.get_report())
+        if key:
+            cache.set(key, pdf, self.cache_timeout())
+        return pdf
+
 
 class FinancialSummary(Report):
     template_name = "Reports/yearly_report.html"
@@ -95,19 +190,24 @@ class FinancialSummary(Report):
         """Extract the base data from the database"""
         account = self._context['account_selection']
 
+        # The starting balance and the balances either side of the previous period - in one query
+        balances = Account.objects.filter(id=account).values('starting_balance')
         if self._prev_start_date and self._prev_end_date:
-            last_tx_in_previous_year = Transaction.objects.filter(account=account, transaction_date__lte=self._prev_end_date).order_by('-tx_number').first()
-            tx_before_previous_year = Transaction.objects.filter(account=account, transaction_date__lt=self._prev_start_date).order_by('-tx_number').first()
-        else:
-            last_tx_in_previous_year, tx_before_previous_year = None, None
+            def latest_balance(**dates):
+                return Subquery(Transaction.objects.filter(account=OuterRef('id'), **dates).order_by('-tx_number').values('balance')[:1])
+            balances = balances.annotate(end_of_previous_year=latest_balance(transaction_date__lte=self._prev_end_date),
+                                         before_previous_year=latest_balance(transaction_date__lt=self._prev_start_date))
+        balances = balances.get()
 
-        self._context |= {'carried_over': (last_tx_in_previous_year.balance if last_tx_in_previous_year
-                                else Account.objects.get(id=self._context['account_selection']).starting_balance,
-                                tx_before_previous_year.balance if tx_before_previous_year else None )}
+        self._context |= {'carried_over': (balances.get('end_of_previous_year') or balances['starting_balance'],
+                                           balances.get('before_previous_year'))}
 
-        self._context |= {'this_period': Transaction.objects.filter(account=account, transaction_date__range=(self._start_date, self._end_date)),
-                        'previous_period': Transaction.objects.filter(account=account, transaction_date__range=(self._prev_start_date, self._prev_end_date)) if
-                        self._prev_start_date and self._prev_end_date else None}
+        self._context |= {'this_period': Transaction.objects.filter(account=account, transaction_date__range=(self._start_date, self._end_date))}
+
+        # One query for each period - the whole months from the monthly totals and the part months from the transactions
+        self._context |= {'this_period_totals': CategoryMonthlyTotal.objects.income_expenditure(account, self._start_date, self._end_date),
+                          'previous_period_totals': CategoryMonthlyTotal.objects.income_expenditure(account, self._prev_start_date, self._prev_end_date) if
+                          self._prev_start_date and self._prev_end_date else None}
 
         super().get_report_data()
 
@@ -130,11 +230,8 @@ class FlexibleReport(FinancialSummary):
     def get_file_name(self) -> Tuple[str, str]:
         """Return path and filename for the report"""
         # identify the financial year for the report
-        try:
-            fy = FinancialYear.objects.get(year_start__lte=self._context['start_date'], year_end__gte=self._context['end_date'])
-            path = fy.year_start.strftime('%Y')
-        except FinancialYear.DoesNotExist:
-            path = 'Unknown'
+        fy = financial_years().containing(self._context['start_date'], self._context['end_date'])
+        path = fy.year_start.strftime('%Y') if fy else 'Unknown'
         return path, f'{self._context["start_date"]!s}-{self._context["end_date"]!s}.pdf'
 
     def extract_report_parameters(self, request: HttpRequest):
@@ -144,8 +241,7 @@ class FlexibleReport(FinancialSummary):
         last_report_record = PublishedReports.objects.order_by(
             '-period_end').first()
 
-        start_date = last_report_record.period_end if last_report_record else FinancialYear.objects.latest(
-            'year_start').year_start
+        start_date = last_report_record.period_end if last_report_record else financial_years().latest().year_start
         self._context |= {'last_report_date': start_date}
 
         # Identify which type of report is required
@@ -166,8 +262,7 @@ class FlexibleReport(FinancialSummary):
                     'transaction_date').first()
 
                 self._context |= {
-                'min_start_date': first_tx.transaction_date if first_tx else FinancialYear.objects.earliest(
-                    'year_start').year_start,
+                'min_start_date': first_tx.transaction_date if first_tx else financial_years().earliest().year_start,
                 'max_start_date': (date.today() - td(days=1)) }
 
                 self._context |= {'min_end_date': (self._context['min_start_date']+td(days=1)),
@@ -195,12 +290,7 @@ class FlexibleReport(FinancialSummary):
                 return
 
         # check if dates span multiple financial years
-        years = list(FinancialYear.objects.
-                    filter(
-                            Q(year_start__lte=self._start_date, year_end__gte=self._start_date)|
-                            Q(year_start__lte=self._end_date, year_end__gte=self._end_date)|
-                            Q(year_start__gt=self._start_date, year_end__lt=self._end_date)
-                    ).distinct('year_start').values_list('year', flat=True).order_by('year_start'))
+        years = [interval.year for interval in financial_years().overlapping(self._start_date, self._end_date)]
         if len(years) >1 :
             self._context['warnings'].append(f'Report spans multiple financial years: {', '.join(years[:-1]) + ' and ' + str(years[-1])}')
 
@@ -218,7 +308,7 @@ class FlexibleReport(FinancialSummary):
             self._context |= {'error':f'Start date {self._start_date} cannot be after end date {self._end_date}'}
         return bool(self._start_date and self._end_date and self._start_date < self._end_date)
 
-    def get_report_data(self):
+    def prepare_report(self):
 
         self._prev_start_date, self._prev_end_date = None, None
         self._carried_over = False
@@ -230,8 +320,7 @@ class FlexibleReport(FinancialSummary):
             'name' : "Download as pdf"
             }
         )
-
-        super().get_report_data()
+        self._context['operations'].extend(self.export_operations())
 
 
 class YearlyReport(FinancialSummary):
@@ -244,7 +333,7 @@ class YearlyReport(FinancialSummary):
 
     def get_summary(self) -> str:
         year = self._context['year_selection']
-        year_inst = FinancialYear.objects.get(year=year)
+        year_inst = financial_years().get(year)
         if date.today() > year_inst.year_end:
             return f"Yearly report for {year!s} ({year_inst.year_start!s} to {year_inst.year_end!s})"
         else:
@@ -263,21 +352,21 @@ class YearlyReport(FinancialSummary):
         if type_selection:
             self._context |= {'type_selection': type_selection}
 
-            self._context |= {'years': FinancialYear.objects.all().order_by('-year_start')}
+            self._context |= {'years': financial_years().newest_first()}
             if year_selection:
                 self._context |= {'year_selection': year_selection}
 
     def validate_params(self) -> bool:
-        """ The yearly report only requires a year to be specified"""
-        return bool(self._context.get('year_selection', None))
+        """ The yearly report only requires a (known) year to be specified"""
+        return financial_years().get(self._context.get('year_selection', None)) is not None
 
-    def get_report_data(self):
+    def prepare_report(self):
 
-        report_year = self._context['year_selection']
-        this_year = FinancialYear.objects.get(year = report_year)
+        years = financial_years()
+        this_year = years.get(self._context['year_selection'])
         self._start_date, self._end_date = this_year.year_start, this_year.year_end
         self._context |= {'start_date': self._start_date, 'end_date': self._end_date}
-        prev = FinancialYear.objects.filter(year__lt=report_year).order_by('-year_start').first()
+        prev = years.previous(this_year)
         if prev:
             self._prev_start_date, self._prev_end_date = prev.year_start, prev.year_end
         else:
@@ -291,6 +380,7 @@ class YearlyReport(FinancialSummary):
             'name' : "Download as pdf"
             },
         )
+        self._context['operations'].extend(self.export_operations())
 
         similar = PublishedReports.objects.filter(report_type=self._context['type'], period_start=self._context['start_date'], period_end=self._context['end_date'])
         if not similar:
@@ -310,4 +400,97 @@ class YearlyReport(FinancialSummary):
                 },
             )
 
-        super().get_report_data()
\ No newline at end of file
+
+class ComparativeReport(Report):
+    """The income and expenditure in each category over several financial years - side by side"""
+    template_name = "Reports/comparative_report.html"
+
+    @staticmethod
+    def default_span() -> int:
+        return settings.APPS_SETTINGS.get('Accounts', {}).get('reporting', {}).get('comparative', {}).get('years', 5)
+
+    @property
+    def url(self):
+        return (reverse("Account:report",
+                       kwargs={'account_id':self._context['account_selection']} )
+                + f"?type={self._context['type_selection']}&year={self._context['year_selection']}&span={self._context['span']}")
+
+    def get_summary(self) -> str:
+        columns = self._context['year_columns']
+        return f"Comparison of {len(columns)} financial years - {columns[0]} to {columns[-1]}"
+
+    def get_file_name(self) -> Tuple[str, str]:
+        columns = self._context['year_columns']
+        return self._context['year_selection'], f"ComparativeReport-{columns[0]}-to-{columns[-1]}.pdf"
+
+    def extract_report_parameters(self, request: HttpRequest):
+        """Given a request, build a context dictionary with the parameters for the report template"""
+        self._context |= {'type_selection': request.GET.get('type', None),
+                          'years': financial_years().newest_first(),
+                          'spans': range(2, 11)}
+        try:
+            span = int(request.GET.get('span', self.default_span()))
+        except ValueError:
+            span = self.default_span()
+        self._context |= {'span': min(max(span, 2), 10)}
+
+        if year_selection := request.GET.get('year', None):
+            self._context |= {'year_selection': year_selection}
+
+    def validate_params(self) -> bool:
+        """ The comparative report requires the latest (known) year to be specified"""
+        return financial_years().get(self._context.get('year_selection', None)) is not None
+
+    def prepare_report(self):
+        years = financial_years()
+        report_years = years.up_to(years.get(self._context['year_selection']), self._context['span'])
+        self._start_date, self._end_date = report_years[0].year_start, report_years[-1].year_end
+        self._context |= {'start_date': self._start_date, 'end_date': self._end_date,
+                          'financial_years': report_years,
+                          'year_columns': [financial_year.year for financial_year in report_years]}
+
+        # Add Operations for this report :
+        self._context['operations'].append(
+            {
+            'url': self.url + '&download',
+            'type': 'pdf',
+            'name' : "Download as pdf"
+            },
+        )
+        self._context['operations'].extend(self.export_operations())
+
+    def get_report_data(self):
+        """The figures for every year from one query - grouped by financial year and category"""
+        columns = self._context['year_columns']
+        summary = CategoryMonthlyTotal.objects.by_period(self._context['account_selection'],
+                                    {financial_year.year: (financial_year.year_start, financial_year.year_end)
+                                            for financial_year in self._context['financial_years']})
+
+        def rows(index:int) -> dict[str, list[Decimal|None]]:
+            """The income (0) or expenditure (1) for each year in each category which has any - largest in the latest year first"""
+            amounts = {category: [by_year[year][index] if year in by_year and by_year[year][index] else None for year in columns]
+                            for category, by_year in summary.items()}
+            return dict(sorted(((category, row) for category, row in amounts.items() if any(row)),
+                               key=lambda item: ([-(amount or 0) for amount in reversed(item[1])], item[0])))
+
+        def totals(table:dict[str, list[Decimal|None]]) -> list[Decimal]:
+            return [sum((row[index] or Decimal('0.00') for row in table.values()), Decimal('0.00')) for index in range(len(columns))]
+
+        income, expenditure = rows(0), rows(1)
+        income_totals, expenditure_totals = totals(income), totals(expenditure)
+        self._context |= {'income': income, 'income_totals': income_totals,
+                          'expenditure': expenditure, 'expenditure_totals': expenditure_totals,
+                          'surplus': [received - spent for received, spent in zip(income_totals, expenditure_totals)],
+                          'summary': self.get_summary()}
+
+    def get_tables(self) -> list[tuple[str, list[str], list[tuple]]]:
+        """The tables of the report - for export as csv or xlsx (after get_report_data)"""
+        context = self._context
+        columns = ['Category'] + context['year_columns']
+        return [('Income', columns,
+                        [(category, *row) for category, row in context['income'].items()] + [('Total', *context['income_totals'])]),
+                ('Expenditure', columns,
+                        [(category, *row) for category, row in context['expenditure'].items()] + [('Total', *context['expenditure_totals'])]),
+                ('Surplus', columns,
+                        [('Income', *context['income_totals']), ('Expenditure', *context['expenditure_totals']),
+                         ('Surplus', *context['surplus'])])]
@@ -2,41 +2,33 @@ import json
 from http import HTTPStatus
 
 import logging
-from datetime import datetime
 from decimal import Decimal
-from typing import Any
 
 from django.contrib.auth.decorators import user_passes_test
 from django.core.exceptions import BadRequest
 from django.http import JsonResponse
 from django.views.decorators.http import require_http_methods
 
-from Accounts.models import UploadHistory, Transaction, Categories, UploadError
+from Accounts.models import Transaction, UploadError, ImportJob, Account
+from Accounts.services.category_tree import category_tree
+from Accounts.services.batch_edit import apply_batch, BatchEditError
 
 ### REST API starts here - would be nicer to do some sort of class with a dynamic dispatch based on verb
 # Also URLs need tweaking to make it clear that these are rest APIs
 # Also need to change the common.js file to the new URLs
 # Does Django REST API work for this, or do I need to roll my own - which isn't complex
 
-def _build_tx_record(account, history_inst: UploadHistory, tx_number: int, row) -> tuple[
-    Any, tuple[Transaction, bool], str | Any, str | Any]:
-    """Build a transaction record from the data in the row"""
-
-    debit, credit = row['Debit Amount'], row['Credit Amount']
-    debit = debit if debit else "0"
-    credit = credit if credit else "0"
-    category = row.get('Category', '')
-
-    data_dict = {'transaction_date': datetime.strptime(row['Transaction Date'], '%d/%m/%Y'),
-                 'description': row['Transaction Description'],
-                 'tx_number': tx_number,
-                 'upload_history': history_inst,
-                 'debit': Decimal(debit), 'credit': Decimal(credit),
-                 'balance': Decimal(row['Balance']),
-                 'category': category}
+@require_http_methods(['GET'])
+@user_passes_test(lambda u: u.is_superuser or u.has_perm('Accounts.upload_transaction'))
+def import_progress(request, job_id):
+    """Report the progress of a queued upload"""
+    try:
+        job = ImportJob.objects.get(id=job_id)
+    except ImportJob.DoesNotExist:
+        logging.error(f'Import job {job_id} not found')
+        raise BadRequest(f'Import job {job_id} not found')
 
-    instance = Transaction.objects.get_or_create(account=account, **data_dict)
-    return category, credit, debit, instance
+    return JsonResponse(job.progress() | {'success':HTTPStatus.OK})
 
 @require_http_methods(['GET'])
 def get_child_categories(request, transaction_id):
@@ -46,9 +38,7 @@ def get_child_categories(request, transaction_id):
         logging.error(f'Transaction {transaction_id} not found')
         raise BadRequest(f'Transaction {transaction_id} not found')
 
-    parent_category = transaction.category
-    cat_list = list(i for i in Categories.objects.filter(parent__category_name=parent_category).
-                                           values_list('category_name', flat=True))
+    cat_list = category_tree().children(transaction.category)
     return JsonResponse({'categories':cat_list, 'success':HTTPStatus.OK})
 
 @require_http_methods(['GET'])
@@ -62,11 +52,9 @@ def get_categories(request, transaction_id):
 
     if transaction.parent is None:
         tx_type = 'C' if transaction.credit > 0 else 'D'
-        cat_list = list(Categories.objects.filter(credit_debit=tx_type, parent__isnull=True).values_list('category_name', flat=True))
+        cat_list = category_tree().top_level(tx_type)
     else:
-        parent_category = transaction.parent.category
-        cat_list = list(i for i in Categories.objects.filter(parent__category_name=parent_category).
-                                               values_list('category_name', flat=True))
+        cat_list = category_tree().children(transaction.parent.category)
 
     return JsonResponse({'categories':cat_list, 'success':HTTPStatus.OK})
 
@@ -145,3 +133,25 @@ def delete_transaction(request, transaction_id):
     logging.info(f"delete transaction: {transaction_id} deleted")
 
     return JsonResponse({'message':"delete_transaction : transaction delete successfully",'success':HTTPStatus.OK})
+
+
+@require_http_methods(['PUT'])
+@user_passes_test(lambda u: u.is_superuser or u.has_perm('Accounts.change_transaction'))
+def batch_edit(request, account_id):
+    """Apply a list of edits to the account's transactions - all of them or (if any are invalid) none of them"""
+    if not Account.objects.filter(id=account_id).exists():
+        logging.error(f'Account {account_id} not found')
+        raise BadRequest(f'Account {account_id} not found')
+
+    try:
+        operations = json.loads(request.body).get('operations')
+    except (ValueError, AttributeError):
+        raise BadRequest('batch_edit : invalid request body')
+
+    try:
+        results = apply_batch(account_id, operations)
+    except BatchEditError as e:
+        return JsonResponse({'message':f"batch_edit : {e}", 'results':e.results, 'success':HTTPStatus.BAD_REQUEST},
+                            status=HTTPStatus.BAD_REQUEST)
+
+    return JsonResponse({'message':f"batch_edit : {len(results)} operation(s) applied", 'results':results, 'success':HTTPStatus.OK})
@@ -1,4 +1,6 @@
 import io
+from datetime import date
+from pathlib import Path
 from http import HTTPStatus
 from typing import Any
 
@@ -7,9 +9,8 @@ from django.contrib.auth.decorators import login_required, permission_required
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin, PermissionRequiredMixin
 from django.contrib.staticfiles import finders
 from django.core.exceptions import BadRequest
-from django.db import transaction as db_transaction
-from django.db.models import F, Count, Exists, QuerySet
-from django.http import HttpRequest, HttpResponse
+from django.db.models import BooleanField, Case, Count, Q, QuerySet, Value, When
+from django.http import HttpRequest, HttpResponse, Http404
 from django.shortcuts import redirect
 from django.template.response import TemplateResponse
 from django.templatetags.static import static
@@ -18,26 +19,27 @@ from django.views import View
 from django.views.generic import ListView
 
 from GoogleDrive.services.google_drive import GoogleDrive
-from Accounts.views.restapi import _build_tx_record
+from Accounts.services.importer import TransactionImporter, UploadRejected, import_settings
+from Accounts.services.import_jobs import queue_import
+from Accounts.services.ledger import ledger_health
+from Accounts.services.category_tree import category_tree
+from Accounts.services.financial_years import YearInterval, financial_years
+from Accounts.services.export import EXPORT_FORMATS, category_table, streaming_response, transaction_table
 from GarageSale.models import CommunicationTemplate
 # Create your views here.
 
-from Accounts.models import Transaction, Account, Categories, FinancialYear, UploadError, UploadHistory, \
-    PublishedReports
+from Accounts.models import Transaction, Account, UploadError, UploadHistory, \
+    PublishedReports, ImportJob
 from Accounts.forms import Upload
 
-from csv import DictReader
-from datetime import datetime
 import logging
 
-from Accounts.views.reports import FlexibleReport, YearlyReport
+from Accounts.views.reports import ComparativeReport, FlexibleReport, YearlyReport
 from TeamPageFramework.entry_point import register, EntryPointMixin
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
-expected_fields = ['Transaction Date','Sort Code','Account Number','Transaction Description','Debit Amount','Credit Amount','Balance','Category']
-
 entry_point = register( 'Finances', 'Account:EntryPoint',
             static('Accounts/images/icons/navigation/money-bag-pound-svgrepo-com.svg'),
                         'Accounts.view_account', needs_event=False)
@@ -57,93 +59,53 @@ def upload_transactions(request):
             account = form.cleaned_data['account']
             file = form.cleaned_data['file']
 
-            categories = set(Categories.objects.all().values_list('category_name', flat=True))
-
-            transactions_data = file.read().decode('utf-8').splitlines()
-            transactions = DictReader(transactions_data, delimiter=',')
-
-            missing = set(expected_fields) - set(transactions.fieldnames)
-
-            next_tx = account.last_transaction_number + 1
-
-            if missing and 'Category' in missing:
-                missing.remove('Category')
-
-            # Check for expected fields
-            if missing:
-                form.add_error('file', f'Missing columns {','.join(missing)} in {file.name}')
-                return TemplateResponse(request, 'Transactions/upload_transactions.html', {'form': form})
-
-            data = list(transactions)
-
-            # Check for data overlap this account
-            first_date = datetime.strptime(data[0]['Transaction Date'],'%d/%m/%Y')
-            last_date  = datetime.strptime(data[-1]['Transaction Date'],'%d/%m/%Y')
-
-            # Currently check all transactions - and not the upload history.
-            existing = Transaction.objects.filter(account=account, transaction_date__range=(first_date,last_date)).exists()
-            if existing:
-                form.add_error('file', f'Transactions already uploaded for {account.bank_name} between {first_date.strftime('%d/%m/%Y')} and {last_date.strftime('%d/%m/%Y')}')
+            # A preview checks the whole file and reports what an import would do - without writing anything
+            if 'preview' in request.POST:
+                try:
+                    preview = TransactionImporter(account=account, uploaded_by=request.user).preview_file(file)
+                except UploadRejected as e:
+                    form.add_error('file', str(e))
+                    preview = None
+                return TemplateResponse(request, 'Transactions/upload_transactions.html',
+                                        {'form': form, 'preview': preview, 'data_type': 'transactions', 'action': 'upload'})
+
+            # Large statements are imported in the background - the page then polls for progress
+            if file.size > import_settings().get('background_threshold', 512 * 1024):
+                job = queue_import(account=account, uploaded_by=request.user, file=file)
+                return redirect(reverse('Account:ImportJob', kwargs={'job_id':job.id}))
+
+            importer = TransactionImporter(account=account, uploaded_by=request.user)
+            try:
+                history_inst = importer.import_file(file)
+            except UploadRejected as e:
+                form.add_error('file', str(e))
                 return TemplateResponse(request, 'Transactions/upload_transactions.html', {'form': form})
 
-            if not data :
-                form.add_error('file', f'No new transactions found in {file.name}')
-                return TemplateResponse(request, 'Transactions/upload_transactions.html', {'form': form})
+            if importer.error_count:
+                return redirect(reverse('Account:UploadErrorList', kwargs={'account_id':account.id, 'upload_id':history_inst.pk}))
 
-            # Check for out-of-order insertion.
-            # We know there is no overlap - so we need to identify the right number to start from
-            # Is there a transaction before the last data in the upload file
-            try:
-                prev_tx = Transaction.objects.filter(account=account,
-                                                     transaction_date__gt = first_date).earliest('transaction_date')
-            except Transaction.DoesNotExist:
-                prev_tx = None
-
-            if prev_tx:
-                next_tx = prev_tx.tx_number
-                shift = len(data)
-            else:
-                shift = 0
-
-            with db_transaction.atomic():
-                # Shift : update transaction numbers of existing data to ensure that all data has
-                #  unique increasing number.
-                if shift:
-                    Transaction.objects.filter(account=account,
-                                               transaction_date__gt=first_date).update(tx_number=F('tx_number')+shift)
-
-                history_inst = UploadHistory.objects.create(account=account,
-                                                         start_date=first_date,
-                                                         end_date=last_date,
-                                                         uploaded_by=request.user
-                                                         )
-                for index, row in enumerate(data, start=0):
-                    category, credit, debit, instance = _build_tx_record(account, history_inst, next_tx + index, row)
-
-                    if category not in categories:
-                        UploadError.objects.create(transaction=instance[0], upload_history=history_inst,
-                                                   error_message=f'Unknown category {category}')
-                    else:
-                        try:
-                            category_inst = Categories.objects.get(category_name=category)
-                            if (category and category_inst.credit_debit == 'C' and debit != "0") or\
-                                        (category and category_inst.credit_debit == 'D' and credit != "0"):
-                                UploadError.objects.create(transaction=instance[0], upload_history=history_inst,
-                                                           error_message= f'Invalid category for debit' if category_inst.credit_debit == 'D' else f'Invalid category for credit')
-                        except Categories.DoesNotExist:
-                            UploadError.objects.create(transaction=instance[0], upload_history=history_inst,
-                                                       error_message= f'Unknown category {category}')
-
-                if history_inst.errors.count():
-                    return redirect(reverse('Account:UploadErrorList', kwargs={'account_id':account.id, 'upload_id':history_inst.pk, 'data_type': 'transactions', 'action': 'uploadErrors'}))
-
-            return redirect(reverse('Account:TransactionList', kwargs={'account_id':account.id, 'data_type': 'transactions', 'action': 'list'}))
+            return redirect(reverse('Account:TransactionList', kwargs={'account_id':account.id}))
         else:
             return TemplateResponse(request, 'Transactions/upload_transactions.html', {'form': form, 'data_type': 'transactions', 'action': 'upload'})
     else:
         raise Exception('Invalid request method')
 
 
+@login_required( redirect_field_name='next', login_url=reverse_lazy('user_management:login') )
+@permission_required('Accounts.upload_transaction', raise_exception=True)
+def import_job(request, job_id):
+    """Progress page for a queued upload - the page polls the import_progress API"""
+    try:
+        job = ImportJob.objects.get(id=job_id)
+    except ImportJob.DoesNotExist:
+        raise Http404(f'Import job {job_id} not found')
+
+    if job.get_result_url():
+        return redirect(job.get_result_url())
+
+    return TemplateResponse(request, 'Transactions/import_job.html', {'job': job, 'data_type': 'transactions', 'action': 'upload'})
+
+
 class UploadErrorList(EntryPointMixin, LoginRequiredMixin, PermissionRequiredMixin, ListView):
     login_url = reverse_lazy('user_management:login')
     redirect_field_name = 'next'
@@ -171,7 +133,7 @@ class UploadErrorList(EntryPointMixin, LoginRequiredMixin, PermissionRequiredMix
 
         if account_selected and upload_selected:
             context |= {'errors': self.get_error_list(account_selected, upload_selected),
-                        'categories': Categories.objects.all()}
+                        'categories': list(category_tree())}
         return context
 
     @staticmethod
@@ -185,13 +147,55 @@ class UploadErrorList(EntryPointMixin, LoginRequiredMixin, PermissionRequiredMix
         else:
             return UploadHistory.objects.none()
 
+class KeysetPage:
+    """A page of transactions found by its position in (transaction_date, id) order - rather than by an offset,
+       so a page costs the same however long the account's history is.
+
+       The cursors identify the first and last transactions on the page - for the previous and next links.
+    """
+    def __init__(self, object_list:list, has_previous:bool, has_next:bool):
+        self.object_list = object_list
+        self._has_previous, self._has_next = has_previous, has_next
+
+    @staticmethod
+    def cursor(transaction) -> str:
+        return f'{transaction.transaction_date.isoformat()}_{transaction.id}'
+
+    @staticmethod
+    def from_cursor(cursor:str) -> tuple[date, int]:
+        try:
+            transaction_date, tx_id = cursor.split('_')
+            return date.fromisoformat(transaction_date), int(tx_id)
+        except ValueError:
+            raise BadRequest(f'Invalid page {cursor}')
+
+    def has_previous(self):
+        return self._has_previous
+    def has_next(self):
+        return self._has_next
+    def has_other_pages(self):
+        return self._has_previous or self._has_next
+    def previous_cursor(self):
+        return self.cursor(self.object_list[0]) if self.object_list else ''
+    def next_cursor(self):
+        return self.cursor(self.object_list[-1]) if self.object_list else ''
+    def first_date(self):
+        return self.object_list[0].transaction_date if self.object_list else None
+    def last_date(self):
+        return self.object_list[-1].transaction_date if self.object_list else None
+
+    def __iter__(self):
+        return iter(self.object_list)
+    def __len__(self):
+        return len(self.object_list)
+
+
 class TransactionList(EntryPointMixin,LoginRequiredMixin, UserPassesTestMixin, ListView):
     login_url = reverse_lazy('user_management:login')
     redirect_field_name = 'next'
     model = Transaction
     template_name = 'Transactions/transaction_list.html'
     paginate_by = 10
-    paginate_orphans = 3
     entry_point_url = 'Account:TransactionList'
     entry_point_label = 'Transaction List'
     entry_point_permission = 'Accounts.view_transaction'
@@ -205,38 +209,67 @@ class TransactionList(EntryPointMixin,LoginRequiredMixin, UserPassesTestMixin, L
 
     @staticmethod
     def get_yearset():
-        years = FinancialYear.objects.all().order_by('-year_start')
-        return [i.year for i in years]
-
-    def _add_splittable_flag(self, qs):
-        splittable = set(Categories.objects.filter(children__isnull = False).values_list('category_name', flat=True))
-        data = []
-        for record in qs:
-            if record.category not in splittable:
-                record.no_split = True
-            data.append(record)
-        return data
+        return [interval.year for interval in financial_years().newest_first()]
+
+    @staticmethod
+    def _add_splittable_flag(qs):
+        """Only transactions with a category which has sub-categories can be split"""
+        return qs.annotate(splittable=Case(When(category__in=category_tree().splittable, then=Value(True)),
+                                           default=Value(False), output_field=BooleanField()))
+
+    def get_year(self) -> YearInterval|None:
+        """The financial year the list is filtered to - if any"""
+        year = self.request.GET.get('year','')
+        if not year or year == 'all':
+            return None
+        if (year_inst := financial_years().get(year)) is None:
+            logging.error(f'Invalid year {year} specified for transaction list')
+            raise BadRequest(f'Invalid year {year} specified for transaction list')
+        return year_inst
+
+    def get(self, request, *args, **kwargs):
+        account_id = self.kwargs.get('account_id')
+        if account_id and (export_format := request.GET.get('export')) in EXPORT_FORMATS:
+            # The whole list - statement rows and splits - streamed as it is read
+            year_inst = self.get_year()
+            table = transaction_table(account_id, financial_year=year_inst.id if year_inst else None)
+            return streaming_response(f'transactions-{account_id}-{year_inst.year if year_inst else "all"}', export_format, [table])
+        return super().get(request, *args, **kwargs)
 
     def get_queryset(self):
         account_id = self.kwargs.get('account_id')
         if not account_id:
             return Transaction.objects.none()
-        year = self.request.GET.get('year','')
-        year_inst = None
-        if year:
-            try:
-                year_inst = FinancialYear.objects.get(year=year)
-            except FinancialYear.DoesNotExist:
-                logging.error(f'Invalid year {year} specified for transaction list')
-                year = None
-                raise BadRequest(f'Invalid year {year} specified for transaction list')
+        year_inst = self.get_year()
 
         qs = Transaction.details.bank_only().filter(account_id=account_id)
-        if year:
-            start, end = year_inst.year_start, year_inst.year_end
-            qs = qs.filter(transaction_date__range=(start,end))
+        if year_inst:
+            qs = qs.filter(financial_year=year_inst.id)
+
+        return self._add_splittable_flag(qs).prefetch_related('children')
+
+    def paginate_queryset(self, queryset, page_size):
+        """Keyset pagination - the page after or before a cursor, or the first or last page"""
+        after, before = self.request.GET.get('after'), self.request.GET.get('before')
+
+        if after:
+            transaction_date, tx_id = KeysetPage.from_cursor(after)
+            rows = list(queryset.filter(Q(transaction_date__gt=transaction_date) |
+                                        Q(transaction_date=transaction_date, id__gt=tx_id)).
+                                 order_by('transaction_date', 'id')[:page_size + 1])
+            page = KeysetPage(rows[:page_size], has_previous=True, has_next=len(rows) > page_size)
+        elif before or 'last' in self.request.GET:
+            if before:
+                transaction_date, tx_id = KeysetPage.from_cursor(before)
+                queryset = queryset.filter(Q(transaction_date__lt=transaction_date) |
+                                           Q(transaction_date=transaction_date, id__lt=tx_id))
+            rows = list(queryset.order_by('-transaction_date', '-id')[:page_size + 1])
+            page = KeysetPage(rows[:page_size][::-1], has_previous=len(rows) > page_size, has_next=bool(before))
+        else:
+            rows = list(queryset.order_by('transaction_date', 'id')[:page_size + 1])
+            page = KeysetPage(rows[:page_size], has_previous=False, has_next=len(rows) > page_size)
 
-        return self._add_splittable_flag(qs)
+        return None, page, page.object_list, page.has_other_pages()
 
     def get_context_data(self, *args, **kwargs):
         context = super().get_context_data(*args, **kwargs) | {'data_type': 'transactions', 'action': 'list'}
@@ -245,6 +278,31 @@ class TransactionList(EntryPointMixin,LoginRequiredMixin, UserPassesTestMixin, L
             return context | {'account_selection': None, 'accounts': Account.objects.all() }
         return context | {'account_selection':account_id,  'accounts': Account.objects.all(), 'years':self.get_yearset(), 'year_selected':self.request.GET.get('year','')}
 
+class LedgerHealth(EntryPointMixin, LoginRequiredMixin, UserPassesTestMixin, View):
+    """Check each account's statement rows follow on from each other - and list any which don't"""
+    login_url = reverse_lazy('user_management:login')
+    redirect_field_name = 'next'
+    template_name = 'Transactions/ledger_health.html'
+    entry_point_url = 'Account:LedgerHealth'
+    entry_point_label = 'Ledger Health'
+    entry_point_permission = 'Accounts.view_transaction'
+    entry_point_icon = static('Accounts/images/icons/navigation/report-svgrepo-com.svg')
+    entry_point_nav_page = 'AccountsEntryPoint'
+    entry_point_needs_event = False
+
+    def test_func(self):
+        user = self.request.user
+        return user.is_superuser or user.has_perm('Accounts.view_transaction')
+
+    def get(self, request, account_id=None):
+        context = {'data_type': 'transactions', 'action': 'ledger', 'accounts': Account.objects.all(),
+                   'account_selection': account_id}
+        if account_id:
+            if not Account.objects.filter(id=account_id).exists():
+                raise Http404(f'Account {account_id} not found')
+            context['health'] = ledger_health(account_id)
+        return TemplateResponse(request, self.template_name, context)
+
 class FinancialReport(EntryPointMixin, LoginRequiredMixin, PermissionRequiredMixin, View):
     login_url = reverse_lazy('user_management:login')
     redirect_field_name = 'next'
@@ -270,7 +328,7 @@ class FinancialReport(EntryPointMixin, LoginRequiredMixin, PermissionRequiredMix
 
     def get(self, request: HttpRequest, account_id: int = None):
 
-        report_classes = {'year': YearlyReport, 'flexible': FlexibleReport}
+        report_classes = {'year': YearlyReport, 'flexible': FlexibleReport, 'comparative': ComparativeReport}
 
         # Populate the Accounts list
         report_context = { 'accounts': Account.objects.all(), 'data_type':'reports'}
@@ -283,7 +341,7 @@ class FinancialReport(EntryPointMixin, LoginRequiredMixin, PermissionRequiredMix
 
         # Populate report type information
         report_context |= {'account_selection': account_id}
-        report_context |= {'summary_types': [('year', 'Full Year'), ('flexible', 'Flexible date-range'), ('outgoings', 'Outgoings')]}
+        report_context |= {'summary_types': [('year', 'Full Year'), ('flexible', 'Flexible date-range'), ('comparative', 'Multi-year comparison'), ('outgoings', 'Outgoings')]}
         report_context |= {'type': request.GET.get('type', None)}
 
         if not request.GET.get('type'):
@@ -306,20 +364,17 @@ class FinancialReport(EntryPointMixin, LoginRequiredMixin, PermissionRequiredMix
             return TemplateResponse(request, 'Reports/reports.html', report_inst.context)
         else:
             # We know that we have the data for this report type - so grab the data and render
-            report_inst.get_report_data()
-            report = report_inst.get_rendered_report()
-
-            if 'download' in request.GET or 'save' in request.GET:
-                header_context = {'host': request.get_host(), 'scheme': request.scheme, 'summary':report_inst.get_summary()}
+            # Reports for closed periods are cached until the account's transactions change
+            report_inst.prepare_report()
 
-                pdf_header = CommunicationTemplate.pdf_header_template(header_context)
+            if (export_format := request.GET.get('export')) in EXPORT_FORMATS:
+                report_inst.get_report_data()
+                tables = report_inst.get_tables() + [category_table(account, report_inst.context['start_date'],
+                                                                    report_inst.context['end_date'])]
+                return streaming_response(Path(report_inst.get_file_name()[1]).stem, export_format, tables)
 
-                result = finders.find('Accounts/styles/reports.css')
-                with open(result) as f:
-                    header = f.read()
-                header = f"<style>\n{header}\n</style>"
-
-                pdf = CommunicationTemplate.pdf_from_template_str(header_context, header + report, pdf_header)
+            if 'download' in request.GET or 'save' in request.GET:
+                pdf = report_inst.get_pdf(lambda report: self.render_pdf(request, report_inst, report))
 
                 if 'save' in request.GET:
                     self.save_to_google_drive(pdf, report_context, report_inst, request)
@@ -327,11 +382,25 @@ class FinancialReport(EntryPointMixin, LoginRequiredMixin, PermissionRequiredMix
                 return HttpResponse(pdf, content_type='application/pdf',
                                     headers={"Content-Disposition": f'attachment; filename={report_inst.get_file_name()[1]}'})
 
+            report = report_inst.get_report()
             report_context |= {'report': report}
 
 
         return TemplateResponse(request, 'Reports/reports.html', report_inst.context | {'report': report})
 
+    @staticmethod
+    def render_pdf(request: HttpRequest, report_inst, report: str) -> bytes:
+        header_context = {'host': request.get_host(), 'scheme': request.scheme, 'summary':report_inst.get_summary()}
+
+        pdf_header = CommunicationTemplate.pdf_header_template(header_context)
+
+        result = finders.find('Accounts/styles/reports.css')
+        with open(result) as f:
+            header = f.read()
+        header = f"<style>\n{header}\n</style>"
+
+        return CommunicationTemplate.pdf_from_template_str(header_context, header + report, pdf_header)
+
     def save_to_google_drive(self, pdf: bytes | None, report_context: dict[str, QuerySet[Any, Any]], report_inst,
                              request: HttpRequest):
         report_settings = (settings.APPS_SETTINGS.get('Accounts', {}).
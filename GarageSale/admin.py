@@ -17,7 +17,7 @@ from django import forms
 
 from Sponsors.models import Sponsor
 from user_management.models import TeamMember
-from .models import MOTD, EventData, Supporting, CommunicationTemplate, TemplateAttachment, Nomination
+from .models import MOTD, EventData, Supporting, CommunicationTemplate, TemplateAttachment, Nomination, OutboundEmail
 from Location.models import Location
 
 from Sponsors import models as sponsor_models
@@ -95,3 +95,12 @@ class NominationAdmin(admin.ModelAdmin):
     list_display = ['nominee', 'status', 'nomination_date']
     list_filter = ['status', 'anonymous']
     date_hierarchy = 'nomination_date'
+
+
+@admin.register(OutboundEmail)
+class OutboundEmailAdmin(admin.ModelAdmin):
+    list_display = ['subject', 'sender', 'status', 'attempts', 'next_attempt', 'sent_at']
+    list_filter = ['status', 'sender']
+    date_hierarchy = 'created_at'
+    exclude = ['message', 'attachments']
+    readonly_fields = ['sender', 'recipients', 'subject', 'attempts', 'last_error', 'created_at', 'claimed_at', 'sent_at']
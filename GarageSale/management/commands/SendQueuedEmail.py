@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+import logging
+
+from GarageSale.services import outbox
+
+logger = logging.getLogger('GarageSale.management.SendQueuedEmail')
+
+
+class Command( BaseCommand ):
+    help = 'Send queued outbound email'
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true",
+                            help="Send the emails which are currently due and then exit")
+        parser.add_argument("--sleep", type=float, default=2.0,
+                            help="Seconds to wait between polls when no email is due")
+
+    def handle(self, *args, **options):
+        verbose = options.get('verbosity', 0)
+
+        while True:
+            sent, failed = outbox.deliver_due()
+            if verbose and (sent or failed):
+                self.stdout.write(f'Sent {sent} email(s), {failed} failed')
+            if not (sent or failed):
+                if options['once']:
+                    return
+                time.sleep(options['sleep'])
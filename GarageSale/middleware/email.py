@@ -1,18 +1,147 @@
+"""
+    GarageSale.middleware.email.py :
+
+Summary :
+    The email backend - sends each message through the SMTP account of its sender.
+
+    Opening an SMTP connection costs a TCP connect, a TLS handshake and a login, so rather than
+    a connection for every message :
+
+        * the messages in a batch are grouped by sender, and each sender's messages are sent over
+          one connection
+        * once a batch is sent the connection is kept in a small pool of idle connections, so the
+          next batch from that sender can reuse it. An idle connection is checked with a NOOP
+          before it is reused, and discarded if the server has dropped it or it has been idle
+          for too long
+        * if the server drops the connection part way through a batch, the connection is
+          reopened and the message it failed on is sent again - once
+
+    Settings - APPS_SETTINGS['GarageSale']['email'] :
+        pool_size : The most idle connections kept for each sender (default 1) - 0 closes every
+                    connection once its batch is sent
+        idle_timeout : Seconds an idle connection is kept before it is closed (default 60)
+"""
+import smtplib
+import threading
+import time
+from collections import defaultdict
+
 from django.conf import settings
 from django.core.mail.backends.base import  BaseEmailBackend
 from django.core.exceptions import ImproperlyConfigured
 from django.core.mail.backends import smtp
 
+# The idle connections for each sender - (connection, time it was last used), most recent last
+_idle: dict[str, list[tuple[smtp.EmailBackend, float]]] = defaultdict(list)
+_idle_lock = threading.Lock()
+
+
+def email_settings() -> dict:
+    return settings.APPS_SETTINGS.get('GarageSale', {}).get('email', {})
+
+
+def _close(connection:smtp.EmailBackend):
+    try:
+        connection.close()
+    except Exception:
+        pass
+
+
+def _healthy(connection:smtp.EmailBackend) -> bool:
+    """Whether the server is still answering on this connection"""
+    if connection.connection is None:
+        return False
+    try:
+        return connection.connection.noop()[0] == 250
+    except (smtplib.SMTPException, OSError):
+        return False
+
+
+def close_idle_connections():
+    """Close every idle connection in the pool"""
+    with _idle_lock:
+        connections = [connection for idle in _idle.values() for connection, _ in idle]
+        _idle.clear()
+    for connection in connections:
+        _close(connection)
+
 
 class EmailExtended(BaseEmailBackend):
     def send_messages(self, email_messages):
+        batches = defaultdict(list)
         for message in email_messages:
             # Strip out any 'fake users' - ie anyone with fakeuser in their email address
             message.to = [email for email in message.to if not 'fakeuser' in email.replace('.','')]
-            sender = message.from_email
-            connection_details = settings.EMAIL_CREDENTIALS.get(sender.casefold())
-            if not connection_details:
-                raise ImproperlyConfigured(f'No credentials for the email sender {sender}')
-            else:
-                with smtp.EmailBackend(**connection_details) as sender:
-                    sender.send_messages([message])
+            batches[message.from_email.casefold()].append(message)
+
+        # Check every sender before anything is sent - so a batch is never half sent
+        for sender, messages in batches.items():
+            if not settings.EMAIL_CREDENTIALS.get(sender):
+                raise ImproperlyConfigured(f'No credentials for the email sender {messages[0].from_email}')
+
+        sent = 0
+        for sender, messages in batches.items():
+            sent += self._send_batch(sender, messages)
+        return sent
+
+    def _send_batch(self, sender:str, messages) -> int:
+        """Send all of one sender's messages over one connection"""
+        connection = self._checkout(sender)
+        if connection is None:
+            return 0
+
+        sent = 0
+        try:
+            for message in messages:
+                try:
+                    sent += connection.send_messages([message])
+                except (smtplib.SMTPServerDisconnected, ConnectionError):
+                    # The server dropped the connection - reopen it and try this message again
+                    _close(connection)
+                    if not connection.open():
+                        raise
+                    sent += connection.send_messages([message])
+        except Exception:
+            _close(connection)
+            if not self.fail_silently:
+                raise
+            return sent
+
+        self._release(sender, connection)
+        return sent
+
+    def _checkout(self, sender:str) -> smtp.EmailBackend|None:
+        """A healthy idle connection for the sender - or a new one"""
+        idle_timeout = email_settings().get('idle_timeout', 60)
+        now = time.monotonic()
+        while True:
+            with _idle_lock:
+                if not _idle[sender]:
+                    break
+                connection, last_used = _idle[sender].pop()
+            if now - last_used < idle_timeout and _healthy(connection):
+                connection.fail_silently = self.fail_silently
+                return connection
+            _close(connection)
+
+        connection = smtp.EmailBackend(fail_silently=self.fail_silently, **settings.EMAIL_CREDENTIALS[sender])
+        connection.open()
+        return connection if connection.connection else None
+
+    def _release(self, sender:str, connection:smtp.EmailBackend):
+        """Keep the connection for the sender's next batch - unless the pool is full"""
+        pool_size = email_settings().get('pool_size', 1)
+        idle_timeout = email_settings().get('idle_timeout', 60)
+        now = time.monotonic()
+        with _idle_lock:
+            # Close the connections which have been idle too long - for every sender
+            stale = [(key, entry) for key, idle in _idle.items() for entry in idle if now - entry[1] >= idle_timeout]
+            for key, entry in stale:
+                _idle[key].remove(entry)
+            keep = len(_idle[sender]) < pool_size
+            if keep:
+                _idle[sender].append((connection, now))
+        for _, (stale_connection, _) in stale:
+            _close(stale_connection)
+        if not keep:
+            _close(connection)
@@ -11,16 +11,18 @@ Use Case :
 """
 import datetime
 
-import weasyprint
 import mimetypes
-import io
 import logging
+import os
+from concurrent.futures import Future
 import bs4
 from django.contrib.staticfiles import finders
 
 from django.core.mail import EmailMultiAlternatives
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import models, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.db.models import Subquery
 from django.http import HttpRequest
 from django.utils import timezone
@@ -29,6 +31,8 @@ from django_quill.fields import QuillField
 from django.contrib.auth.models import User
 from django.contrib.auth.models import AbstractUser
 
+from GarageSale.services import compiled_templates, pdf as pdf_service
+
 from calendar import day_name, month_name
 import logging
 
@@ -243,6 +247,12 @@ class CommunicationTemplate(models.Model):
         except CommunicationTemplate.DoesNotExist:
             return None
 
+    def compiled(self, part:str, source:str) -> Template:
+        """The compiled template for one part of this template - compiled once while the part is unchanged"""
+        if self.pk is None:
+            return Template(source)
+        return compiled_templates.compiled((self.pk, self.use_from, part), source)
+
     def get_use_from_display(self):
         return f'{day_name[self.use_from.weekday()]} {self.use_from.day} {month_name[self.use_from.month]} {self.use_from.year}'
 
@@ -338,13 +348,13 @@ class CommunicationTemplate(models.Model):
         bcc = context.pop('bcc', [])
 
         logger.debug(f'Rendering body  {self=} for {context=} ')
-        body_template = Template(str(self.html_content))
+        body_template = self.compiled('html_content', str(self.html_content))
         html_body = body_template.render( context=Context(context)) + "<br>-- <br>" + self.signature
 
         msg = EmailMultiAlternatives(
             to=to,
             from_email=from_,
-            subject=Template(self.subject).render(context=Context(context)),
+            subject=self.compiled('subject', self.subject).render(context=Context(context)),
             body=self.html_to_text(html_body),
             bcc=bcc if bcc else []
         )
@@ -360,9 +370,7 @@ class CommunicationTemplate(models.Model):
         if not result:
             return ''
 
-        with open(result) as f:
-            template = Template(f.read())
-        return template.render( context=Context(context))
+        return compiled_templates.compiled_file(result).render( context=Context(context))
 
     def get_header_text(self, request:HttpRequest, context):
         """Get the header text for the email"""
@@ -376,17 +384,50 @@ class CommunicationTemplate(models.Model):
         return CommunicationTemplate.pdf_header_template(context)
 
     @classmethod
-    def pdf_from_template_str(cls, context:dict, template_str:str, header:str = ""):
-        html = io.StringIO(Template(template_str).render(Context(context)))
-        pdf = weasyprint.HTML(html).write_pdf(stylesheets=[weasyprint.CSS(string=header)])
-        return pdf
+    def pdf_from_template_str(cls, context:dict, template_str:str, header:str = "", template:Template|None = None,
+                              cached:bool = False):
+        html = (template or Template(template_str)).render(Context(context))
+        if cached:
+            return pdf_service.render_cached(html, stylesheets=[header])
+        return pdf_service.render(html, stylesheets=[header])
 
     def render_template_as_pdf(self,request:HttpRequest, context):
         """Convert a given template to a PDF - with headers etc."""
         logger.info(f'Rendering template {self} for {context} as a PDF')
 
         header = self.get_header_text(request, context)
-        return CommunicationTemplate.pdf_from_template_str(context, self.html_content, header)
+        return CommunicationTemplate.pdf_from_template_str(context, self.html_content, header,
+                                                           template=self.compiled('html_content', self.html_content),
+                                                           cached=True)
+
+    def submit_template_as_pdf(self, request:HttpRequest, context) -> Future:
+        """Queue the template to be rendered as a PDF by the pdf workers - the future's result is the pdf"""
+        header = self.get_header_text(request, context)
+        html = self.compiled('html_content', self.html_content).render(Context(context))
+        return pdf_service.submit(html, stylesheets=[header])
+
+    def resolved_attachments(self) -> list[tuple[TemplateAttachment, "CommunicationTemplate|None"]]:
+        """The attachments - each generated pdf with the in date template it is rendered from"""
+        attachments = self.attachments.all()
+        logger.info(f'Rendering template {self} - {len(attachments)} attachments')
+
+        resolved = []
+        for attachment in attachments:
+            if attachment.upload:
+                resolved.append((attachment, None))
+                continue
+
+            logger.debug(f'Generating PDF for {self}, {self.category}, {self.transition} {attachment.template_name}')
+            try:
+                content = CommunicationTemplate.current_active.filter(category=self.category).filter(transition=attachment.template_name).order_by("-use_from").latest('use_from')
+            except CommunicationTemplate.DoesNotExist:
+                logger.error(f'Could not find a valid {attachment.template_name} and in date template for {self}')
+                continue
+
+            logger.debug(
+                f'Found named template {content.transition} PDF for {self.category}, {self.transition} {attachment.template_name}')
+            resolved.append((attachment, content))
+        return resolved
 
     def send_email(self, request:HttpRequest, context):
 
@@ -394,31 +435,131 @@ class CommunicationTemplate(models.Model):
 
         msg = self.render_template_as_email(request, context)
 
-        attachments = self.attachments.all()
-        logger.info(f'Rendering template {self} - {len(attachments)} attachments')
-
-        for attachment in attachments:
+        for attachment, content in self.resolved_attachments():
             match attachment.upload:
                 case True:
                     mime_type = mimetypes.guess_type(attachment.attached_file.name)[0]
                     msg.attach_file(attachment.attached_file.path, mime_type)
                 case False:
-                    logger.debug(f'Generating PDF for {self}, {self.category}, {self.transition} {attachment.template_name}')
-                    try:
-                        content = CommunicationTemplate.current_active.filter(category=self.category).filter(transition=attachment.template_name).order_by("-use_from").latest('use_from')
-                    except CommunicationTemplate.DoesNotExist:
-                        logger.error(f'Could not find a valid {attachment.template_name} and in date template for {self}')
-                        content = None
-
-                    if content:
-                        logger.debug(
-                            f'Found named template {content.transition} PDF for {self.category}, {self.transition} {attachment.template_name}')
-                        pdf = content.render_template_as_pdf(request, context)
-                        msg.attach( attachment.template_name+'-'+datetime.datetime.now().isoformat(sep='-')+'.pdf', pdf, 'application/pdf')
+                    pdf = content.render_template_as_pdf(request, context)
+                    msg.attach( attachment.template_name+'-'+datetime.datetime.now().isoformat(sep='-')+'.pdf', pdf, 'application/pdf')
 
         try:
-            ret = msg.send()
-            return ret
+            from GarageSale.services import outbox
+            return outbox.send(msg)
         except Exception as e:
             logger.error(f'Could not send email for {self} for {context} - {e}')
             return None
+
+    def send_bulk(self, recipients_contexts, request:HttpRequest|None = None) -> int:
+        """Mail merge - send this template to many recipients, each with their own context (including 'email')
+
+            The attachments are found once; uploaded files are read once, and a generated pdf which reads
+            nothing that differs between the recipients is rendered once and attached to every email.
+            The emails are rendered here one after another, while the pdfs which do differ are rendered
+            by the pdf workers (see GarageSale.services.pdf) - and all of the emails are sent (or queued) together.
+
+            :return: The number of emails sent or queued
+        """
+        contexts = [dict(context) for context in recipients_contexts]
+        if not contexts:
+            return 0
+
+        # The context names which differ between the recipients
+        missing = object()
+        personal = {name for name in set().union(*contexts)
+                        if any(context.get(name, missing) != contexts[0].get(name, missing) for context in contexts)}
+
+        # Each attachment is either the same for everyone - (name, content, mime type) - or rendered for each recipient
+        stamp = datetime.datetime.now().isoformat(sep='-')
+        parts = []
+        for attachment, content in self.resolved_attachments():
+            if attachment.upload:
+                with attachment.attached_file.open('rb') as f:
+                    parts.append((None, (os.path.basename(attachment.attached_file.name), f.read(),
+                                         mimetypes.guess_type(attachment.attached_file.name)[0])))
+            elif compiled_templates.variables(content.html_content) & personal:
+                parts.append((content, attachment.template_name + '-' + stamp + '.pdf'))
+            else:
+                pdf = content.render_template_as_pdf(request, dict(contexts[0]))
+                parts.append((None, (attachment.template_name + '-' + stamp + '.pdf', pdf, 'application/pdf')))
+
+        # Render every email (submitting its personal pdfs to the workers), then collect the pdfs
+        merged = []
+        for context in contexts:
+            try:
+                msg = self.render_template_as_email(request, context)
+                merged.append((context, msg, [(part, content.submit_template_as_pdf(request, context) if content else None)
+                                              for content, part in parts]))
+            except Exception as e:
+                logger.error(f'Could not render email for {self} for {context} - {e}')
+
+        messages = []
+        for context, msg, attachments in merged:
+            try:
+                for part, future in attachments:
+                    if future is None:
+                        msg.attach(*part)
+                    else:
+                        msg.attach(part, pdf_service.result(future), 'application/pdf')
+                messages.append(msg)
+            except Exception as e:
+                logger.error(f'Could not render email for {self} for {context} - {e}')
+
+        try:
+            from GarageSale.services import outbox
+            return outbox.send_many(messages)
+        except Exception as e:
+            logger.error(f'Could not send the mail merge for {self} - {e}')
+            return 0
+
+
+@receiver([post_save, post_delete], sender=CommunicationTemplate)
+def communication_template_changed(instance, **kwargs):
+    """Discard the compiled parts of the template (see GarageSale.services.compiled_templates)"""
+    compiled_templates.invalidate(instance.pk)
+
+
+class OutboundEmailManager(models.Manager):
+    def claim_due(self, limit:int, claim_timeout:float) -> list["OutboundEmail"]:
+        """Claim the emails which are due to be sent - so that only one worker sends each of them.
+           An email claimed by a worker which has since died is claimed again after claim_timeout seconds"""
+        now = timezone.now()
+        with transaction.atomic():
+            emails = list(self.select_for_update(skip_locked=True).
+                            filter(models.Q(status=OutboundEmail.Status.QUEUED, next_attempt__lte=now) |
+                                   models.Q(status=OutboundEmail.Status.SENDING,
+                                            claimed_at__lte=now - datetime.timedelta(seconds=claim_timeout))).
+                            order_by('next_attempt', 'id')[:limit])
+            self.filter(pk__in=[email.pk for email in emails]).update(status=OutboundEmail.Status.SENDING, claimed_at=now)
+        return emails
+
+
+class OutboundEmail(models.Model):
+    """An email waiting to be sent - sent by the SendQueuedEmail management command"""
+    class Status(models.TextChoices):
+        QUEUED = 'Queued', 'Queued'
+        SENDING = 'Sending', 'Sending'
+        SENT = 'Sent', 'Sent'
+        FAILED = 'Failed', 'Failed'
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [models.Index(name='OutboundEmailDue', fields=['status', 'next_attempt'])]
+
+    objects = OutboundEmailManager()
+    sender = models.CharField(max_length=254)
+    recipients = models.JSONField(default=list)
+    subject = models.CharField(max_length=255, blank=True, default='')
+    message = models.BinaryField()
+    attachments = models.BinaryField()
+    status = models.CharField(max_length=10, choices=Status.choices, default=Status.QUEUED)
+    attempts = models.IntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now)
+    last_error = models.CharField(max_length=200, blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f'{self.subject} from {self.sender} to {", ".join(self.recipients)} - {self.status}'
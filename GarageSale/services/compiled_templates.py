@@ -0,0 +1,112 @@
+"""
+    GarageSale.services.compiled_templates.py :
+
+Summary :
+    A cache of compiled Django templates - for the communication templates and the pdf header.
+
+    A CommunicationTemplate is compiled from its source every time it is rendered - for a mail
+    merge to a few hundred recipients that is a few hundred compiles of the same template. Instead
+    the compiled template is kept, keyed by :
+
+        * the communication template's id, use_from date and which part it is (subject, body ...),
+          together with a hash of the source - so an edited template is never served stale, even
+          by a process which didn't see the edit
+        * the path and modification time for a template read from a file (the pdf header css) - so
+          the file is only read again when it changes
+
+    Saving or deleting a CommunicationTemplate discards its compiled parts in this process
+    (see the receivers in GarageSale.models). The cache holds the most recently used templates.
+
+    Usage :
+        template = compiled((comm_template.id, comm_template.use_from, 'subject'), comm_template.subject)
+        template = compiled_file(finders.find('GarageSale/styles/pdf_header.css'))
+        invalidate(comm_template.id)
+        variables(source)               # The names the template reads from its context
+
+    Settings - APPS_SETTINGS['GarageSale']['templates'] :
+        cache_size : The most compiled templates kept (default 128)
+"""
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+from django.conf import settings
+from django.template import Template
+from django.template.base import Lexer, TokenType
+
+_templates: OrderedDict[tuple, tuple[object, Template]] = OrderedDict()
+_lock = threading.Lock()
+
+
+def template_settings() -> dict:
+    return settings.APPS_SETTINGS.get('GarageSale', {}).get('templates', {})
+
+
+def _cached(key:tuple, version, source):
+    """The compiled template for the key - compiled from source() if the cached version is out of date"""
+    with _lock:
+        entry = _templates.get(key)
+        if entry and entry[0] == version:
+            _templates.move_to_end(key)
+            return entry[1]
+
+    template = Template(source())
+    with _lock:
+        _templates[key] = (version, template)
+        _templates.move_to_end(key)
+        while len(_templates) > template_settings().get('cache_size', 128):
+            _templates.popitem(last=False)
+    return template
+
+
+def compiled(key:tuple, source:str) -> Template:
+    """The compiled template for this source - key identifies where the source came from"""
+    return _cached(key, hashlib.sha1(source.encode()).digest(), lambda: source)
+
+
+def compiled_file(path:str) -> Template:
+    """The compiled template held in a file - read again only when the file changes"""
+    stat = os.stat(path)
+
+    def source():
+        with open(path) as f:
+            return f.read()
+
+    return _cached(('file', path), (stat.st_mtime_ns, stat.st_size), source)
+
+
+def invalidate(template_id=None):
+    """Discard the compiled parts of one communication template - or every compiled template"""
+    with _lock:
+        if template_id is None:
+            _templates.clear()
+            return
+        for key in [key for key in _templates if key[0] == template_id]:
+            del _templates[key]
+
+
+_QUOTED = re.compile(r'"[^"]*"|\'[^\']*\'')
+_FILTER = re.compile(r'\|\s*\w+')
+_NAME = re.compile(r'(?<![\w.])[A-Za-z_]\w*')
+
+
+@lru_cache(maxsize=128)
+def variables(source:str) -> frozenset[str]:
+    """The names the template reads from its context - 'event' for {{ event.date }}.
+       Every name in a tag is counted (the loop variable of a for, and words like 'and' or 'in'), so this
+       can be more names than the template reads - but never fewer (unless it uses {% include %})"""
+    names = set()
+    for token in Lexer(source).tokenize():
+        match token.token_type:
+            case TokenType.VAR:
+                text = token.contents
+            case TokenType.BLOCK:
+                # Leave out the name of the tag itself
+                text = token.contents.partition(' ')[2]
+            case _:
+                continue
+        names.update(_NAME.findall(_FILTER.sub(' ', _QUOTED.sub(' ', text))))
+    return frozenset(names)
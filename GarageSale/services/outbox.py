@@ -0,0 +1,182 @@
+"""
+    GarageSale.services.outbox.py :
+
+Summary :
+    A queue of outbound email - sent by a background worker rather than in the request.
+
+    Sending an email in the request means the page waits for the mail server (and a failure is
+    only logged). Instead each email is saved as an OutboundEmail and the SendQueuedEmail
+    management command sends them :
+
+        * the emails are sent through the configured email backend - EmailExtended in production,
+          which keeps a pooled connection for each sender
+        * an email which fails is tried again later - waiting twice as long after each failure -
+          until max_attempts have failed
+        * no sender sends more than its rate limit in any minute - the rest wait for the next
+          minute (without counting as a failed attempt)
+
+    When the email backend isn't EmailExtended (during development and in tests) the emails are
+    sent straight away - so they are seen at once.
+
+    Usage :
+        outbox.send(message)                # Queue the message (an EmailMessage) - or send it now
+        outbox.send_many(messages)          # Queue the messages - or send them now over one connection
+        outbox.deliver_due()                # Send the emails which are due - returns (sent, failed)
+
+    Settings - APPS_SETTINGS['GarageSale']['email'] :
+        queue : Whether email is queued (default - only when the email backend is EmailExtended)
+        batch_size : The most emails a worker claims at once (default 50)
+        max_attempts : Failed attempts before an email is abandoned (default 6)
+        retry_delay : Seconds before the first retry - doubled after each failure (default 60)
+        max_retry_delay : The longest wait between retries (default 3600)
+        rate_limits : {sender : emails per minute} - for the senders with a limit
+        default_rate_limit : Emails per minute for any other sender (default 0 - no limit)
+        claim_timeout : Seconds before emails claimed by a dead worker are claimed again (default 600)
+"""
+import datetime
+import logging
+import pickle
+import time
+from collections import defaultdict, deque
+
+from django.conf import settings
+from django.core.mail import get_connection
+from django.utils import timezone
+
+from GarageSale.models import OutboundEmail
+
+logger = logging.getLogger(__name__)
+
+
+def email_settings() -> dict:
+    return settings.APPS_SETTINGS.get('GarageSale', {}).get('email', {})
+
+
+def queueing() -> bool:
+    return email_settings().get('queue', settings.EMAIL_BACKEND == 'GarageSale.middleware.email.EmailExtended')
+
+
+def _outbound(message) -> OutboundEmail:
+    """The (unsaved) queued email for the message - the message and its attachments are saved separately"""
+    attachments, message.attachments = message.attachments, []
+    message.connection = None
+    try:
+        return OutboundEmail(sender=message.from_email.casefold(),
+                             recipients=message.recipients(),
+                             subject=message.subject[:255],
+                             message=pickle.dumps(message),
+                             attachments=pickle.dumps(attachments))
+    finally:
+        message.attachments = attachments
+
+
+def send(message) -> int:
+    """Queue the message for the worker - or send it now when email isn't queued"""
+    if not queueing():
+        return message.send()
+
+    _outbound(message).save()
+    return 1
+
+
+def send_many(messages) -> int:
+    """Queue the messages for the worker - or send them now over one connection when email isn't queued"""
+    if not messages:
+        return 0
+    if not queueing():
+        return get_connection().send_messages(messages)
+
+    OutboundEmail.objects.bulk_create([_outbound(message) for message in messages])
+    return len(messages)
+
+
+def load(email:OutboundEmail):
+    """The EmailMessage saved for the queued email"""
+    message = pickle.loads(email.message)
+    message.attachments = pickle.loads(email.attachments)
+    return message
+
+
+class RateLimiter:
+    """Count the emails each sender sends in a rolling minute"""
+    def __init__(self, limits:dict, default:int, window:float = 60.0):
+        self.limits = {sender.casefold(): limit for sender, limit in limits.items()}
+        self.default, self.window = default, window
+        self._sent = defaultdict(deque)
+
+    def _recent(self, sender:str, now:float) -> deque:
+        sent = self._sent[sender]
+        while sent and now - sent[0] >= self.window:
+            sent.popleft()
+        return sent
+
+    def allow(self, sender:str) -> bool:
+        """Whether the sender can send now - if so the send is counted"""
+        limit = self.limits.get(sender, self.default)
+        now = time.monotonic()
+        sent = self._recent(sender, now)
+        if limit and len(sent) >= limit:
+            return False
+        sent.append(now)
+        return True
+
+    def wait(self, sender:str) -> float:
+        """Seconds until the sender can send again"""
+        sent = self._recent(sender, time.monotonic())
+        return max(self.window - (time.monotonic() - sent[0]), 0.0) if sent else 0.0
+
+
+_limiter: RateLimiter|None = None
+
+
+def rate_limiter() -> RateLimiter:
+    """The rate limits for this worker - shared by every call to deliver_due"""
+    global _limiter
+    if _limiter is None:
+        _limiter = RateLimiter(email_settings().get('rate_limits', {}), email_settings().get('default_rate_limit', 0))
+    return _limiter
+
+
+def retry_delay(attempts:int) -> float:
+    """Seconds to wait after the given number of failed attempts"""
+    return min(email_settings().get('retry_delay', 60) * 2 ** (attempts - 1), email_settings().get('max_retry_delay', 3600))
+
+
+def deliver_due(limit:int|None = None) -> tuple[int, int]:
+    """Send the emails which are due - returns the number sent and the number which failed"""
+    options = email_settings()
+    emails = OutboundEmail.objects.claim_due(limit or options.get('batch_size', 50), options.get('claim_timeout', 600))
+    if not emails:
+        return 0, 0
+
+    limiter = rate_limiter()
+    sent = failed = 0
+    with get_connection(fail_silently=False) as connection:
+        for email in emails:
+            now = timezone.now()
+            if not limiter.allow(email.sender):
+                # Over the rate limit - put it back until the sender can send again
+                email.status = OutboundEmail.Status.QUEUED
+                email.next_attempt = now + datetime.timedelta(seconds=limiter.wait(email.sender))
+                email.save(update_fields=['status', 'next_attempt'])
+                continue
+
+            try:
+                connection.send_messages([load(email)])
+            except Exception as e:
+                failed += 1
+                email.attempts += 1
+                email.last_error = str(e)[:200]
+                if email.attempts >= options.get('max_attempts', 6):
+                    logger.error(f'Abandoned email {email.id} after {email.attempts} attempts - {e}')
+                    email.status = OutboundEmail.Status.FAILED
+                else:
+                    logger.warning(f'Could not send email {email.id} (attempt {email.attempts}) - {e}')
+                    email.status = OutboundEmail.Status.QUEUED
+                    email.next_attempt = now + datetime.timedelta(seconds=retry_delay(email.attempts))
+                email.save(update_fields=['attempts', 'last_error', 'status', 'next_attempt'])
+            else:
+                sent += 1
+                email.status, email.sent_at = OutboundEmail.Status.SENT, now
+                email.save(update_fields=['status', 'sent_at'])
+    return sent, failed
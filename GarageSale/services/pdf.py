@@ -0,0 +1,185 @@
+"""
+    GarageSale.services.pdf.py :
+
+Summary :
+    PDF rendering in a pool of worker processes.
+
+    WeasyPrint is CPU heavy - rendering a multi-page report or a sheet of id cards can take
+    seconds - so rather than rendering in the request thread, PDFs are rendered by a pool of
+    worker processes. Each worker imports WeasyPrint and loads the fonts as it starts, and keeps
+    the stylesheets it has parsed, so a request only pays for the layout itself; and several PDFs
+    can be rendered at once.
+
+    Usage :
+        pdf = render(html, stylesheets=[css])          # Wait for the pdf (up to the timeout)
+
+        future = submit(html, stylesheets=[css])       # Or submit now, and wait later
+        ...
+        pdf = result(future)
+
+        pdf = render_cached(html, stylesheets=[css])   # Render only if this html hasn't been rendered before
+
+    Generated email attachments are often identical for every recipient (terms and conditions for
+    instance), so render_cached keeps each pdf in the cache - keyed by a hash of the rendered html
+    and the stylesheets, which is the template with the values of exactly the variables it uses. An
+    identical pdf is rendered once, however many emails it is attached to.
+
+    The pdfs are kept in the 'pdf' cache (see CACHES in GarageSale.settings) - a FileBasedCache, so
+    every web and worker process shares them. The default cache is held in each process.
+
+    Settings - APPS_SETTINGS['GarageSale']['pdf'] :
+        workers : The number of worker processes (default 2) - 0 renders in the calling thread
+        timeout : Seconds to wait for a pdf (default 60)
+        start_method : The multiprocessing start method for the workers (default 'forkserver')
+        cache : The CACHES alias render_cached keeps pdfs in (default 'pdf')
+        cache_timeout : Seconds a cached pdf is kept (default 86400) - 0 turns off the cache
+        cache_max_size : The largest pdf which is cached, in bytes (default 2MB)
+"""
+import hashlib
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+_pool: ProcessPoolExecutor | None = None
+_pool_lock = threading.Lock()
+
+
+class PdfRenderError(Exception):
+    """The pdf could not be rendered - either the worker failed or it took too long"""
+
+
+def pdf_settings() -> dict:
+    return settings.APPS_SETTINGS.get('GarageSale', {}).get('pdf', {})
+
+
+# ---- These run in the worker processes ----
+
+@lru_cache(maxsize=1)
+def _font_config():
+    from weasyprint.text.fonts import FontConfiguration
+    return FontConfiguration()
+
+
+@lru_cache(maxsize=32)
+def _stylesheet(css:str):
+    import weasyprint
+    return weasyprint.CSS(string=css, font_config=_font_config())
+
+
+def _warm_up():
+    """Load WeasyPrint and the fonts before the first pdf is requested"""
+    import weasyprint
+    weasyprint.HTML(string='<p>Warm up</p>').write_pdf(font_config=_font_config())
+
+
+def _render(html:str, stylesheets:tuple[str, ...], base_url:str|None) -> bytes:
+    import weasyprint
+    return weasyprint.HTML(string=html, base_url=base_url).write_pdf(
+                                    stylesheets=[_stylesheet(css) for css in stylesheets],
+                                    font_config=_font_config())
+
+# ----
+
+
+def _get_pool() -> ProcessPoolExecutor | None:
+    """The pool of warm workers - started on first use"""
+    global _pool
+    workers = pdf_settings().get('workers', 2)
+    if not workers:
+        return None
+
+    with _pool_lock:
+        if _pool is None:
+            context = multiprocessing.get_context(pdf_settings().get('start_method', 'forkserver'))
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_warm_up)
+            logger.info(f'Started pdf rendering pool with {workers} workers')
+        return _pool
+
+
+def _discard_pool(pool:ProcessPoolExecutor|None, terminate:bool = False):
+    """A worker has died (or is stuck, when terminate) - the next pdf starts a new pool"""
+    global _pool
+    if pool is None:
+        return
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    # Shutting down doesn't stop a pdf being rendered - the worker has to be stopped
+    workers = list((pool._processes or {}).values()) if terminate else []
+    pool.shutdown(wait=False, cancel_futures=True)
+    for worker in workers:
+        worker.terminate()
+
+
+def submit(html:str, stylesheets=(), base_url:str|None = None) -> Future:
+    """Queue the html to be rendered as a pdf - the future's result is the pdf"""
+    stylesheets = tuple(stylesheets)
+    pool = _get_pool()
+    if pool is None:
+        future = Future()
+        try:
+            future.set_result(_render(html, stylesheets, base_url))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    try:
+        future = pool.submit(_render, html, stylesheets, base_url)
+    except BrokenProcessPool:
+        _discard_pool(pool)
+        pool = _get_pool()
+        future = pool.submit(_render, html, stylesheets, base_url)
+    # The pool rendering it - which is the one to discard if it fails, even once another has replaced it
+    future._pdf_pool = pool
+    return future
+
+
+def render(html:str, stylesheets=(), base_url:str|None = None, timeout:float|None = None) -> bytes:
+    """Render the html as a pdf - waiting for a worker to render it"""
+    return result(submit(html, stylesheets, base_url), timeout)
+
+
+def result(future:Future, timeout:float|None = None) -> bytes:
+    """Wait for a submitted pdf"""
+    timeout = timeout if timeout else pdf_settings().get('timeout', 60)
+    try:
+        return future.result(timeout)
+    except FutureTimeout:
+        if not future.cancel():
+            # Already being rendered - stop the worker, rather than leave it busy with a pdf nobody is waiting for.
+            # Any other pdf the pool is rendering fails as well.
+            logger.warning(f'pdf not rendered within {timeout} seconds - restarting the pdf workers')
+            _discard_pool(getattr(future, '_pdf_pool', None), terminate=True)
+        raise PdfRenderError(f'pdf not rendered within {timeout} seconds')
+    except BrokenProcessPool as e:
+        _discard_pool(getattr(future, '_pdf_pool', None))
+        raise PdfRenderError(f'pdf worker failed : {e}')
+
+
+def render_cached(html:str, stylesheets=(), base_url:str|None = None, timeout:float|None = None) -> bytes:
+    """Render the html as a pdf - unless an identical pdf is in the cache"""
+    cache_timeout = pdf_settings().get('cache_timeout', 86400)
+    if not cache_timeout:
+        return render(html, stylesheets, base_url, timeout)
+
+    digest = hashlib.sha256()
+    for part in (html, *stylesheets, base_url or ''):
+        digest.update(part.encode())
+        digest.update(b'\0')
+    key = f'GarageSale.pdf:{digest.hexdigest()}'
+
+    cache = caches[pdf_settings().get('cache', 'pdf')]
+    pdf = cache.get(key)
+    if pdf is None:
+        pdf = render(html, stylesheets, base_url, timeout)
+        if len(pdf) <= pdf_settings().get('cache_max_size', 2 * 1024 * 1024):
+            cache.set(key, pdf, cache_timeout)
+    return pdf
@@ -212,6 +212,16 @@ DATABASES = db_credentials.db_credentials(BASE_DIR)
 
 SESSION_COOKIE_AGE = 365 * 24 * 60 * 60  # Allow upto 365 days between log ins.
 
+# Caches
+# The default cache is held in each process. Generated pdfs are kept on disk instead - so a pdf rendered by
+# one web or worker process is reused by every other (see GarageSale.services.pdf).
+CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'pdf': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': BASE_DIR / 'cache' / 'pdf',
+            'OPTIONS': {'MAX_ENTRIES': 1000}},
+}
+
 APPS_SETTINGS = {
     'user_management': {'EMAIL_SENDER': 'website@branthamgaragesale.org.uk',
                         'SITE_NAME': 'Brantham Garage Sale',
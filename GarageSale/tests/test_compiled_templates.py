@@ -0,0 +1,64 @@
+"""
+Tests of the compiled template cache - templates are compiled once, until they change.
+"""
+import datetime
+import os
+import tempfile
+from unittest import mock
+
+from django.template import Context, Template
+from django.test import TestCase
+
+from GarageSale.models import CommunicationTemplate
+from GarageSale.services import compiled_templates
+
+
+class CompiledTemplateTests(TestCase):
+    def setUp(self):
+        self.addCleanup(compiled_templates.invalidate)
+        self.template = CommunicationTemplate.objects.create(category='Test', transition='invite',
+                                                             subject='Invite for {{ name }}',
+                                                             html_content='<p>Hello {{ name }}</p>',
+                                                             signature='The Team',
+                                                             use_from=datetime.date(2025, 1, 1))
+        patcher = mock.patch.object(compiled_templates, 'Template', wraps=Template)
+        self.compiles = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def render(self, name):
+        return self.template.render_template_as_email(None, {'email': ['a@test.com'], 'from': 'chair@test.com', 'name': name})
+
+    def test_100_compiled_once(self):
+        """A mail merge compiles the subject and body once"""
+        messages = [self.render(name) for name in ('Alice', 'Bob', 'Carol')]
+        self.assertEqual([msg.subject for msg in messages], ['Invite for Alice', 'Invite for Bob', 'Invite for Carol'])
+        self.assertEqual(self.compiles.call_count, 2)
+
+    def test_110_recompiled_when_changed(self):
+        """Saving the template discards the compiled copy - and a changed source is compiled again even without the save"""
+        self.render('Alice')
+        self.template.subject = 'Welcome {{ name }}'
+        self.template.save()
+        self.assertEqual(self.render('Alice').subject, 'Welcome Alice')
+        self.assertEqual(self.compiles.call_count, 4)
+
+        # A copy changed in another process - the hash of the source no longer matches
+        CommunicationTemplate.objects.filter(pk=self.template.pk).update(subject='Hello {{ name }}')
+        self.template.refresh_from_db()
+        self.assertEqual(self.render('Bob').subject, 'Hello Bob')
+        self.assertEqual(self.compiles.call_count, 5)
+
+    def test_120_file_recompiled_when_modified(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.css', delete=False) as css:
+            css.write('@page { @top-center { content: "{{ summary }}" } }')
+        self.addCleanup(os.unlink, css.name)
+
+        self.assertIn('"Report"', compiled_templates.compiled_file(css.name).render(Context({'summary': 'Report'})))
+        compiled_templates.compiled_file(css.name)
+        self.assertEqual(self.compiles.call_count, 1)
+
+        with open(css.name, 'w') as f:
+            f.write('@page { size: A4 }')
+        os.utime(css.name, ns=(0, os.stat(css.name).st_mtime_ns + 1_000_000))
+        self.assertEqual(compiled_templates.compiled_file(css.name).source, '@page { size: A4 }')
+        self.assertEqual(self.compiles.call_count, 2)
@@ -0,0 +1,110 @@
+"""
+Tests of the email backend - batched by sender, with a pool of idle connections.
+"""
+import smtplib
+from unittest import mock
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.mail import EmailMessage
+from django.test import SimpleTestCase, override_settings
+
+from GarageSale.middleware import email as email_backend
+
+CREDENTIALS = {'chair@test.com': {'host': 'smtp.test.com', 'username': 'chair@test.com', 'password': 'wibble'},
+               'secretary@test.com': {'host': 'smtp.test.com', 'username': 'secretary@test.com', 'password': 'wobble'}}
+
+
+class FakeSMTP:
+    """Stands in for smtplib.SMTP - records what is sent, and can drop the connection"""
+    opened = []
+
+    def __init__(self, host, port, **kwargs):
+        self.sent, self.alive = [], True
+        FakeSMTP.opened.append(self)
+
+    def login(self, username, password):
+        self.username = username
+
+    def noop(self):
+        if not self.alive:
+            raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+        return 250, b'OK'
+
+    def sendmail(self, from_email, recipients, message):
+        if not self.alive:
+            raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+        self.sent.append(recipients)
+        return {}
+
+    def quit(self):
+        self.alive = False
+
+    close = quit
+
+
+def message(sender, *recipients):
+    return EmailMessage(subject='Hello', body='Hello', from_email=sender, to=list(recipients))
+
+
+@override_settings(EMAIL_CREDENTIALS=CREDENTIALS, APPS_SETTINGS={'GarageSale': {'email': {'pool_size': 1}}})
+class EmailBackendTests(SimpleTestCase):
+    def setUp(self):
+        FakeSMTP.opened = []
+        patcher = mock.patch('django.core.mail.backends.smtp.EmailBackend.connection_class', FakeSMTP)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(email_backend.close_idle_connections)
+
+    def test_100_batched_by_sender(self):
+        """One connection for each sender - and fake users are never sent to"""
+        sent = email_backend.EmailExtended().send_messages(
+                    [message('chair@test.com', 'a@test.com'), message('Secretary@test.com', 'b@test.com'),
+                     message('chair@test.com', 'c@test.com', 'fake.user1@test.com')])
+        self.assertEqual(sent, 3)
+        self.assertEqual([(smtp.username, smtp.sent) for smtp in FakeSMTP.opened],
+                         [('chair@test.com', [['a@test.com'], ['c@test.com']]),
+                          ('secretary@test.com', [['b@test.com']])])
+
+    def test_110_connection_reused(self):
+        """The next batch reuses the idle connection - unless the server has dropped it"""
+        backend = email_backend.EmailExtended()
+        backend.send_messages([message('chair@test.com', 'a@test.com')])
+        backend.send_messages([message('chair@test.com', 'b@test.com')])
+        self.assertEqual(len(FakeSMTP.opened), 1)
+
+        FakeSMTP.opened[0].alive = False
+        backend.send_messages([message('chair@test.com', 'c@test.com')])
+        self.assertEqual(len(FakeSMTP.opened), 2)
+        self.assertEqual(FakeSMTP.opened[1].sent, [['c@test.com']])
+
+    @override_settings(APPS_SETTINGS={'GarageSale': {'email': {'idle_timeout': 0}}})
+    def test_120_idle_timeout(self):
+        backend = email_backend.EmailExtended()
+        backend.send_messages([message('chair@test.com', 'a@test.com')])
+        backend.send_messages([message('chair@test.com', 'b@test.com')])
+        self.assertEqual(len(FakeSMTP.opened), 2)
+        self.assertFalse(FakeSMTP.opened[0].alive)
+
+    def test_130_reconnect(self):
+        """A connection dropped part way through a batch is reopened - and the failed message sent again"""
+        def drop_after_first(smtp_sendmail):
+            calls = []
+            def sendmail(self, *args):
+                calls.append(args)
+                if len(calls) == 2:
+                    self.alive = False
+                return smtp_sendmail(self, *args)
+            return sendmail
+
+        with mock.patch.object(FakeSMTP, 'sendmail', drop_after_first(FakeSMTP.sendmail)):
+            sent = email_backend.EmailExtended().send_messages(
+                        [message('chair@test.com', f'{name}@test.com') for name in 'abc'])
+        self.assertEqual(sent, 3)
+        self.assertEqual([smtp.sent for smtp in FakeSMTP.opened], [[['a@test.com']], [['b@test.com'], ['c@test.com']]])
+
+    def test_140_unknown_sender(self):
+        """A sender with no credentials is rejected before anything is sent"""
+        with self.assertRaisesRegex(ImproperlyConfigured, 'No credentials for the email sender treasurer@test.com'):
+            email_backend.EmailExtended().send_messages([message('chair@test.com', 'a@test.com'),
+                                                         message('treasurer@test.com', 'b@test.com')])
+        self.assertEqual(FakeSMTP.opened, [])
@@ -0,0 +1,83 @@
+"""
+Tests of the mail merge - one template sent to many recipients.
+"""
+import datetime
+from unittest import mock
+
+from django.core import mail
+from django.core.cache import caches
+from django.core.mail.backends import locmem
+from django.test import TestCase, override_settings
+
+from GarageSale.models import CommunicationTemplate, OutboundEmail, TemplateAttachment
+from GarageSale.services import compiled_templates
+from GarageSale.tests.test_pdf import TEST_CACHES
+
+RECIPIENTS = [{'email': [f'{name.lower()}@test.com'], 'name': name, 'from': 'chair@test.com', 'event': 'Garage Sale'}
+              for name in ('Alice', 'Bob', 'Carol')]
+
+
+@override_settings(CACHES=TEST_CACHES, APPS_SETTINGS={'GarageSale': {'pdf': {'workers': 0}}})
+class MailMergeTests(TestCase):
+    def setUp(self):
+        self.addCleanup(compiled_templates.invalidate)
+        self.addCleanup(caches['pdf'].clear)
+        use_from = datetime.date(2025, 1, 1)
+        self.template = CommunicationTemplate.objects.create(category='Sponsors', transition='thanks',
+                                                             subject='Thank you {{ name }}',
+                                                             html_content='<p>Dear {{ name }}, thank you for supporting the {{ event }}</p>',
+                                                             signature='The Team', use_from=use_from)
+        for name, content in (('terms', '<p>Terms for the {{ event }}</p>'), ('certificate', '<p>Certificate for {{ name }}</p>')):
+            CommunicationTemplate.objects.create(category='Sponsors', transition=name, subject=name,
+                                                 html_content=content, use_from=use_from)
+            TemplateAttachment.objects.create(template=self.template, upload=False, template_name=name)
+
+        patcher = mock.patch('GarageSale.models.pdf_service._render', side_effect=lambda html, stylesheets, base_url: html.encode())
+        self.render_pdf = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_100_merged(self):
+        """Each recipient gets their own email - the shared pdf is rendered once, the personal pdf for each"""
+        with mock.patch.object(locmem.EmailBackend, 'send_messages', autospec=True,
+                               side_effect=locmem.EmailBackend.send_messages) as send_messages:
+            self.assertEqual(self.template.send_bulk(RECIPIENTS), 3)
+        send_messages.assert_called_once()
+
+        self.assertEqual([(msg.to, msg.subject) for msg in mail.outbox],
+                         [(['alice@test.com'], 'Thank you Alice'), (['bob@test.com'], 'Thank you Bob'),
+                          (['carol@test.com'], 'Thank you Carol')])
+        for msg, name in zip(mail.outbox, ('Alice', 'Bob', 'Carol')):
+            with self.subTest(name=name):
+                terms, certificate = [content for _, content, _ in msg.attachments]
+                self.assertEqual(terms, b'<p>Terms for the Garage Sale</p>')
+                self.assertEqual(certificate, f'<p>Certificate for {name}</p>'.encode())
+        self.assertEqual(self.render_pdf.call_count, 4)
+
+    @override_settings(APPS_SETTINGS={'GarageSale': {'email': {'queue': True}, 'pdf': {'workers': 0}}})
+    def test_110_queued(self):
+        self.assertEqual(self.template.send_bulk(RECIPIENTS), 3)
+        self.assertEqual(mail.outbox, [])
+        self.assertEqual(sorted(email.recipients[0] for email in OutboundEmail.objects.all()),
+                         ['alice@test.com', 'bob@test.com', 'carol@test.com'])
+
+    def test_120_nobody(self):
+        self.assertEqual(self.template.send_bulk([]), 0)
+        self.render_pdf.assert_not_called()
+
+    def test_130_cached_across_sends(self):
+        """A pdf which is the same for everyone isn't rendered again for a later email"""
+        self.template.send_email(None, dict(RECIPIENTS[0]))
+        self.template.send_email(None, dict(RECIPIENTS[1]))
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(self.render_pdf.call_count, 3)
+
+    def test_140_failed_pdf(self):
+        """A recipient whose pdf can't be rendered is left out - everyone else is sent their email"""
+        def render(html, stylesheets, base_url):
+            if 'Bob' in html:
+                raise ValueError('Bad html')
+            return html.encode()
+
+        self.render_pdf.side_effect = render
+        self.assertEqual(self.template.send_bulk(RECIPIENTS), 2)
+        self.assertEqual([msg.to for msg in mail.outbox], [['alice@test.com'], ['carol@test.com']])
@@ -0,0 +1,93 @@
+"""
+Tests of the outbound email queue - queued in the request, and sent by the worker.
+"""
+import datetime
+import smtplib
+from unittest import mock
+
+from django.core import mail
+from django.core.mail import EmailMultiAlternatives
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from GarageSale.models import OutboundEmail
+from GarageSale.services import outbox
+
+QUEUED = {'GarageSale': {'email': {'queue': True, 'retry_delay': 60, 'max_attempts': 2}}}
+
+
+def message(sender='chair@test.com', to='a@test.com'):
+    msg = EmailMultiAlternatives(subject='Hello', body='Hello', from_email=sender, to=[to])
+    msg.attach_alternative('<p>Hello</p>', 'text/html')
+    return msg
+
+
+@override_settings(APPS_SETTINGS=QUEUED)
+class OutboxTests(TestCase):
+    def setUp(self):
+        self.addCleanup(setattr, outbox, '_limiter', None)
+
+    @override_settings(APPS_SETTINGS={})
+    def test_100_sent_at_once(self):
+        """Without the production email backend the email is sent straight away"""
+        outbox.send(message())
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertFalse(OutboundEmail.objects.exists())
+
+    def test_110_queued_and_delivered(self):
+        """A queued email is sent by the worker - with its alternatives and attachments intact"""
+        msg = message()
+        msg.attach('terms.pdf', b'%PDF-1.7', 'application/pdf')
+        self.assertEqual(outbox.send(msg), 1)
+        self.assertEqual(mail.outbox, [])
+        email = OutboundEmail.objects.get()
+        self.assertEqual((email.sender, email.recipients, email.status), ('chair@test.com', ['a@test.com'], 'Queued'))
+
+        self.assertEqual(outbox.deliver_due(), (1, 0))
+        self.assertEqual(mail.outbox[0].to, ['a@test.com'])
+        self.assertEqual(mail.outbox[0].alternatives[0][0], '<p>Hello</p>')
+        self.assertEqual(mail.outbox[0].attachments, [('terms.pdf', b'%PDF-1.7', 'application/pdf')])
+        email.refresh_from_db()
+        self.assertEqual(email.status, OutboundEmail.Status.SENT)
+        self.assertEqual(outbox.deliver_due(), (0, 0))
+
+    def test_120_retried_with_backoff(self):
+        """A failed email is retried after a growing delay - and abandoned after max_attempts"""
+        outbox.send(message())
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages',
+                        side_effect=smtplib.SMTPServerDisconnected('Connection unexpectedly closed')):
+            self.assertEqual(outbox.deliver_due(), (0, 1))
+            email = OutboundEmail.objects.get()
+            self.assertEqual((email.status, email.attempts), ('Queued', 1))
+            self.assertAlmostEqual(email.next_attempt, timezone.now() + datetime.timedelta(seconds=60),
+                                   delta=datetime.timedelta(seconds=5))
+
+            # Not due yet
+            self.assertEqual(outbox.deliver_due(), (0, 0))
+
+            OutboundEmail.objects.update(next_attempt=timezone.now())
+            self.assertEqual(outbox.deliver_due(), (0, 1))
+            email.refresh_from_db()
+            self.assertEqual((email.status, email.attempts, email.last_error),
+                             ('Failed', 2, 'Connection unexpectedly closed'))
+        self.assertEqual(outbox.retry_delay(3), 240)
+
+    @override_settings(APPS_SETTINGS={'GarageSale': {'email': {'queue': True, 'rate_limits': {'Chair@test.com': 2}}}})
+    def test_130_rate_limited(self):
+        """A sender over its rate limit waits for the next minute - other senders don't"""
+        for to in ('a@test.com', 'b@test.com', 'c@test.com'):
+            outbox.send(message(to=to))
+        outbox.send(message(sender='secretary@test.com'))
+
+        self.assertEqual(outbox.deliver_due(), (3, 0))
+        waiting = OutboundEmail.objects.get(status=OutboundEmail.Status.QUEUED)
+        self.assertEqual((waiting.recipients, waiting.attempts), (['c@test.com'], 0))
+        self.assertGreater(waiting.next_attempt, timezone.now())
+
+    def test_140_worker(self):
+        for to in ('a@test.com', 'b@test.com'):
+            outbox.send(message(to=to))
+        call_command('SendQueuedEmail', '--once', verbosity=0)
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(OutboundEmail.objects.filter(status=OutboundEmail.Status.SENT).count(), 2)
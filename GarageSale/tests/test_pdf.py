@@ -0,0 +1,106 @@
+"""
+Tests of the pdf rendering service - in the calling thread and in the worker pool.
+"""
+import time
+from unittest import mock
+
+from django.core.cache import caches
+from django.test import SimpleTestCase, override_settings
+
+from GarageSale.services import pdf as pdf_service
+
+def _slow_render(html, stylesheets, base_url):
+    """A render which never finishes in time - run in the pool, so it can't be a mock"""
+    time.sleep(60)
+    return b''
+
+
+# The pdf cache held in memory - rather than on disk
+TEST_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+               'pdf': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'pdf'}}
+
+
+@override_settings(CACHES=TEST_CACHES)
+class PdfServiceTests(SimpleTestCase):
+
+    def tearDown(self):
+        pdf_service._discard_pool(pdf_service._pool)
+
+    @override_settings(APPS_SETTINGS={'GarageSale': {'pdf': {'workers': 0}}})
+    def test_100_render_inline(self):
+        """With no workers the pdf is rendered in the calling thread"""
+        pdf = pdf_service.render('<p>Hello</p>', stylesheets=['p {color: red}'])
+        self.assertTrue(pdf.startswith(b'%PDF'))
+        self.assertIsNone(pdf_service._pool)
+
+    @override_settings(APPS_SETTINGS={'GarageSale': {'pdf': {'workers': 2}}})
+    def test_110_render_in_pool(self):
+        """PDFs submitted together are rendered by the pool"""
+        futures = [pdf_service.submit(f'<p>Page {index}</p>') for index in range(4)]
+        self.assertTrue(all(future.result(60).startswith(b'%PDF') for future in futures))
+        self.assertIsNotNone(pdf_service._pool)
+
+    @override_settings(APPS_SETTINGS={'GarageSale': {'pdf': {'workers': 0}}})
+    def test_120_render_failure(self):
+        """A failure to render is raised to the caller"""
+        with mock.patch.object(pdf_service, '_render', side_effect=ValueError('Bad html')):
+            with self.assertRaisesRegex(ValueError, 'Bad html'):
+                pdf_service.render('<p>Hello</p>')
+
+    @override_settings(APPS_SETTINGS={'GarageSale': {'pdf': {'workers': 1, 'timeout': 0.001}}})
+    def test_130_render_timeout(self):
+        """A pdf which takes too long raises a render error"""
+        with mock.patch.object(pdf_service, 'submit', return_value=pdf_service.Future()):
+            with self.assertRaisesRegex(pdf_service.PdfRenderError, 'not rendered within'):
+                pdf_service.render('<p>Hello</p>')
+
+    @override_settings(APPS_SETTINGS={'GarageSale': {'pdf': {'workers': 1, 'start_method': 'fork'}}})
+    def test_135_timeout_stops_worker(self):
+        """A pdf still being rendered when the caller gives up stops its worker - and the next pdf gets a new one"""
+        with mock.patch.object(pdf_service, '_render', _slow_render):
+            future = pdf_service.submit('<p>Slow</p>')
+            pool = pdf_service._pool
+            workers = list(pool._processes.values())
+            with self.assertRaisesRegex(pdf_service.PdfRenderError, 'not rendered within'):
+                pdf_service.result(future, timeout=2)
+
+        self.assertIsNot(pdf_service._pool, pool)
+        self.assertTrue(workers)
+        for worker in workers:
+            worker.join(5)
+            self.assertFalse(worker.is_alive())
+        self.assertTrue(pdf_service.render('<p>Hello</p>').startswith(b'%PDF'))
+
+    @override_settings(APPS_SETTINGS={'GarageSale': {'pdf': {'workers': 1, 'start_method': 'fork'}}})
+    def test_137_timeout_leaves_newer_pool(self):
+        """A pdf from a pool which has since been replaced stops only its own pool's worker"""
+        with mock.patch.object(pdf_service, '_render', _slow_render):
+            future = pdf_service.submit('<p>Slow</p>')
+        old_pool = pdf_service._pool
+        self.addCleanup(pdf_service._discard_pool, old_pool, True)
+        pdf_service._pool = None
+        self.assertTrue(pdf_service.render('<p>Hello</p>').startswith(b'%PDF'))
+        new_pool = pdf_service._pool
+
+        with self.assertRaisesRegex(pdf_service.PdfRenderError, 'not rendered within'):
+            pdf_service.result(future, timeout=1)
+        self.assertIs(pdf_service._pool, new_pool)
+        self.assertTrue(all(worker.is_alive() for worker in new_pool._processes.values()))
+        self.assertTrue(pdf_service.render('<p>Hello again</p>').startswith(b'%PDF'))
+
+    @override_settings(APPS_SETTINGS={'GarageSale': {'pdf': {'workers': 0}}})
+    def test_140_render_cached(self):
+        """An identical pdf is rendered once - a different html or stylesheet is rendered again"""
+        self.addCleanup(caches['pdf'].clear)
+        with mock.patch.object(pdf_service, '_render', side_effect=lambda html, stylesheets, base_url: html.encode()) as render:
+            pdfs = [pdf_service.render_cached('<p>Terms</p>', stylesheets=['p {color: red}']) for _ in range(3)]
+            self.assertEqual(pdfs, [b'<p>Terms</p>'] * 3)
+            self.assertEqual(render.call_count, 1)
+
+            pdf_service.render_cached('<p>Terms</p>', stylesheets=['p {color: blue}'])
+            pdf_service.render_cached('<p>Terms and conditions</p>', stylesheets=['p {color: red}'])
+            self.assertEqual(render.call_count, 3)
+
+            with override_settings(APPS_SETTINGS={'GarageSale': {'pdf': {'workers': 0, 'cache_timeout': 0}}}):
+                pdf_service.render_cached('<p>Terms</p>', stylesheets=['p {color: red}'])
+            self.assertEqual(render.call_count, 4)
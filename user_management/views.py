@@ -1,9 +1,7 @@
 import datetime
 from datetime import datetime as dt
 from typing import Type
-import io
 
-import weasyprint
 from django.contrib.auth.base_user import AbstractBaseUser
 from django.contrib.staticfiles import finders
 from django.template import Template, Context
@@ -23,6 +21,7 @@ from django.core.exceptions import ObjectDoesNotExist, ValidationError, Permissi
 from django.contrib.auth import authenticate
 
 from TeamPageFramework.entry_point import EntryPointMixin
+from GarageSale.services import outbox, pdf as pdf_service
 from . import forms
 from .models import GuestVerifier, PasswordResetApplication, UserExtended, \
     AdditionalData, TeamMember
@@ -62,7 +61,7 @@ def send_register_verification_email(incoming_request, email, url):
                                  to=[email])
     msg.attach_alternative(non_html, 'text/plain')
     msg.attach_alternative(html_content, 'text/html')
-    msg.send()
+    outbox.send(msg)
 
 
 def send_guest_verification_email(request, email=None, short_code=None, template=None,
@@ -87,7 +86,7 @@ def send_guest_verification_email(request, email=None, short_code=None, template
                            f'please enter this value into the website',
                            'text/plain')
     msg.attach_alternative(html_content, 'text/html')
-    msg.send()
+    outbox.send(msg)
 
 
 def guest_error(incoming_request, short_code_id=None):
@@ -698,7 +697,7 @@ class ResetPasswordApply(View):
                     f"If you didn't request a reset you can ignore this email.\n",
                                'text/plain')
         msg.attach_alternative(html_content, 'text/html')
-        msg.send()
+        outbox.send(msg)
 
         return TemplateResponse(request, 'generic_forms/generic_response.html',
                                 context={'msg': 'A Password reset email has been sent to you. '
@@ -820,7 +819,7 @@ def id_card_pdf_header(context:dict):
 def make_pdf( template_file:str, context:dict, header:str, request):
     template_content = get_template(template_file)
     content = template_content.render(context | {'request': request})
-    pdf = weasyprint.HTML(io.StringIO(content), base_url=request.build_absolute_uri()).write_pdf(stylesheets=[weasyprint.CSS(string=header)])
+    pdf = pdf_service.render(content, stylesheets=[header], base_url=request.build_absolute_uri())
     return pdf, content
 
 